@@ -0,0 +1,175 @@
+#
+#  Copyright (C) 2016 Dell, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+'''
+Throughput of the REST API servers under concurrent status polling.
+
+Every server answers status requests of clients polling as fast as they can
+for a while. The blockade is a stand-in whose status takes as long as the
+Docker calls of a real one would, so no Docker is needed. Run it from the
+source tree with blockade installed, e.g. by ``pip install -e .``:
+
+    python benchmarks/rest_throughput.py --clients 64 --containers 100
+'''
+
+import argparse
+import shutil
+import socket
+import tempfile
+import threading
+import time
+
+import gevent
+from gevent.pywsgi import WSGIServer
+from six.moves import http_client
+
+from blockade.api import rest
+from blockade.api.manager import BlockadeManager
+
+
+class _FakeContainer(object):
+
+    def __init__(self, name):
+        self.name = name
+
+    def to_dict(self):
+        return {'name': self.name, 'status': 'UP', 'network_state': 'NORMAL'}
+
+
+class _FakeBlockade(object):
+
+    def __init__(self, containers, latency):
+        self._containers = [_FakeContainer("c%d" % idx)
+                            for idx in range(containers)]
+        self._latency = latency
+
+    def status(self):
+        time.sleep(self._latency)
+        return list(self._containers)
+
+
+def _free_port():
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+def _poll(port, deadline, counts, idx):
+    conn = http_client.HTTPConnection('127.0.0.1', port, timeout=30)
+    while time.time() < deadline:
+        conn.request("GET", "/blockade/bench")
+        response = conn.getresponse()
+        response.read()
+        if response.status == 200:
+            counts[idx] += 1
+    conn.close()
+
+
+def _run_gevent(port, threads):
+    gevent.get_hub().threadpool.maxsize = threads
+    server = WSGIServer(('127.0.0.1', port), rest.app, log=None)
+    server.start()
+    stopping = threading.Event()
+
+    def serve_forever():
+        # the server can only be stopped from the thread of its hub
+        try:
+            while not stopping.is_set():
+                gevent.sleep(0.1)
+        finally:
+            server.stop()
+
+    return serve_forever, stopping.set
+
+
+def _run_asyncio(port, threads):
+    from blockade.api.aio import AsyncServer
+    server = AsyncServer(rest.app, host='127.0.0.1', port=port,
+                         workers=threads)
+    return server.serve_forever, server.stop
+
+
+def measure(server, clients, duration, threads):
+    '''Status requests per second answered by the given server'''
+    port = _free_port()
+    rest._offload_to_hub = server == rest.GEVENT_SERVER
+    started = threading.Event()
+    stop = []
+
+    def serve():
+        if server == rest.GEVENT_SERVER:
+            serve_forever, stop_server = _run_gevent(port, threads)
+        else:
+            serve_forever, stop_server = _run_asyncio(port, threads)
+        stop.append(stop_server)
+        started.set()
+        serve_forever()
+
+    thread = threading.Thread(target=serve)
+    thread.daemon = True
+    thread.start()
+    started.wait()
+    try:
+        time.sleep(0.2)
+
+        counts = [0] * clients
+        deadline = time.time() + duration
+        pollers = [threading.Thread(target=_poll,
+                                    args=(port, deadline, counts, idx))
+                   for idx in range(clients)]
+        start = time.time()
+        for poller in pollers:
+            poller.start()
+        for poller in pollers:
+            poller.join()
+        elapsed = time.time() - start
+    finally:
+        stop[0]()
+        thread.join()
+    return sum(counts) / elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[1])
+    parser.add_argument("--clients", type=int, default=64)
+    parser.add_argument("--containers", type=int, default=100)
+    parser.add_argument("--latency", type=float, default=0.005,
+                        help="Seconds a status takes. Default: 0.005")
+    parser.add_argument("--duration", type=float, default=5.0)
+    parser.add_argument("--threads", type=int,
+                        default=rest.DEFAULT_DAEMON_THREADS)
+    parser.add_argument("--server", choices=rest.SERVERS, action="append",
+                        help="Server to measure. Default: all")
+    opts = parser.parse_args()
+
+    data_dir = tempfile.mkdtemp()
+    blockade = _FakeBlockade(opts.containers, opts.latency)
+    BlockadeManager.set_data_dir(data_dir)
+    BlockadeManager.get_blockade = staticmethod(lambda name: blockade)
+    BlockadeManager.blockade_exists = staticmethod(lambda name: True)
+    try:
+        for server in opts.server or rest.SERVERS:
+            rate = measure(server, opts.clients, opts.duration, opts.threads)
+            print("%-8s %8.1f requests/s" % (server, rate))
+    finally:
+        BlockadeManager.close_store()
+        shutil.rmtree(data_dir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,393 @@
+#
+#  Copyright (C) 2016 Dell, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+'''
+asyncio HTTP server for the REST API, an alternative to the gevent server.
+
+Connections are served by the event loop, whereas every request runs the
+WSGI app on a bounded pool of threads, which make the blocking Docker and
+host calls of the handlers. This module needs Python 3.5 or later.
+
+Event streams (text/event-stream) are the exception: once the app returned
+one, the loop iterates it, so a client following events holds no thread.
+Their iterators must not block. They yield an empty chunk when nothing is
+to be sent, and the loop waits a moment before asking again. The app finds
+in the environ of every request:
+
+    blockade.stopping        a threading.Event set once the server stops
+    blockade.stream_on_loop  True, event streams are iterated by the loop
+'''
+
+import asyncio
+import concurrent.futures
+import io
+import logging
+import signal
+import sys
+import threading
+from urllib.parse import unquote_to_bytes
+
+
+# how long to wait for the requests in progress when shutting down, and for
+# the next request on an idle connection
+SHUTDOWN_TIMEOUT = 30
+KEEPALIVE_TIMEOUT = 75
+
+# how often an event stream with nothing to send is asked again, and how
+# often a worker waiting to send checks whether the server is gone
+STREAM_POLL_INTERVAL = 0.2
+SEND_POLL_INTERVAL = 1
+
+MAX_HEADER_SIZE = 64 * 1024
+# request bodies are read into memory, larger ones are refused
+MAX_BODY_SIZE = 8 * 1024 * 1024
+
+_logger = logging.getLogger(__name__)
+
+
+class BadRequest(Exception):
+    pass
+
+
+def _parse_head(head):
+    '''Parse the request line and headers of an HTTP/1.x request'''
+    lines = head.decode('latin-1').split('\r\n')
+    try:
+        method, target, version = lines[0].split(' ')
+    except ValueError:
+        raise BadRequest("Invalid request line")
+    if not version.startswith('HTTP/1.'):
+        raise BadRequest("Unsupported HTTP version %s" % version)
+    headers = []
+    for line in lines[1:]:
+        if not line:
+            continue
+        name, sep, value = line.partition(':')
+        if not sep:
+            raise BadRequest("Invalid header line")
+        headers.append((name.strip(), value.strip()))
+    return method, target, version, headers
+
+
+def _environ(method, target, version, headers, body, server, peer):
+    path, _, query = target.partition('?')
+    environ = {
+        'REQUEST_METHOD': method,
+        'SCRIPT_NAME': '',
+        'PATH_INFO': unquote_to_bytes(path).decode('latin-1'),
+        'QUERY_STRING': query,
+        'SERVER_NAME': server[0],
+        'SERVER_PORT': str(server[1]),
+        'SERVER_PROTOCOL': version,
+        'REMOTE_ADDR': peer[0] if peer else '',
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': 'http',
+        'wsgi.input': io.BytesIO(body),
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': False,
+        'wsgi.run_once': False,
+    }
+    for name, value in headers:
+        key = name.upper().replace('-', '_')
+        if key in ('CONTENT_TYPE', 'CONTENT_LENGTH'):
+            environ[key] = value
+        else:
+            key = 'HTTP_' + key
+            if key in environ:
+                value = environ[key] + ',' + value
+            environ[key] = value
+    return environ
+
+
+class _Response(object):
+    '''Writes the response of a WSGI app, from a worker thread'''
+
+    def __init__(self, send, version, keep_alive, stopping):
+        self._send = send
+        self._version = version
+        self.keep_alive = keep_alive
+        self._stopping = stopping
+        self._status = None
+        self._headers = None
+        self._chunked = False
+        self.started = False
+
+    def start_response(self, status, headers, exc_info=None):
+        if exc_info is not None and self.started:
+            raise exc_info[1].with_traceback(exc_info[2])
+        self._status = status
+        self._headers = list(headers)
+        return self.write
+
+    def _start(self, has_body):
+        if self._stopping():
+            self.keep_alive = False
+        names = set(name.lower() for name, _ in self._headers)
+        if has_body and 'content-length' not in names:
+            if self._version == 'HTTP/1.1':
+                self._chunked = True
+                self._headers.append(('Transfer-Encoding', 'chunked'))
+            else:
+                # the end of the body is where the connection ends
+                self.keep_alive = False
+        if not self.keep_alive:
+            self._headers.append(('Connection', 'close'))
+        lines = ["%s %s" % (self._version, self._status)]
+        lines.extend("%s: %s" % header for header in self._headers)
+        self.started = True
+        return ("\r\n".join(lines) + "\r\n\r\n").encode('latin-1')
+
+    def is_event_stream(self):
+        return any(name.lower() == 'content-type' and
+                   value.split(';')[0].strip() == 'text/event-stream'
+                   for name, value in self._headers)
+
+    def frame(self, data):
+        '''The bytes to send for a piece of the body, after the head'''
+        head = b'' if self.started else self._start(True)
+        if data and self._chunked:
+            data = b"%x\r\n%s\r\n" % (len(data), data)
+        return head + data
+
+    def end(self):
+        '''The bytes to send when the body is done'''
+        if not self.started:
+            return self._start(False)
+        return b"0\r\n\r\n" if self._chunked else b''
+
+    def write(self, data):
+        data = self.frame(data)
+        if data:
+            self._send(data)
+
+    def finish(self):
+        data = self.end()
+        if data:
+            self._send(data)
+
+
+class AsyncServer(object):
+    '''
+    HTTP/1.1 server running a WSGI app on asyncio, with keep-alive and
+    chunked responses. `workers` threads run the requests.
+    '''
+
+    def __init__(self, app, host='', port=5000, workers=32,
+                 shutdown_timeout=SHUTDOWN_TIMEOUT,
+                 max_body_size=MAX_BODY_SIZE):
+        self._app = app
+        self._max_body_size = max_body_size
+        self._host = host or None
+        self._port = port
+        self._workers = workers
+        self._shutdown_timeout = shutdown_timeout
+        self._loop = None
+        self._executor = None
+        self._stopping = None
+        # the same for the worker threads, and set once the loop is gone
+        self._stopped = threading.Event()
+        self._closed = False
+        self._handlers = set()
+        self._idle = set()
+        self.started = threading.Event()
+        self.address = None
+
+    def serve_forever(self):
+        '''Serve until stop is called or SIGINT or SIGTERM come in'''
+        self._loop = asyncio.new_event_loop()
+        self._executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=self._workers)
+        try:
+            self._loop.run_until_complete(self._serve())
+        finally:
+            # workers still sending give up instead of waiting for the loop
+            self._closed = True
+            self._executor.shutdown(wait=True)
+            self._loop.close()
+
+    def stop(self):
+        '''Stop serving once the requests in progress are done, from any
+        thread'''
+        if self._loop is not None and not self._loop.is_closed():
+            self._loop.call_soon_threadsafe(self._stopping.set)
+
+    async def _serve(self):
+        self._stopping = asyncio.Event()
+        server = await asyncio.start_server(
+            self._handle, self._host, self._port, limit=MAX_HEADER_SIZE)
+        self.address = server.sockets[0].getsockname()
+        self._add_signal_handlers()
+        self.started.set()
+        try:
+            await self._stopping.wait()
+        finally:
+            self._stopped.set()
+            server.close()
+            await self._shutdown()
+
+    def _add_signal_handlers(self):
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            try:
+                self._loop.add_signal_handler(signum, self._stopping.set)
+            except (NotImplementedError, RuntimeError, ValueError):
+                # not the main thread, or not supported on this platform
+                pass
+
+    async def _shutdown(self):
+        # idle connections are closed right away, the others once their
+        # request is answered
+        for task in list(self._idle):
+            task.cancel()
+        if self._handlers:
+            _, pending = await asyncio.wait(list(self._handlers),
+                                            timeout=self._shutdown_timeout)
+            for task in pending:
+                _logger.warning("Cancelling a request still in progress")
+                task.cancel()
+
+    async def _handle(self, reader, writer):
+        task = asyncio.current_task() if hasattr(asyncio, 'current_task') \
+            else asyncio.Task.current_task()
+        self._handlers.add(task)
+        try:
+            keep_alive = True
+            while keep_alive and not self._stopping.is_set():
+                self._idle.add(task)
+                try:
+                    head = await asyncio.wait_for(
+                        reader.readuntil(b"\r\n\r\n"), KEEPALIVE_TIMEOUT)
+                except (asyncio.IncompleteReadError, asyncio.LimitOverrunError,
+                        asyncio.TimeoutError, ConnectionError):
+                    return
+                finally:
+                    self._idle.discard(task)
+                keep_alive = await self._request(head, reader, writer)
+        except (asyncio.CancelledError, ConnectionError):
+            pass
+        finally:
+            self._handlers.discard(task)
+            writer.close()
+
+    async def _request(self, head, reader, writer):
+        try:
+            method, target, version, headers = _parse_head(head)
+            lowered = dict((name.lower(), value) for name, value in headers)
+            if 'chunked' in lowered.get('transfer-encoding', '').lower():
+                raise BadRequest("Chunked request bodies are not supported")
+            length = int(lowered.get('content-length') or 0)
+            if length < 0:
+                raise BadRequest("Negative Content-Length")
+        except (BadRequest, ValueError) as err:
+            writer.write(b"HTTP/1.1 400 Bad Request\r\nConnection: close\r\n"
+                         b"Content-Length: 0\r\n\r\n")
+            _logger.debug("Bad request: %s", err)
+            return False
+        if length > self._max_body_size:
+            # refused before reading any of it
+            writer.write(b"HTTP/1.1 413 Payload Too Large\r\n"
+                         b"Connection: close\r\nContent-Length: 0\r\n\r\n")
+            return False
+        body = await reader.readexactly(length) if length else b''
+
+        connection = lowered.get('connection', '').lower()
+        keep_alive = ((version == 'HTTP/1.1' and connection != 'close') or
+                      connection == 'keep-alive')
+        environ = _environ(method, target, version, headers, body,
+                           writer.get_extra_info('sockname'),
+                           writer.get_extra_info('peername'))
+
+        environ['blockade.stopping'] = self._stopped
+        environ['blockade.stream_on_loop'] = True
+
+        def send(data):
+            # called by the worker thread, which waits for slow clients
+            # but not for a loop that is gone
+            if self._closed:
+                raise ConnectionError("The server is shut down")
+            future = asyncio.run_coroutine_threadsafe(
+                self._send(writer, data), self._loop)
+            while True:
+                try:
+                    return future.result(SEND_POLL_INTERVAL)
+                except concurrent.futures.TimeoutError:
+                    if self._closed:
+                        future.cancel()
+                        raise ConnectionError("The server is shut down")
+
+        response = _Response(send, version, keep_alive,
+                             self._stopping.is_set)
+        stream = await self._loop.run_in_executor(
+            self._executor, self._run_app, environ, response)
+        if stream is not None:
+            await self._stream(stream, response, writer, environ)
+        return response.keep_alive and not self._stopping.is_set()
+
+    @staticmethod
+    async def _send(writer, data):
+        writer.write(data)
+        await writer.drain()
+
+    async def _stream(self, body, response, writer, environ):
+        '''Send an event stream from the loop until it ends or the server
+        stops'''
+        try:
+            for data in body:
+                if data or not response.started:
+                    await self._send(writer, response.frame(data))
+                elif self._stopping.is_set():
+                    response.keep_alive = False
+                    break
+                else:
+                    await asyncio.sleep(STREAM_POLL_INTERVAL)
+            await self._send(writer, response.end())
+        except (asyncio.CancelledError, ConnectionError):
+            raise
+        except Exception:
+            _logger.exception("Failed to stream %s %s",
+                              environ['REQUEST_METHOD'], environ['PATH_INFO'])
+            response.keep_alive = False
+        finally:
+            if hasattr(body, 'close'):
+                body.close()
+
+    def _run_app(self, environ, response):
+        '''Run the app and send its response, but hand event streams back to
+        the loop'''
+        try:
+            body = self._app(environ, response.start_response)
+            if response.is_event_stream():
+                return body
+            try:
+                for data in body:
+                    response.write(data)
+            finally:
+                if hasattr(body, 'close'):
+                    body.close()
+            response.finish()
+        except ConnectionError:
+            _logger.debug("Client of %s %s is gone",
+                          environ['REQUEST_METHOD'], environ['PATH_INFO'])
+            response.keep_alive = False
+        except Exception:
+            _logger.exception("Failed to serve %s %s",
+                              environ['REQUEST_METHOD'], environ['PATH_INFO'])
+            response.keep_alive = False
+            if not response.started:
+                response.start_response(
+                    "500 Internal Server Error",
+                    [('Content-Length', '0')])
+                response.finish()
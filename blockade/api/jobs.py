@@ -0,0 +1,162 @@
+#
+#  Copyright (C) 2016 Dell, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+import collections
+import logging
+import os
+import threading
+import time
+import uuid
+
+from six.moves import queue
+
+
+# number of jobs running at the same time
+JOB_WORKERS_ENV = "BLOCKADE_JOB_WORKERS"
+DEFAULT_JOB_WORKERS = 4
+
+# number of finished jobs whose outcome can still be looked up
+MAX_FINISHED_JOBS = 1000
+
+_logger = logging.getLogger(__name__)
+
+
+class JobStatus(object):
+    PENDING = "pending"
+    RUNNING = "running"
+    SUCCEEDED = "succeeded"
+    FAILED = "failed"
+
+
+class Job(object):
+    '''A long running operation on a blockade run in the background'''
+
+    def __init__(self, blockade, action, func):
+        self.id = uuid.uuid4().hex
+        self.blockade = blockade
+        self.action = action
+        self.status = JobStatus.PENDING
+        self.done = 0
+        self.total = None
+        self.message = ''
+        self.result = None
+        self.error = None
+        self.created = time.time()
+        self.started = None
+        self.finished = None
+        self._func = func
+
+    def progress(self, done, total, message):
+        '''Progress callback for Blockade.create and Blockade.destroy'''
+        self.done = done
+        self.total = total
+        self.message = message
+
+    def run(self):
+        self.started = time.time()
+        self.status = JobStatus.RUNNING
+        try:
+            self.result = self._func(self)
+            self.status = JobStatus.SUCCEEDED
+        except Exception as ex:
+            _logger.exception("Job %s (%s of %s) failed",
+                              self.id, self.action, self.blockade)
+            self.error = str(ex)
+            self.status = JobStatus.FAILED
+        finally:
+            self.finished = time.time()
+
+    def to_dict(self):
+        progress = self.message
+        if self.total:
+            progress = "[%d/%d] %s" % (self.done, self.total, self.message)
+        return {
+            'id': self.id,
+            'blockade': self.blockade,
+            'action': self.action,
+            'status': self.status,
+            'progress': progress,
+            'done': self.done,
+            'total': self.total,
+            'result': self.result,
+            'error': self.error,
+            'created': self.created,
+            'started': self.started,
+            'finished': self.finished,
+        }
+
+
+def _workers_from_env():
+    return int(os.environ.get(JOB_WORKERS_ENV, DEFAULT_JOB_WORKERS))
+
+
+class JobRunner(object):
+    '''
+    Runs jobs on a bounded pool of worker threads, which are only started
+    once there is something to do, and keeps them for lookup by id.
+    '''
+
+    def __init__(self, max_workers=None, max_finished=MAX_FINISHED_JOBS):
+        self._max_workers = max_workers or _workers_from_env()
+        self._max_finished = max_finished
+        self._queue = queue.Queue()
+        self._jobs = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self._workers = []
+
+    def submit(self, blockade, action, func):
+        '''
+        Run func(job) in the background and return the job. What func
+        returns is the result of the job.
+        '''
+        job = Job(blockade, action, func)
+        with self._lock:
+            self._jobs[job.id] = job
+            self._expire()
+            if len(self._workers) < self._max_workers:
+                worker = threading.Thread(target=self._work,
+                                          name="blockade-job-worker")
+                worker.daemon = True
+                worker.start()
+                self._workers.append(worker)
+        self._queue.put(job)
+        return job
+
+    def get(self, job_id):
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def _expire(self):
+        finished = [job_id for job_id, job in self._jobs.items()
+                    if job.finished is not None]
+        for job_id in finished[:max(0, len(finished) - self._max_finished)]:
+            del self._jobs[job_id]
+
+    def _work(self):
+        while True:
+            job = self._queue.get()
+            if job is None:
+                return
+            job.run()
+
+    def close(self):
+        '''Stop the workers once the submitted jobs are done'''
+        with self._lock:
+            workers, self._workers = self._workers, []
+        for _ in workers:
+            self._queue.put(None)
+        for worker in workers:
+            worker.join()
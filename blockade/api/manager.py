@@ -14,18 +14,123 @@
 # limitations under the License.
 #
 
+from contextlib import contextmanager
+
+import logging
+import os
+import threading
+import uuid
+
+import docker
+
+from blockade.api.store import BlockadeStore
+from blockade.api.store import StoreState
+from blockade.config import BlockadeConfig
 from blockade.core import Blockade
-from blockade.errors import InvalidBlockadeName
 from blockade.net import BlockadeNetwork
-from blockade.state import BlockadeState
 
-# TODO(pdmars): breaks if server restarts, refactor to be part of BlockadeState
-BLOCKADE_CONFIGS = {}
 DATA_DIR = "/tmp"
+STORE_FILE = "blockade.db"
+
+# configs, states and chaos options of all blockades persist in the store
+_STORE = None
+_STORE_LOCK = threading.Lock()
+
+# parsed configs by blockade name, filled from the store on demand
+_CONFIGS = {}
+
+# Blockade instances by name, reused across requests until their config,
+# state or host exec changes
+_BLOCKADES = {}
+_BLOCKADES_LOCK = threading.Lock()
+
+# all blockades share one Docker client
+_DOCKER_CLIENT = None
+
+# reader/writer locks by blockade name
+_LOCKS = {}
+_LOCKS_LOCK = threading.Lock()
+
+# The status of a blockade changes with every version, which is bumped by
+# changes through the daemon and by Docker events of its containers. The
+# generation is bumped for changes that may concern any blockade. The epoch
+# tells versions of different daemon runs apart.
+_STATUS_VERSIONS = {}
+_STATUS_GENERATION = 0
+_STATUS_EPOCH = uuid.uuid4().hex[:8]
+_STATUS_LOCK = threading.Lock()
+
+# Docker events changing the status of containers
+STATUS_EVENTS = ["create", "start", "restart", "stop", "kill", "die",
+                 "oom", "pause", "unpause", "rename", "destroy",
+                 "update"]
+EVENTS_RECONNECT_DELAY = 5
+
+_watcher = None
+
+_logger = logging.getLogger(__name__)
+
+
+class LazyBlockade(object):
+    '''
+    Stands in for a managed blockade, which is only built, and so only
+    talks to Docker, once it is used, and is always the current instance.
+    '''
+
+    def __init__(self, name):
+        self.name = name
+
+    def __getattr__(self, attr):
+        return getattr(BlockadeManager.get_blockade(self.name), attr)
+
+
+class ReadWriteLock(object):
+    '''
+    Lock held by any number of readers or by a single writer. Once a writer
+    waits for the lock no new readers get it, so writers do not starve.
+    '''
+
+    def __init__(self):
+        self._cond = threading.Condition(threading.Lock())
+        self._readers = 0
+        self._writer = False
+        self._waiting_writers = 0
+
+    @contextmanager
+    def read(self):
+        with self._cond:
+            while self._writer or self._waiting_writers:
+                self._cond.wait()
+            self._readers += 1
+        try:
+            yield
+        finally:
+            with self._cond:
+                self._readers -= 1
+                if not self._readers:
+                    self._cond.notify_all()
+
+    @contextmanager
+    def write(self):
+        with self._cond:
+            self._waiting_writers += 1
+            try:
+                while self._writer or self._readers:
+                    self._cond.wait()
+            finally:
+                self._waiting_writers -= 1
+            self._writer = True
+        try:
+            yield
+        finally:
+            with self._cond:
+                self._writer = False
+                self._cond.notify_all()
 
 
 class BlockadeManager:
-    """Simple helper for what should eventually be persisted via BlockadeState
+    """Access to the blockades managed by the daemon, which are kept in a
+    BlockadeStore in the data directory and so survive daemon restarts
     """
     host_exec = None
 
@@ -33,48 +138,281 @@ class BlockadeManager:
     def set_data_dir(data_dir):
         global DATA_DIR
         DATA_DIR = data_dir
+        BlockadeManager.close_store()
+
+    @staticmethod
+    def get_data_dir():
+        return DATA_DIR
 
     @staticmethod
     def set_host_exec(host_exec):
         BlockadeManager.host_exec = host_exec
+        BlockadeManager.invalidate_blockades()
+
+    @staticmethod
+    def get_store():
+        global _STORE
+        with _STORE_LOCK:
+            if _STORE is None:
+                _STORE = BlockadeStore(os.path.join(DATA_DIR, STORE_FILE))
+            return _STORE
+
+    @staticmethod
+    def close_store():
+        global _STORE
+        with _STORE_LOCK:
+            if _STORE is not None:
+                _STORE.close()
+                _STORE = None
+            _CONFIGS.clear()
+        BlockadeManager.invalidate_blockades()
 
     @staticmethod
     def blockade_exists(name):
-        global BLOCKADE_CONFIGS
-        return name in BLOCKADE_CONFIGS
+        return name in _CONFIGS or BlockadeManager.get_store().exists(name)
 
     @staticmethod
-    def store_config(name, config):
-        global BLOCKADE_CONFIGS
-        BLOCKADE_CONFIGS[name] = config
+    def store_config(name, config, config_dict):
+        BlockadeManager.get_store().put_config(name, config_dict)
+        _CONFIGS[name] = config
+        BlockadeManager.invalidate_blockade(name)
 
     @staticmethod
     def delete_config(name):
-        global BLOCKADE_CONFIGS
-        if name in BLOCKADE_CONFIGS:
-            del BLOCKADE_CONFIGS[name]
+        BlockadeManager.get_store().delete(name)
+        _CONFIGS.pop(name, None)
+        BlockadeManager.invalidate_blockade(name)
+
+    @staticmethod
+    def get_config(name):
+        config = _CONFIGS.get(name)
+        if config is None:
+            config_dict = BlockadeManager.get_store().get_config(name)
+            if config_dict is None:
+                raise KeyError(name)
+            config = _CONFIGS[name] = BlockadeConfig.from_dict(config_dict)
+        return config
+
+    @staticmethod
+    def load_configs():
+        '''
+        Parse the configs of all stored blockades up front, which is cheap
+        and leaves no Docker work for later than their first use
+        '''
+        for name, config_dict in BlockadeManager.get_store().configs().items():
+            if name in _CONFIGS:
+                continue
+            try:
+                _CONFIGS[name] = BlockadeConfig.from_dict(config_dict)
+            except Exception:
+                _logger.exception("Invalid config of blockade %s", name)
+
+    @staticmethod
+    def store_chaos(name, options):
+        BlockadeManager.get_store().put_chaos(name, options)
+
+    @staticmethod
+    def store_chaos_state(name, state):
+        BlockadeManager.get_store().put_chaos_state(name, state)
+
+    @staticmethod
+    def load_all_chaos():
+        '''The name, options and last state of all stored chaos'''
+        return BlockadeManager.get_store().all_chaos()
+
+    @staticmethod
+    def load_chaos(name):
+        return BlockadeManager.get_store().get_chaos(name)
+
+    @staticmethod
+    def delete_chaos(name):
+        BlockadeManager.get_store().delete_chaos(name)
 
     @staticmethod
     def load_state(name):
-        global DATA_DIR
-        try:
-            return BlockadeState(blockade_id=name, data_dir=DATA_DIR)
-        except InvalidBlockadeName:
-            raise
+        return StoreState(BlockadeManager.get_store(), name,
+                          data_dir=DATA_DIR)
+
+    @staticmethod
+    def get_docker_client():
+        global _DOCKER_CLIENT
+        with _BLOCKADES_LOCK:
+            if _DOCKER_CLIENT is None:
+                _DOCKER_CLIENT = docker.APIClient(
+                    **docker.utils.kwargs_from_env(assert_hostname=False))
+            return _DOCKER_CLIENT
 
     @staticmethod
     def get_blockade(name):
-        global BLOCKADE_CONFIGS
-        config = BLOCKADE_CONFIGS[name]
+        b = _BLOCKADES.get(name)
+        if b is not None:
+            return b
+
+        config = BlockadeManager.get_config(name)
         host_exec = BlockadeManager.host_exec
         if host_exec is None:
             raise ValueError("host exec not set")
-        return Blockade(config,
-                        blockade_id=name,
-                        state=BlockadeManager.load_state(name),
-                        network=BlockadeNetwork(config, host_exec))
+        b = Blockade(config,
+                     blockade_id=name,
+                     state=BlockadeManager.load_state(name),
+                     network=BlockadeNetwork(config, host_exec),
+                     docker_client=BlockadeManager.get_docker_client())
+        with _BLOCKADES_LOCK:
+            # keep the instance another request may have built meanwhile
+            return _BLOCKADES.setdefault(name, b)
+
+    @staticmethod
+    def invalidate_blockade(name):
+        '''Build the blockade anew on its next use'''
+        with _BLOCKADES_LOCK:
+            _BLOCKADES.pop(name, None)
+
+    @staticmethod
+    def invalidate_blockades():
+        with _BLOCKADES_LOCK:
+            _BLOCKADES.clear()
+
+    @staticmethod
+    def get_lock(name):
+        with _LOCKS_LOCK:
+            lock = _LOCKS.get(name)
+            if lock is None:
+                lock = _LOCKS[name] = ReadWriteLock()
+            return lock
+
+    @staticmethod
+    def read_lock(name):
+        '''Context manager for looking at a blockade, many at once'''
+        return BlockadeManager.get_lock(name).read()
+
+    @staticmethod
+    @contextmanager
+    def write_lock(name):
+        '''Context manager for changing a blockade, one at a time'''
+        with BlockadeManager.get_lock(name).write():
+            try:
+                yield
+            finally:
+                BlockadeManager.bump_status_version(name)
+
+    @staticmethod
+    def bump_status_version(name=None):
+        '''Mark the status of a blockade, or of all of them, as changed'''
+        global _STATUS_GENERATION
+        with _STATUS_LOCK:
+            if name is None:
+                _STATUS_GENERATION += 1
+            else:
+                _STATUS_VERSIONS[name] = _STATUS_VERSIONS.get(name, 0) + 1
+
+    @staticmethod
+    def status_version(name):
+        '''
+        The version of the status of a blockade, or None if changes may
+        go unnoticed because the Docker events are not being watched.
+        '''
+        if _watcher is not None and not _watcher.connected:
+            return None
+        with _STATUS_LOCK:
+            return "%s-%d-%d" % (_STATUS_EPOCH, _STATUS_GENERATION,
+                                 _STATUS_VERSIONS.get(name, 0))
+
+    @staticmethod
+    def container_counts():
+        '''The number of containers of every initialized blockade'''
+        store = BlockadeManager.get_store()
+        counts = {}
+        for name in store.names():
+            containers, _ = store.get_containers(name)
+            if containers is not None:
+                counts[name] = len(containers)
+        return counts
+
+    @staticmethod
+    def blockades_with_container(container_id):
+        return BlockadeManager.get_store().names_with_container(container_id)
+
+    @staticmethod
+    def watch_docker_events(docker_client=None):
+        '''
+        Watch the Docker events in the background to notice containers
+        changing outside of the daemon
+        '''
+        global _watcher
+        if _watcher is None:
+            _watcher = _DockerEventWatcher(
+                docker_client or BlockadeManager.get_docker_client())
+            _watcher.start()
+        return _watcher
+
+    @staticmethod
+    def stop_watching_docker_events():
+        global _watcher
+        if _watcher is not None:
+            _watcher.stop()
+            _watcher = None
 
     @staticmethod
     def get_all_blockade_names():
-        global BLOCKADE_CONFIGS
-        return list(BLOCKADE_CONFIGS.keys())
+        return BlockadeManager.get_store().names()
+
+
+class _DockerEventWatcher(object):
+    '''
+    Bumps the status version of the blockades whose containers change,
+    according to the Docker events, on a background thread
+    '''
+
+    def __init__(self, docker_client):
+        self._docker_client = docker_client
+        self._stopped = threading.Event()
+        self._events = None
+        self.connected = False
+
+    def start(self):
+        thread = threading.Thread(target=self._run,
+                                  name="blockade-docker-events")
+        thread.daemon = True
+        thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        events = self._events
+        if events is not None and hasattr(events, 'close'):
+            events.close()
+
+    def _run(self):
+        while not self._stopped.is_set():
+            try:
+                self._events = self._docker_client.events(
+                    decode=True,
+                    filters={"type": "container", "event": STATUS_EVENTS})
+                self.connected = True
+                # whatever happened while not connected went unnoticed
+                BlockadeManager.bump_status_version()
+                for event in self._events:
+                    if self._stopped.is_set():
+                        break
+                    self._handle(event)
+            except Exception:
+                if not self._stopped.is_set():
+                    _logger.warning("Lost the Docker event stream",
+                                    exc_info=True)
+            finally:
+                self.connected = False
+                self._events = None
+            self._stopped.wait(EVENTS_RECONNECT_DELAY)
+
+    def _handle(self, event):
+        actor = event.get('Actor') or {}
+        labels = actor.get('Attributes') or {}
+        name = labels.get('blockade.id')
+        if name is not None:
+            BlockadeManager.bump_status_version(name)
+            return
+        # containers added to a blockade do not carry its label
+        container_id = actor.get('ID') or event.get('id')
+        if container_id:
+            for name in BlockadeManager.blockades_with_container(
+                    container_id):
+                BlockadeManager.bump_status_version(name)
@@ -0,0 +1,210 @@
+#
+#  Copyright (C) 2016 Dell, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+'''
+Metrics of the daemon in the Prometheus text exposition format.
+
+Latencies of Docker calls, host commands, audit writes and whole blockade
+operations are collected from the timing spans, see `blockade.timing`.
+'''
+
+import bisect
+import threading
+
+from blockade import timing
+
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                   1.0, 2.5, 5.0, 10.0)
+
+
+def _escape(value):
+    return (str(value).replace("\\", "\\\\").replace("\n", "\\n")
+            .replace('"', '\\"'))
+
+
+def _labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ""
+    return "{%s}" % ",".join('%s="%s"' % (name, _escape(value))
+                             for name, value in pairs)
+
+
+def _number(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _Metric(object):
+    kind = None
+
+    def __init__(self, name, documentation, labels=()):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def _key(self, labels):
+        return tuple(str(labels[name]) for name in self.label_names)
+
+    def render(self):
+        lines = ["# HELP %s %s" % (self.name, self.documentation),
+                 "# TYPE %s %s" % (self.name, self.kind)]
+        with self._lock:
+            items = sorted(self._values.items())
+        for key, value in items:
+            lines.extend(self._render_value(key, value))
+        return lines
+
+    def _render_value(self, key, value):
+        return ["%s%s %s" % (self.name, _labels(self.label_names, key),
+                             _number(value))]
+
+
+class Gauge(_Metric):
+    '''Gauge whose values are all set anew by every collection'''
+    kind = "gauge"
+
+    def set_all(self, values):
+        '''Replace all values, given as (labels dict, value) pairs'''
+        values = dict((self._key(labels), value) for labels, value in values)
+        with self._lock:
+            self._values = values
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name, documentation, labels=(),
+                 buckets=DEFAULT_BUCKETS):
+        super(Histogram, self).__init__(name, documentation, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        idx = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            counts = self._values.get(key)
+            if counts is None:
+                # one count per bucket, then +Inf, then the sum
+                counts = [0] * (len(self.buckets) + 1) + [0.0]
+                self._values[key] = counts
+            counts[idx] += 1
+            counts[-1] += value
+
+    def _render_value(self, key, counts):
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets + (float("inf"),), counts):
+            cumulative += count
+            lines.append("%s_bucket%s %d" % (
+                self.name,
+                _labels(self.label_names, key, [("le", _number(bound))]),
+                cumulative))
+        labels = _labels(self.label_names, key)
+        lines.append("%s_sum%s %s" % (self.name, labels, repr(counts[-1])))
+        lines.append("%s_count%s %d" % (self.name, labels, cumulative))
+        return lines
+
+
+class Registry(object):
+    '''
+    Metrics to expose. Collectors are called before rendering to update
+    the metrics that reflect the current state rather than counting.
+    '''
+
+    def __init__(self):
+        self._metrics = []
+        self._collectors = []
+
+    def register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def add_collector(self, collector):
+        self._collectors.append(collector)
+
+    def render(self):
+        for collector in self._collectors:
+            collector()
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+REQUEST_SECONDS = REGISTRY.register(Histogram(
+    "blockade_http_request_duration_seconds",
+    "Time taken to answer REST requests",
+    labels=("route", "method", "status")))
+OPERATION_SECONDS = REGISTRY.register(Histogram(
+    "blockade_operation_duration_seconds",
+    "Time taken by blockade operations like partition or slow",
+    labels=("operation",)))
+DOCKER_SECONDS = REGISTRY.register(Histogram(
+    "blockade_docker_call_duration_seconds",
+    "Time taken by Docker API calls",
+    labels=("call",)))
+HOST_SECONDS = REGISTRY.register(Histogram(
+    "blockade_host_command_duration_seconds",
+    "Time taken by host commands",
+    labels=("tool",)))
+AUDIT_SECONDS = REGISTRY.register(Histogram(
+    "blockade_audit_write_duration_seconds",
+    "Time taken to write a batch of audit events"))
+CHAOS_STATE = REGISTRY.register(Gauge(
+    "blockade_chaos_state",
+    "State of the chaos on a blockade, 1 for the current state",
+    labels=("blockade", "state")))
+CHAOS_DEGRADED_SECONDS = REGISTRY.register(Gauge(
+    "blockade_chaos_degraded_seconds",
+    "Total time chaos kept a blockade degraded",
+    labels=("blockade",)))
+CONTAINERS = REGISTRY.register(Gauge(
+    "blockade_containers",
+    "Number of containers in a blockade",
+    labels=("blockade",)))
+
+
+def _observe_span(span):
+    if span.kind == "operation":
+        OPERATION_SECONDS.observe(span.duration, operation=span.name)
+    elif span.name == timing.DOCKER:
+        DOCKER_SECONDS.observe(span.duration,
+                               call=span.tags.get('call', 'unknown'))
+    elif span.name == timing.HOST:
+        HOST_SECONDS.observe(span.duration,
+                             tool=span.tags.get('tool', 'unknown'))
+    elif span.name == timing.AUDIT:
+        AUDIT_SECONDS.observe(span.duration)
+
+
+_installed = False
+
+
+def install():
+    '''Start collecting the latencies from the timing spans'''
+    global _installed
+    if not _installed:
+        timing.add_listener(_observe_span)
+        _installed = True
@@ -13,16 +13,28 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 #
+import json
+import os
 import signal
 import sys
+import time
 import traceback
+import uuid
+import zlib
 
-from flask import Flask, abort, jsonify, request, Response
+import gevent
+import six
+from flask import Flask, abort, g, jsonify, request, Response, send_file
 from gevent.pywsgi import WSGIServer
 
+from blockade import audit
 from blockade import chaos
 from blockade import errors
+from blockade import timing
+from blockade.api import metrics
+from blockade.api.jobs import JobRunner
 from blockade.api.manager import BlockadeManager
+from blockade.api.manager import LazyBlockade
 from blockade.config import BlockadeConfig
 from blockade.errors import DockerContainerNotFound
 from blockade.errors import InvalidBlockadeName
@@ -30,6 +42,34 @@ from blockade.errors import InvalidBlockadeName
 
 app = Flask(__name__)
 
+# how often event streams look for new events and send a keep-alive comment
+SSE_POLL_INTERVAL = 0.2
+SSE_KEEPALIVE_INTERVAL = 15
+
+# number of threads running the blocking Docker and host calls of requests
+DAEMON_THREADS_ENV = "BLOCKADE_DAEMON_THREADS"
+DEFAULT_DAEMON_THREADS = 32
+
+# the servers the API can be run on, the asyncio one needs Python 3
+GEVENT_SERVER = "gevent"
+ASYNCIO_SERVER = "asyncio"
+SERVERS = (GEVENT_SERVER, ASYNCIO_SERVER)
+
+# blocking work of requests goes to the thread pool of the gevent hub,
+# unless the server runs every request on a thread of its own anyway
+_offload_to_hub = True
+
+# directory below the data dir keeping the traces of requests with ?trace=1,
+# only the newest MAX_TRACES of them are kept
+TRACE_DIR = "traces"
+MAX_TRACES = 100
+
+# large responses are sent in pieces of about this size, and compressed for
+# clients accepting gzip once their body reaches GZIP_MIN_SIZE
+STREAM_CHUNK_SIZE = 64 * 1024
+GZIP_MIN_SIZE = 1024
+GZIP_LEVEL = 6
+
 
 def stack_trace_handler(signum, frame):
     code = []
@@ -45,15 +85,45 @@ def stack_trace_handler(signum, frame):
     app.logger.warn("\n".join(code))
 
 
-def start(data_dir='/tmp', port=5000, debug=False, host_exec=None):
+def _asyncio_server(port, threads):
+    try:
+        from blockade.api.aio import AsyncServer
+    except (ImportError, SyntaxError):
+        raise errors.BlockadeUsageError(
+            "The asyncio server needs Python 3.5 or later")
+    return AsyncServer(app, port=port, workers=threads)
+
+
+def start(data_dir='/tmp', port=5000, debug=False, host_exec=None,
+          server=GEVENT_SERVER, threads=None):
+    global _offload_to_hub
+    threads = threads or int(
+        os.environ.get(DAEMON_THREADS_ENV, DEFAULT_DAEMON_THREADS))
+    if server == ASYNCIO_SERVER:
+        http_server = _asyncio_server(port, threads)
+        _offload_to_hub = False
+    elif server == GEVENT_SERVER:
+        gevent.get_hub().threadpool.maxsize = threads
+        http_server = WSGIServer(('', port), app)
+    else:
+        raise errors.BlockadeUsageError("Unknown server %s" % server)
+
     signal.signal(signal.SIGUSR2, stack_trace_handler)
 
+    # only the daemon collects metrics, not every command importing this
+    metrics.install()
     BlockadeManager.set_data_dir(data_dir)
     if host_exec:
         BlockadeManager.set_host_exec(host_exec)
+    restore()
+    BlockadeManager.watch_docker_events()
     app.debug = debug
-    http_server = WSGIServer(('', port), app)
-    http_server.serve_forever()
+    try:
+        http_server.serve_forever()
+    finally:
+        BlockadeManager.stop_watching_docker_events()
+        _jobs.close()
+        audit.close_all()
 
 
 ############## ERROR HANDLERS ##############
@@ -79,9 +149,219 @@ def docker_container_not_found(error):
     return 'Docker container not found', 400
 
 
+################### METRICS ###################
+
+
+@app.before_request
+def start_request_timer():
+    g.request_started = time.time()
+    if _bool_arg(request.args, 'trace'):
+        # kept in the request rather than the thread, which is shared by all
+        # requests, and carried into the thread pool by _offload
+        g.trace = timing.Trace()
+
+
+@app.after_request
+def observe_request(response):
+    started = getattr(g, 'request_started', None)
+    if started is not None:
+        route = request.url_rule.rule if request.url_rule else "unmatched"
+        metrics.REQUEST_SECONDS.observe(time.time() - started,
+                                        route=route,
+                                        method=request.method,
+                                        status=response.status_code)
+    trace = getattr(g, 'trace', None)
+    if trace is not None:
+        trace.record("trace", "%s %s" % (request.method, request.path),
+                     started, status=response.status_code)
+        response.headers['X-Blockade-Trace'] = '/traces/%s' % _save_trace(
+            trace)
+    return response
+
+
+def _trace_dir():
+    return os.path.join(BlockadeManager.get_data_dir(), TRACE_DIR)
+
+
+def _save_trace(trace):
+    trace_dir = _trace_dir()
+    if not os.path.isdir(trace_dir):
+        os.makedirs(trace_dir)
+    trace_id = uuid.uuid4().hex
+    trace.write(os.path.join(trace_dir, trace_id + ".json"))
+    _prune_traces(trace_dir)
+    return trace_id
+
+
+def _prune_traces(trace_dir):
+    """Remove the oldest traces beyond MAX_TRACES"""
+    traces = []
+    for name in os.listdir(trace_dir):
+        path = os.path.join(trace_dir, name)
+        try:
+            traces.append((os.path.getmtime(path), path))
+        except OSError:
+            # removed by a request pruning at the same time
+            pass
+    traces.sort()
+    for _, path in traces[:-MAX_TRACES]:
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+
+@app.after_request
+def compress_response(response):
+    if (response.status_code in (204, 304) or response.direct_passthrough or
+            'Content-Encoding' in response.headers or
+            # events are sent as they come, not once enough are compressed
+            response.mimetype == 'text/event-stream'):
+        return response
+    response.vary.add('Accept-Encoding')
+    if not request.accept_encodings['gzip']:
+        return response
+
+    if response.is_streamed:
+        response.response = _gzip_stream(response.response)
+        response.headers.pop('Content-Length', None)
+    else:
+        data = response.get_data()
+        if len(data) < GZIP_MIN_SIZE:
+            return response
+        compressor = _gzip_compressor()
+        response.set_data(compressor.compress(data) + compressor.flush())
+    response.headers['Content-Encoding'] = 'gzip'
+    return response
+
+
+def _gzip_compressor():
+    return zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+
+
+def _gzip_stream(chunks):
+    compressor = _gzip_compressor()
+    for chunk in chunks:
+        if isinstance(chunk, six.text_type):
+            chunk = chunk.encode('utf-8')
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+def _buffered(pieces, size=STREAM_CHUNK_SIZE):
+    '''Join small pieces of a response into chunks of about the given size'''
+    buf = []
+    length = 0
+    for piece in pieces:
+        buf.append(piece)
+        length += len(piece)
+        if length >= size:
+            yield ''.join(buf)
+            buf = []
+            length = 0
+    if buf:
+        yield ''.join(buf)
+
+
+def _json_stream(head, items, tail):
+    '''
+    Stream a JSON document made of head, the given JSON encoded items
+    separated by commas, and tail, without holding all of it in memory
+    '''
+    def generate():
+        yield head
+        delim = ''
+        for item in items:
+            yield delim
+            yield item.strip()
+            delim = ','
+        yield tail
+    return Response(_buffered(generate()), mimetype='application/json')
+
+
+@app.route("/traces/<trace_id>")
+def get_trace(trace_id):
+    path = os.path.join(_trace_dir(), trace_id + ".json")
+    if not trace_id.isalnum() or not os.path.isfile(path):
+        return 'Trace not found', 404
+    return send_file(path, mimetype='application/json')
+
+
+def collect_blockade_metrics():
+    chaos_states = []
+    degraded = []
+    for name in _chaos.names():
+        try:
+            state = _chaos.status(name)['state']
+            seconds = _chaos.degraded_seconds(name)
+        except errors.BlockadeUsageError:
+            continue  # deleted meanwhile
+        chaos_states.append(({'blockade': name, 'state': state}, 1))
+        degraded.append(({'blockade': name}, seconds))
+    metrics.CHAOS_STATE.set_all(chaos_states)
+    metrics.CHAOS_DEGRADED_SECONDS.set_all(degraded)
+    metrics.CONTAINERS.set_all(
+        ({'blockade': name}, count)
+        for name, count in BlockadeManager.container_counts().items())
+
+
+metrics.REGISTRY.add_collector(collect_blockade_metrics)
+
+
+@app.route("/metrics")
+def get_metrics():
+    return Response(metrics.REGISTRY.render(),
+                    content_type=metrics.CONTENT_TYPE)
+
+
 ################### ROUTES ###################
 
 
+def _offload(func, *args):
+    '''
+    Run a blocking function on the thread pool of the hub so that other
+    requests are served meanwhile, and blockades are worked on in parallel
+    '''
+    ctx = (None, getattr(g, 'trace', None))
+
+    def call():
+        try:
+            with timing.attached(ctx):
+                return func(*args), None
+        except Exception:
+            # reraised in the request instead of being reported by the hub
+            return None, sys.exc_info()
+
+    if _offload_to_hub:
+        result, exc_info = gevent.get_hub().threadpool.apply(call)
+    else:
+        result, exc_info = call()
+    if exc_info is not None:
+        six.reraise(*exc_info)
+    return result
+
+
+def _locked(name, func, write=True):
+    '''
+    Call func with the blockade while holding its write lock, or its read
+    lock for looking only. The request context is not available in func.
+    '''
+    def locked():
+        if write:
+            lock = BlockadeManager.write_lock(name)
+        else:
+            lock = BlockadeManager.read_lock(name)
+        with lock:
+            return func(BlockadeManager.get_blockade(name))
+    return locked
+
+
+def _with_blockade(name, func, write=True):
+    return _offload(_locked(name, func, write))
+
+
 @app.route("/blockade")
 def list_all():
     blockades = BlockadeManager.get_all_blockade_names()
@@ -99,10 +379,14 @@ def create(name):
     # This will abort with a 400 if the JSON is bad
     data = request.get_json()
     config = BlockadeConfig.from_dict(data)
-    BlockadeManager.store_config(name, config)
+    BlockadeManager.store_config(name, config, data)
 
-    b = BlockadeManager.get_blockade(name)
-    containers = b.create()
+    if _bool_arg(request.args, 'async'):
+        def create_job(job):
+            _locked(name, lambda b: b.create(progress=job.progress))()
+        return _accepted(_jobs.submit(name, 'create', create_job))
+
+    _with_blockade(name, lambda b: b.create())
 
     return '', 204
 
@@ -117,8 +401,7 @@ def add(name):
 
     data = request.get_json()
     containers = data.get('containers')
-    b = BlockadeManager.get_blockade(name)
-    b.add_container(containers)
+    _with_blockade(name, lambda b: b.add_container(containers))
 
     return '', 204
 
@@ -143,12 +426,11 @@ def action(name):
     if container_names is None:
         return "'container_names' not found in body", 400
 
-    b = BlockadeManager.get_blockade(name)
+    kwargs = {}
     if 'kill' == command:
-        signal = request.args.get('signal', 'SIGKILL')
-        getattr(b, command)(container_names, signal=signal)
-    else:
-        getattr(b, command)(container_names)
+        kwargs['signal'] = request.args.get('signal', 'SIGKILL')
+    _with_blockade(
+        name, lambda b: getattr(b, command)(container_names, **kwargs))
 
     return '', 204
 
@@ -161,20 +443,22 @@ def partitions(name):
     if not BlockadeManager.blockade_exists(name):
         abort(404)
 
-    b = BlockadeManager.get_blockade(name)
-
     if request.args.get('random', False):
-        b.random_partition()
+        _with_blockade(name, lambda b: b.random_partition())
         return '', 204
 
     data = request.get_json()
     partitions = data.get('partitions')
-    if partitions is None:
-        return "'partitions' not found in body", 400
-    for partition in partitions:
+    edges = data.get('edges')
+    if partitions is None and edges is None:
+        return "'partitions' or 'edges' not found in body", 400
+    for partition in partitions or []:
         if not isinstance(partition, list):
             return "'partitions' must be a list of lists", 400
-    b.partition(partitions)
+    for edge in edges or []:
+        if not (isinstance(edge, list) and len(edge) == 2):
+            return "'edges' must be a list of [source, destination] lists", 400
+    _with_blockade(name, lambda b: b.partition(partitions or [], edges=edges))
 
     return '', 204
 
@@ -184,8 +468,7 @@ def delete_partitions(name):
     if not BlockadeManager.blockade_exists(name):
         abort(404)
 
-    b = BlockadeManager.get_blockade(name)
-    b.join()
+    _with_blockade(name, lambda b: b.join())
     return '', 204
 
 
@@ -197,7 +480,7 @@ def network_state(name):
     if not BlockadeManager.blockade_exists(name):
         abort(404)
 
-    network_states = ['flaky', 'slow', 'fast', 'duplicate']
+    network_states = ['flaky', 'slow', 'fast', 'duplicate', 'throttle']
     data = request.get_json()
     network_state = data.get('network_state')
     container_names = data.get('container_names')
@@ -209,8 +492,58 @@ def network_state(name):
     if container_names is None:
         return "'container_names' not found in body", 400
 
-    b = BlockadeManager.get_blockade(name)
-    getattr(b, network_state)(container_names)
+    _with_blockade(name,
+                   lambda b: getattr(b, network_state)(container_names))
+
+    return '', 204
+
+
+@app.route("/blockade/<name>/batch", methods=['POST'])
+def batch(name):
+    if not request.headers['Content-Type'] == 'application/json':
+        abort(415)
+
+    if not BlockadeManager.blockade_exists(name):
+        abort(404)
+
+    data = request.get_json()
+    steps = data.get('steps')
+    if steps is None:
+        return "'steps' not found in body", 400
+    if not isinstance(steps, list):
+        return "'steps' must be a list", 400
+
+    try:
+        outcomes = _with_blockade(name, lambda b: b.batch(steps))
+    except errors.BlockadeUsageError as err:
+        return str(err), 400
+
+    # a failed step is an outcome of the batch, not a failure of the daemon
+    return jsonify(steps=outcomes)
+
+
+@app.route("/blockade/<name>/links", methods=['POST'])
+def links(name):
+    if not request.headers['Content-Type'] == 'application/json':
+        abort(415)
+
+    if not BlockadeManager.blockade_exists(name):
+        abort(404)
+
+    data = request.get_json()
+    links = data.get('links')
+    if links is None:
+        return "'links' not found in body", 400
+    if not isinstance(links, dict):
+        return "'links' must be a map of container names", 400
+    for destinations in links.values():
+        if not isinstance(destinations, dict):
+            return "'links' must map containers to maps of impairments", 400
+
+    try:
+        _with_blockade(name, lambda b: b.impair_links(links))
+    except errors.BlockadeUsageError as err:
+        return str(err), 400
 
     return '', 204
 
@@ -220,12 +553,57 @@ def status(name):
     if not BlockadeManager.blockade_exists(name):
         abort(404, "The blockade %s does not exist" % name)
 
-    containers = {}
-    b = BlockadeManager.get_blockade(name)
-    for container in b.status():
-        containers[container.name] = container.to_dict()
-
-    return jsonify(containers=containers)
+    # unchanged since the client got it, so no need to look at the containers
+    version = BlockadeManager.status_version(name)
+    if version is not None and request.if_none_match.contains_weak(version):
+        response = Response(status=304)
+        response.set_etag(version, weak=True)
+        response.vary.add('Accept-Encoding')
+        return response
+
+    def get_status(b):
+        # versions only change with the write lock, which is not held now
+        return BlockadeManager.status_version(name), b.status()
+
+    version, status = _with_blockade(name, get_status, write=False)
+    containers = ('%s: %s' % (json.dumps(container.name),
+                              json.dumps(container.to_dict()))
+                  for container in status)
+
+    response = _json_stream('{"containers": {', containers, '}}')
+    if version is not None:
+        # weak, since the gzip and identity encodings of the body differ
+        response.set_etag(version, weak=True)
+    return response
+
+
+def _event_filters(args):
+    since = args.get('since')
+    until = args.get('until')
+    limit = _count_arg(args, 'limit')
+    last = _count_arg(args, 'tail')
+    return dict(
+        since=audit.parse_time(since) if since else None,
+        until=audit.parse_time(until) if until else None,
+        events=_split_args(args.getlist('event')),
+        containers=_split_args(args.getlist('container')),
+        limit=limit,
+        last=last)
+
+
+def _count_arg(args, name):
+    value = args.get(name)
+    if value is None:
+        return None
+    value = int(value)
+    if value < 0:
+        raise ValueError("%s must not be negative" % name)
+    return value
+
+
+def _split_args(values):
+    names = [name.strip() for value in values for name in value.split(",")]
+    return [name for name in names if name] or None
 
 
 @app.route("/blockade/<name>/events")
@@ -233,15 +611,55 @@ def get_events(name):
     if not BlockadeManager.blockade_exists(name):
         abort(404, "The blockade %s does not exist" % name)
 
+    try:
+        filters = _event_filters(request.args)
+    except (errors.BlockadeUsageError, ValueError) as err:
+        return str(err), 400
+
     b = BlockadeManager.get_blockade(name)
+    if _bool_arg(request.args, 'follow'):
+        return _follow_events(b.get_audit(), filters)
+    logs = b.get_audit().query(as_json=False, **filters)
+    return _json_stream('{"events": [', logs, ']}')
 
-    def generate():
-        yield '{"events": ['
-        for a in b.get_audit().read_logs(as_json=False):
-            yield a
-        yield ']}'
 
-    return Response(generate(), mimetype='application/json')
+def _follow_events(auditor, filters):
+    """Stream the events logged from now on as Server-Sent Events
+
+    The stream starts with the events selected by the usual filters if a
+    tail was requested. Live events only go through the event and container
+    filters. The stream ends when the server stops.
+    """
+    stopping = request.environ.get('blockade.stopping')
+    on_loop = request.environ.get('blockade.stream_on_loop', False)
+
+    def generate():
+        # subscribe before reading the tail so no event falls in between
+        with auditor.subscribe(events=filters['events'],
+                               containers=filters['containers']) as sub:
+            if filters['last'] is not None:
+                for line in auditor.query(as_json=False, **filters):
+                    yield "data: %s\n\n" % line.strip()
+            last_sent = time.time()
+            while stopping is None or not stopping.is_set():
+                records = sub.poll()
+                for record in records:
+                    yield "data: %s\n\n" % json.dumps(record)
+                if records:
+                    last_sent = time.time()
+                elif time.time() - last_sent >= SSE_KEEPALIVE_INTERVAL:
+                    yield ": keep-alive\n\n"
+                    last_sent = time.time()
+                elif on_loop:
+                    # the asyncio server waits for them without a thread
+                    yield ""
+                else:
+                    # events are logged from other threads, cooperatively
+                    # wait for them instead of blocking the server
+                    gevent.sleep(SSE_POLL_INTERVAL)
+
+    return Response(generate(), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache'})
 
 
 @app.route("/blockade/<name>", methods=['DELETE'])
@@ -249,18 +667,51 @@ def destroy(name):
     if not BlockadeManager.blockade_exists(name):
         abort(404)
 
+    if _bool_arg(request.args, 'async'):
+        def destroy_job(job):
+            _destroy(name, progress=job.progress)
+        return _accepted(_jobs.submit(name, 'destroy', destroy_job))
+
+    _offload(_destroy, name)
+
+    return '', 204
+
+
+def _destroy(name, progress=None):
+    # chaos takes the blockade lock itself, so stop it before taking it
     if _chaos.exists(name):
         try:
             _chaos.delete(name)
         except errors.BlockadeUsageError as bue:
             app.logger.error(bue)
 
-    b = BlockadeManager.get_blockade(name)
-    b.destroy()
-    b.get_audit().clean()
-    BlockadeManager.delete_config(name)
+    with BlockadeManager.write_lock(name):
+        b = BlockadeManager.get_blockade(name)
+        b.destroy(progress=progress)
+        b.get_audit().clean()
+        BlockadeManager.delete_config(name)
 
-    return '', 204
+
+def _bool_arg(args, name):
+    return args.get(name) in ('1', 'true', 'yes')
+
+
+def _accepted(job):
+    response = jsonify(job.to_dict())
+    response.status_code = 202
+    response.headers['Location'] = '/jobs/%s' % job.id
+    return response
+
+
+@app.route("/jobs/<job_id>")
+def get_job(job_id):
+    job = _jobs.get(job_id)
+    if job is None:
+        return 'Job not found', 404
+    return jsonify(job.to_dict())
+
+
+_jobs = JobRunner()
 
 
 _chaos = chaos.Chaos()
@@ -278,6 +729,34 @@ def _validate_chaos_input(option):
             raise errors.BlockadeHttpError(400, "%s is not a valid input")
 
 
+def _new_chaos(name, options, state=None):
+    return _chaos.new_chaos(
+        LazyBlockade(name), name,
+        blockade_lock=lambda: BlockadeManager.write_lock(name),
+        state=state,
+        state_listener=lambda s: BlockadeManager.store_chaos_state(name, s),
+        **options)
+
+
+def restore():
+    '''
+    Pick up the blockades and chaos of a previous run of the daemon. Chaos
+    carries on in the state it was left in, so the containers it degraded
+    are relieved in due time. Docker is only talked to once chaos acts.
+    '''
+    BlockadeManager.load_configs()
+    for name, options, state in BlockadeManager.load_all_chaos():
+        if _chaos.exists(name):
+            continue
+        try:
+            _new_chaos(name, options, state)
+        except errors.BlockadeUsageError as bue:
+            app.logger.error("Failed to restore chaos on %s: %s", name, bue)
+        else:
+            app.logger.info("Restored chaos on %s in state %s", name,
+                            state or chaos.ChaosStates.NEW)
+
+
 @app.route("/blockade/<name>/chaos", methods=['POST'])
 def chaos_new(name):
     if not BlockadeManager.blockade_exists(name):
@@ -287,7 +766,8 @@ def chaos_new(name):
     options = request.get_json()
     _validate_chaos_input(options)
     try:
-        _chaos.new_chaos(BlockadeManager.get_blockade(name), name, **options)
+        _new_chaos(name, options)
+        BlockadeManager.store_chaos(name, options)
         return "Successfully started chaos on %s" % name, 201
     except errors.BlockadeUsageError as bue:
         app.logger.error(str(bue))
@@ -302,6 +782,9 @@ def chaos_update(name):
     _validate_chaos_input(options)
     try:
         _chaos.update_options(name, **options)
+        stored_options = BlockadeManager.load_chaos(name) or {}
+        stored_options.update(options)
+        BlockadeManager.store_chaos(name, stored_options)
         return "Updated chaos on %s" % name, 200
     except errors.BlockadeUsageError as bue:
         app.logger.error(str(bue))
@@ -315,6 +798,7 @@ def chaos_destroy(name):
     try:
         _chaos.stop(name)
         _chaos.delete(name)
+        BlockadeManager.delete_chaos(name)
         return "Deleted chaos on %s" % name, 200
     except errors.BlockadeUsageError as bue:
         app.logger.error(str(bue))
@@ -0,0 +1,288 @@
+#
+#  Copyright (C) 2016 Dell, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+from contextlib import contextmanager
+from copy import deepcopy
+
+import json
+import sqlite3
+import threading
+
+from blockade.errors import AlreadyInitializedError
+from blockade.errors import InconsistentStateError
+from blockade.errors import NotInitializedError
+from blockade.state import BlockadeState
+
+
+SCHEMA_VERSION = 3
+
+_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS blockades (
+    name TEXT PRIMARY KEY,
+    config TEXT NOT NULL,
+    containers TEXT,
+    revision INTEGER NOT NULL DEFAULT 0
+);
+CREATE TABLE IF NOT EXISTS chaos (
+    name TEXT PRIMARY KEY
+        REFERENCES blockades (name) ON DELETE CASCADE,
+    options TEXT NOT NULL,
+    state TEXT
+);
+CREATE TABLE IF NOT EXISTS containers (
+    id TEXT NOT NULL,
+    name TEXT NOT NULL
+        REFERENCES blockades (name) ON DELETE CASCADE,
+    PRIMARY KEY (id, name)
+);
+'''
+
+
+def _index_containers(db):
+    for name, containers in db.execute(
+            "SELECT name, containers FROM blockades "
+            "WHERE containers IS NOT NULL").fetchall():
+        _put_container_ids(db, name, json.loads(containers))
+
+
+def _put_container_ids(db, name, containers):
+    db.execute("DELETE FROM containers WHERE name = ?", (name,))
+    db.executemany("INSERT OR IGNORE INTO containers (id, name) VALUES (?, ?)",
+                   [(c['id'], name) for c in containers.values()
+                    if c.get('id')])
+
+
+# changes to the tables of older schema versions, in order, either SQL or a
+# function of the database
+_MIGRATIONS = {
+    2: "ALTER TABLE chaos ADD COLUMN state TEXT",
+    3: _index_containers,
+}
+
+
+class BlockadeStore(object):
+    '''
+    SQLite database holding the configuration, container state and chaos
+    options of all blockades managed by the daemon, keyed by blockade name.
+    '''
+
+    def __init__(self, path):
+        self._path = path
+        self._lock = threading.RLock()
+        self._db = sqlite3.connect(path, check_same_thread=False,
+                                   isolation_level=None)
+        with self._lock:
+            # a write ahead log lets readers go on while a write is going on
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute("PRAGMA synchronous=NORMAL")
+            self._db.execute("PRAGMA foreign_keys=ON")
+            version = self._db.execute("PRAGMA user_version").fetchone()[0]
+            if version == 0:
+                # new, or older than the user_version
+                tables = self._db.execute(
+                    "SELECT 1 FROM sqlite_master WHERE name = 'blockades'")
+                version = 1 if tables.fetchone() else SCHEMA_VERSION
+            self._db.executescript(_SCHEMA)
+            for migration in range(version + 1, SCHEMA_VERSION + 1):
+                migration = _MIGRATIONS[migration]
+                if callable(migration):
+                    migration(self._db)
+                else:
+                    self._db.execute(migration)
+            self._db.execute("PRAGMA user_version=%d" % SCHEMA_VERSION)
+
+    @property
+    def path(self):
+        return self._path
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+    def _query(self, sql, *args):
+        with self._lock:
+            return self._db.execute(sql, args).fetchall()
+
+    def _query_one(self, sql, *args):
+        rows = self._query(sql, *args)
+        return rows[0] if rows else None
+
+    def _update(self, sql, *args):
+        with self._lock:
+            return self._db.execute(sql, args).rowcount
+
+    @contextmanager
+    def _transaction(self):
+        with self._lock:
+            self._db.execute("BEGIN")
+            try:
+                yield
+            except BaseException:
+                self._db.execute("ROLLBACK")
+                raise
+            self._db.execute("COMMIT")
+
+    def exists(self, name):
+        return self._query_one(
+            "SELECT 1 FROM blockades WHERE name = ?", name) is not None
+
+    def names(self):
+        return [row[0] for row in
+                self._query("SELECT name FROM blockades ORDER BY name")]
+
+    def get_config(self, name):
+        '''Get the configuration dictionary of a blockade or None'''
+        row = self._query_one(
+            "SELECT config FROM blockades WHERE name = ?", name)
+        return json.loads(row[0]) if row else None
+
+    def put_config(self, name, config):
+        '''Store the configuration dictionary of a new blockade'''
+        with self._lock:
+            if self.exists(name):
+                raise AlreadyInitializedError(
+                    "Blockade %s already exists" % name)
+            self._update("INSERT INTO blockades (name, config) VALUES (?, ?)",
+                         name, json.dumps(config))
+
+    def delete(self, name):
+        '''Remove a blockade including its state and chaos options'''
+        self._update("DELETE FROM blockades WHERE name = ?", name)
+
+    def get_revision(self, name):
+        '''
+        Get the revision of the container state of a blockade which changes
+        with every update, or None if the state was not initialized.
+        '''
+        row = self._query_one(
+            "SELECT revision, containers IS NOT NULL FROM blockades "
+            "WHERE name = ?", name)
+        if row is None or not row[1]:
+            return None
+        return row[0]
+
+    def get_containers(self, name):
+        '''Get the container state of a blockade and its revision'''
+        row = self._query_one(
+            "SELECT containers, revision FROM blockades WHERE name = ?", name)
+        if row is None or row[0] is None:
+            return None, None
+        return json.loads(row[0]), row[1]
+
+    def put_containers(self, name, containers, initialize=False):
+        '''Store the container state of a blockade and return its revision'''
+        sql = ("UPDATE blockades SET containers = ?, revision = revision + 1 "
+               "WHERE name = ?")
+        if initialize:
+            sql += " AND containers IS NULL"
+        with self._transaction():
+            if not self._update(sql, json.dumps(containers), name):
+                if not self.exists(name):
+                    raise InconsistentStateError(
+                        "Blockade %s is not stored" % name)
+                raise AlreadyInitializedError(
+                    "Blockade %s is already initialized" % name)
+            _put_container_ids(self._db, name, containers)
+            return self.get_revision(name)
+
+    def delete_containers(self, name):
+        with self._transaction():
+            self._update("UPDATE blockades SET containers = NULL, "
+                         "revision = revision + 1 WHERE name = ?", name)
+            _put_container_ids(self._db, name, {})
+
+    def names_with_container(self, container_id):
+        '''Get the names of the blockades a Docker container belongs to'''
+        return [row[0] for row in self._query(
+            "SELECT name FROM containers WHERE id = ? ORDER BY name",
+            container_id)]
+
+    def get_chaos(self, name):
+        '''Get the chaos options of a blockade or None'''
+        row = self._query_one("SELECT options FROM chaos WHERE name = ?", name)
+        return json.loads(row[0]) if row else None
+
+    def put_chaos(self, name, options):
+        '''Store the chaos options of a blockade, keeping the chaos state'''
+        options = json.dumps(options)
+        with self._lock:
+            if not self._update("UPDATE chaos SET options = ? WHERE name = ?",
+                                options, name):
+                self._update("INSERT INTO chaos (name, options) "
+                             "VALUES (?, ?)", name, options)
+
+    def put_chaos_state(self, name, state):
+        '''Record the state chaos on a blockade is in, if it is stored'''
+        self._update("UPDATE chaos SET state = ? WHERE name = ?", state, name)
+
+    def all_chaos(self):
+        '''Get the name, chaos options and chaos state of every blockade
+        with chaos'''
+        return [(name, json.loads(options), state) for name, options, state in
+                self._query("SELECT name, options, state FROM chaos "
+                            "ORDER BY name")]
+
+    def configs(self):
+        '''Get the configuration dictionaries of all blockades by name'''
+        return dict((name, json.loads(config)) for name, config in
+                    self._query("SELECT name, config FROM blockades"))
+
+    def delete_chaos(self, name):
+        self._update("DELETE FROM chaos WHERE name = ?", name)
+
+
+class StoreState(BlockadeState):
+    '''BlockadeState keeping its container information in a BlockadeStore'''
+
+    def __init__(self, store, blockade_id, data_dir=None):
+        super(StoreState, self).__init__(blockade_id=blockade_id,
+                                         data_dir=data_dir)
+        self._store = store
+        self._revision = None
+
+    def initialize(self, containers):
+        self._containers = deepcopy(containers)
+        self._revision = self._store.put_containers(
+            self._blockade_id, containers, initialize=True)
+
+    def exists(self):
+        return self._store.get_revision(self._blockade_id) is not None
+
+    def update(self, containers):
+        self._containers = deepcopy(containers)
+        self._revision = self._store.put_containers(self._blockade_id,
+                                                    containers)
+
+    def load(self):
+        '''
+        Load the container information from the store. Nothing is parsed
+        as long as the state was not updated since the last load.
+        '''
+        revision = self._store.get_revision(self._blockade_id)
+        if revision is None:
+            raise NotInitializedError("No blockade exists in this context")
+        if revision == self._revision:
+            return
+        containers, revision = self._store.get_containers(self._blockade_id)
+        if containers is None:
+            raise NotInitializedError("No blockade exists in this context")
+        self._containers = containers
+        self._revision = revision
+
+    def destroy(self):
+        self._revision = None
+        self._store.delete_containers(self._blockade_id)
+        self._state_delete()
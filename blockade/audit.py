@@ -1,27 +1,912 @@
+import atexit
+import bisect
+import collections
+import gzip
+import io
+import itertools
 import json
 import logging
+import mmap
 import os
+import re
+import shutil
+import threading
 import time
 
+from six.moves import queue
+
+try:
+    import fcntl
+except ImportError:
+    # no advisory locks on this platform
+    fcntl = None
+
 from blockade import errors
+from blockade import timing
 
 
 _logger = logging.getLogger(__file__)
 
+AUDIT_FSYNC_ENV = "BLOCKADE_AUDIT_FSYNC"
+
+# events are buffered and written in batches, nothing is fsynced
+FSYNC_NEVER = "never"
+# every batch written is fsynced
+FSYNC_BATCH = "batch"
+# logging an event waits until it is written and fsynced
+FSYNC_ALWAYS = "always"
+
+FSYNC_POLICIES = (FSYNC_NEVER, FSYNC_BATCH, FSYNC_ALWAYS)
+
+DEFAULT_QUEUE_SIZE = 1024
+MAX_BATCH_SIZE = 256
+
+AUDIT_SEGMENT_BYTES_ENV = "BLOCKADE_AUDIT_SEGMENT_BYTES"
+AUDIT_SEGMENT_SECONDS_ENV = "BLOCKADE_AUDIT_SEGMENT_SECONDS"
+AUDIT_RETAIN_SEGMENTS_ENV = "BLOCKADE_AUDIT_RETAIN_SEGMENTS"
+
+DEFAULT_SEGMENT_BYTES = 8 * 1024 * 1024
+DEFAULT_RETAIN_SEGMENTS = 16
+
+
+# When the active audit file reaches `max_bytes` or gets older than
+# `max_seconds` (if set), it is sealed into a gzip compressed segment. Only
+# the newest `retain` sealed segments are kept.
+SegmentPolicy = collections.namedtuple(
+    "SegmentPolicy", ["max_bytes", "max_seconds", "retain"])
+
+
+def _env_int(name, default):
+    value = os.environ.get(name)
+    if not value:
+        return default
+    try:
+        return int(value)
+    except ValueError:
+        raise errors.BlockadeError(
+                "%s must be an integer, not '%s'" % (name, value))
+
+
+def segment_policy_from_env():
+    return SegmentPolicy(
+        max_bytes=_env_int(AUDIT_SEGMENT_BYTES_ENV, DEFAULT_SEGMENT_BYTES),
+        max_seconds=_env_int(AUDIT_SEGMENT_SECONDS_ENV, None),
+        retain=_env_int(AUDIT_RETAIN_SEGMENTS_ENV, DEFAULT_RETAIN_SEGMENTS))
+
+
+def _segments(file_path):
+    """
+    Get the sealed segments of an audit file as a list of (sequence number,
+    path) sorted from the oldest to the newest. Segments are named after
+    the audit file with a sequence number and a .gz suffix once compressed.
+    """
+    directory, base = os.path.split(file_path)
+    pattern = re.compile(r"^%s\.(\d+)(\.gz)?$" % re.escape(base))
+    try:
+        names = os.listdir(directory)
+    except OSError:
+        return []
+    segments = {}
+    for name in names:
+        match = pattern.match(name)
+        if not match:
+            continue
+        seq = int(match.group(1))
+        # a segment that is being compressed exists in both forms
+        if seq not in segments or match.group(2):
+            segments[seq] = os.path.join(directory, name)
+    return sorted(segments.items())
+
+
+def _remove(path):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+
+def _lock_path(path):
+    """The lock file of an audit file, which outlives its rotations"""
+    return path + ".lock"
+
+
+class _FileLock(object):
+    """Advisory lock held by a process while it appends or rotates"""
+
+    def __init__(self, path):
+        self._path = path
+        self._fd = None
+
+    def __enter__(self):
+        if fcntl is not None:
+            if self._fd is None:
+                self._fd = os.open(self._path, os.O_RDWR | os.O_CREAT, 0o644)
+            fcntl.flock(self._fd, fcntl.LOCK_EX)
+        return self
+
+    def __exit__(self, *exc_info):
+        if self._fd is not None:
+            fcntl.flock(self._fd, fcntl.LOCK_UN)
+
+    def close(self):
+        if self._fd is not None:
+            fd, self._fd = self._fd, None
+            os.close(fd)
+
+
+_STOP = object()
+
+
+class _AuditWriter(object):
+    """Appends audit lines to a file from a background thread
+
+    The file is kept open and lines queued by `write` are written in
+    batches, so recording an event does not pay for opening, writing and
+    closing the file. The queue is bounded: once it is full, writers wait
+    for the background thread to catch up. Other processes may write to the
+    same file, so every batch and rotation is done under a file lock.
+    """
+
+    def __init__(self, file_path, fsync, queue_size, segment_policy):
+        self._file_path = file_path
+        self._fsync = fsync
+        self._queue_size = queue_size
+        self._segment_policy = segment_policy
+        # when the first record of the active file was written, and the
+        # (st_dev, st_ino) of the file this is known for
+        self._segment_started = None
+        self._segment_file = None
+        self._lock = threading.Lock()
+        self._thread = None
+        self._queue = None
+
+    def write(self, line):
+        lines = self._start()
+        if self._fsync == FSYNC_ALWAYS:
+            self._wait_for(lines, line)
+        else:
+            lines.put((line, None))
+
+    def flush(self):
+        """Wait until every line queued so far is written"""
+        with self._lock:
+            lines = self._queue
+        if lines is not None:
+            self._wait_for(lines, None)
+
+    def close(self):
+        """Write all queued lines and stop the background thread"""
+        with self._lock:
+            thread, lines = self._thread, self._queue
+            self._thread = self._queue = None
+        if thread is not None:
+            lines.put((_STOP, None))
+            thread.join()
+
+    def _wait_for(self, lines, line):
+        written = threading.Event()
+        lines.put((line, written))
+        written.wait()
+
+    def _start(self):
+        with self._lock:
+            if self._thread is None:
+                # every thread gets its own queue to drain until it stops
+                self._queue = queue.Queue(self._queue_size)
+                self._thread = threading.Thread(target=self._run,
+                                                args=(self._queue,),
+                                                name="blockade-audit")
+                self._thread.daemon = True
+                self._thread.start()
+            return self._queue
+
+    def _run(self, lines):
+        segment = None
+        file_lock = _FileLock(_lock_path(self._file_path))
+        try:
+            while True:
+                batch = [lines.get()]
+                try:
+                    while len(batch) < MAX_BATCH_SIZE:
+                        batch.append(lines.get_nowait())
+                except queue.Empty:
+                    pass
+                segment = self._write_batch(segment, batch, file_lock)
+                if any(record is _STOP for record, _ in batch):
+                    return
+        finally:
+            if segment is not None:
+                segment.close()
+            file_lock.close()
+
+    def _write_batch(self, segment, batch, file_lock):
+        records = [record for record, _ in batch
+                   if record is not None and record is not _STOP]
+        try:
+            if records:
+                with timing.phase(timing.AUDIT), file_lock:
+                    if segment is not None and not segment.is_current():
+                        # rotated by another process
+                        segment.close()
+                        segment = None
+                        self._segment_started = None
+                    segment = self._rotate_if_needed(segment)
+                    if segment is None:
+                        segment = self._open_segment()
+                    segment.write(records)
+                    if self._fsync != FSYNC_NEVER:
+                        segment.fsync()
+        except Exception as ex:
+            # swallow errors here and consider it a degradation of service
+            _logger.error("Failed to record %d audit lines %s"
+                          % (len(records), str(ex)))
+            if segment is not None:
+                segment.close()
+                segment = None
+        finally:
+            for _, written in batch:
+                if written is not None:
+                    written.set()
+        return segment
+
+    def _open_segment(self):
+        segment = _ActiveSegment(self._file_path)
+        self._segment_file = segment.file_id
+        if segment.size == 0:
+            self._segment_started = time.time()
+        else:
+            self._segment_started = _first_timestamp(self._file_path)
+        return segment
+
+    def _rotate_if_needed(self, segment):
+        """Seal the active segment if it got too large or too old"""
+        try:
+            stat = os.stat(self._file_path)
+        except OSError:
+            return None
+        if stat.st_size == 0:
+            return segment
+
+        policy = self._segment_policy
+        too_large = policy.max_bytes and stat.st_size >= policy.max_bytes
+        too_old = False
+        if policy.max_seconds:
+            file_id = (stat.st_dev, stat.st_ino)
+            if self._segment_started is None or self._segment_file != file_id:
+                # another process may have rotated it since we looked
+                self._segment_started = _first_timestamp(self._file_path)
+                self._segment_file = file_id
+            too_old = time.time() - self._segment_started >= policy.max_seconds
+        if not (too_large or too_old):
+            return segment
+
+        if segment is not None:
+            segment.close()
+        self._seal()
+        return None
+
+    def _seal(self):
+        segments = _segments(self._file_path)
+        seq = segments[-1][0] + 1 if segments else 1
+        sealed = "%s.%06d" % (self._file_path, seq)
+
+        # readers either see the active file or the renamed segment, whose
+        # index may briefly lag behind and is then rebuilt on the fly
+        os.rename(self._file_path, sealed)
+        try:
+            os.rename(_index_path(self._file_path), _index_path(sealed))
+        except OSError:
+            pass
+        with open(sealed, "rb") as src:
+            with gzip.open(sealed + ".gz.tmp", "wb") as dst:
+                shutil.copyfileobj(src, dst)
+        os.rename(sealed + ".gz.tmp", sealed + ".gz")
+        _remove(sealed)
+
+        retain = self._segment_policy.retain
+        if retain is not None:
+            segments = _segments(self._file_path)
+            for _, path in segments[:max(0, len(segments) - retain)]:
+                _remove(path)
+                _remove(_index_path(path))
+
+
+class _ActiveSegment(object):
+    """The open active audit file together with its index
+
+    For every record the index holds a line with its byte offset and length
+    in the audit file, its timestamp, event and the containers it targets.
+    Queries only read the index and then seek to the matching records.
+    Other processes append to the file as well, so it must only be written
+    under the file lock.
+    """
+
+    def __init__(self, file_path):
+        self._file_path = file_path
+        self._data = open(file_path, "ab")
+        try:
+            self._index = open(_index_path(file_path), "ab")
+            self._catch_up(file_path)
+        except Exception:
+            self.close()
+            raise
+
+    @property
+    def size(self):
+        return os.fstat(self._data.fileno()).st_size
+
+    @property
+    def file_id(self):
+        stat = os.fstat(self._data.fileno())
+        return stat.st_dev, stat.st_ino
+
+    def is_current(self):
+        """Whether the file is still the active one, i.e. not rotated"""
+        try:
+            stat = os.stat(self._file_path)
+        except OSError:
+            return False
+        return (stat.st_dev, stat.st_ino) == self.file_id
+
+    def write(self, records):
+        # appended at the end, wherever other processes left it
+        offset = self.size
+        lines = []
+        entries = []
+        for record in records:
+            line = (json.dumps(record) + os.linesep).encode("utf-8")
+            entries.append(_index_entry(offset, len(line), record))
+            lines.append(line)
+            offset += len(line)
+        self._data.write(b"".join(lines))
+        self._data.flush()
+        self._write_entries(entries)
+
+    def fsync(self):
+        os.fsync(self._data.fileno())
+        os.fsync(self._index.fileno())
+
+    def close(self):
+        for fptr in (self._data, getattr(self, "_index", None)):
+            if fptr is not None:
+                fptr.close()
+
+    def _write_entries(self, entries):
+        self._index.write("".join(json.dumps(entry) + "\n"
+                                  for entry in entries).encode("utf-8"))
+        self._index.flush()
+
+    def _catch_up(self, file_path):
+        """Index records that were written without updating the index"""
+        index = _load_index(file_path)
+        if not index.valid:
+            # the index file does not belong to this audit file
+            self._index.truncate(0)
+            self._write_entries(index.entries_from(0))
+        elif index.end > index.indexed_end:
+            self._write_entries(index.entries_from(index.indexed_end))
+
+
+def _index_path(path):
+    """The index belonging to an active or sealed audit file"""
+    if path.endswith(".gz"):
+        path = path[:-len(".gz")]
+    return path + ".idx"
+
+
+def _target_names(targets):
+    """Container names in the targets of an audit record"""
+    names = []
+    for target in targets:
+        if isinstance(target, list):
+            names.extend(target)
+        else:
+            # directed partition edges are recorded as source->destination
+            names.extend(str(target).split("->"))
+    return names
+
+
+def _index_entry(offset, length, record):
+    return [offset, length, record.get('timestamp', 0),
+            record.get('event'), _target_names(record.get('targets', []))]
+
+
+class _SegmentIndex(object):
+    """Index of the records of one audit file
+
+    Holds the position of every record together with postings lists of the
+    records per event and per container and the running maximum of their
+    timestamps, which allows to bisect by time even if concurrent loggers
+    appended their events slightly out of order.
+    """
+
+    def __init__(self):
+        self.offsets = []
+        self.lengths = []
+        self.timestamps = []
+        self.max_timestamps = []
+        self.min_timestamp = None
+        self.event_names = []
+        self.targets = []
+        self.events = {}
+        self.containers = {}
+        # end of the records covered by the index file and by this index
+        self.indexed_end = 0
+        self.end = 0
+        # whether the index file matches the audit file
+        self.valid = True
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def add(self, offset, length, timestamp, event, targets):
+        position = len(self.offsets)
+        self.offsets.append(offset)
+        self.lengths.append(length)
+        self.timestamps.append(timestamp)
+        if self.max_timestamps:
+            self.max_timestamps.append(max(self.max_timestamps[-1],
+                                           timestamp))
+        else:
+            self.max_timestamps.append(timestamp)
+        if self.min_timestamp is None or timestamp < self.min_timestamp:
+            self.min_timestamp = timestamp
+        self.event_names.append(event)
+        self.targets.append(targets)
+        self.events.setdefault(event, []).append(position)
+        for name in set(targets):
+            self.containers.setdefault(name, []).append(position)
+        self.end = offset + length
+
+    def copy(self):
+        index = _SegmentIndex()
+        for position in range(len(self)):
+            index.add(*self.entry(position))
+        index.indexed_end = self.indexed_end
+        index.valid = self.valid
+        return index
+
+    def entry(self, position):
+        return [self.offsets[position], self.lengths[position],
+                self.timestamps[position], self.event_names[position],
+                self.targets[position]]
+
+    def entries_from(self, offset):
+        start = bisect.bisect_left(self.offsets, offset)
+        return [self.entry(position) for position in range(start, len(self))]
+
+    def select(self, since=None, until=None, events=None, containers=None):
+        """
+        Get (offset, length, timestamp, event) of all matching records in
+        file order
+        """
+        if not self.offsets:
+            return []
+        if until is not None and self.min_timestamp > until:
+            return []
+        start = 0
+        if since is not None:
+            start = bisect.bisect_left(self.max_timestamps, since)
+
+        positions = None
+        for names, postings in ((events, self.events),
+                                (containers, self.containers)):
+            if not names:
+                continue
+            matching = set()
+            for name in names:
+                matching.update(postings.get(name, ()))
+            positions = matching if positions is None else positions & matching
+        if positions is None:
+            positions = range(start, len(self))
+        else:
+            positions = sorted(p for p in positions if p >= start)
+
+        selected = []
+        for position in positions:
+            timestamp = self.timestamps[position]
+            if since is not None and timestamp < since:
+                continue
+            if until is not None and timestamp > until:
+                continue
+            selected.append((self.offsets[position], self.lengths[position],
+                             timestamp, self.event_names[position]))
+        return selected
+
+
+def _open_binary(path):
+    if path.endswith(".gz"):
+        return gzip.open(path, "rb")
+    return open(path, "rb")
+
+
+def _scan_into(index, path, offset=0):
+    """Index the records of an audit file from the given offset on"""
+    with _open_binary(path) as fptr:
+        fptr.seek(offset)
+        for line in fptr:
+            if not line.endswith(b"\n"):
+                # a record that is still being written
+                break
+            try:
+                record = json.loads(line.decode("utf-8"))
+                index.add(*_index_entry(offset, len(line), record))
+            except (ValueError, AttributeError):
+                pass
+            offset += len(line)
+    index.end = offset
+    return index
+
+
+def _parse_entries(index, content):
+    """Add the complete lines of index file content, return bytes used"""
+    used = content.rfind(b"\n") + 1
+    lines = content[:used].decode("utf-8").splitlines()
+    try:
+        # decoding all entries at once is a lot faster than line by line
+        entries = json.loads("[%s]" % ",".join(lines))
+    except ValueError:
+        entries = []
+        for line in lines:
+            try:
+                entries.append(json.loads(line))
+            except ValueError:
+                index.valid = False
+    for entry in entries:
+        try:
+            index.add(*entry)
+        except TypeError:
+            index.valid = False
+    index.indexed_end = index.end
+    return used
+
+
+# parsed index files by path, extended when the index file grows
+_index_cache = {}
+_index_cache_lock = threading.Lock()
+
+
+def _read_index_file(idx_path):
+    """Get the index stored in an index file or None if it does not exist"""
+    try:
+        fptr = open(idx_path, "rb")
+    except (IOError, OSError):
+        return None
+    with fptr:
+        stat = os.fstat(fptr.fileno())
+        key = (stat.st_dev, stat.st_ino)
+        cached = _index_cache.get(idx_path)
+        if cached is None or cached[0] != key or cached[1] > stat.st_size:
+            cached = (key, 0, _SegmentIndex())
+        key, consumed, index = cached
+        if stat.st_size > consumed:
+            fptr.seek(consumed)
+            consumed += _parse_entries(index, fptr.read())
+        _index_cache[idx_path] = (key, consumed, index)
+        return index
+
+
+def _write_index_file(idx_path, index):
+    tmp_path = idx_path + ".tmp"
+    with open(tmp_path, "wb") as fptr:
+        fptr.write("".join(json.dumps(entry) + "\n" for entry
+                           in index.entries_from(0)).encode("utf-8"))
+    os.rename(tmp_path, idx_path)
+
+
+def _load_index(path):
+    """
+    Get the index of an active or sealed audit file. Index files are only
+    parsed as far as they grew since they were last read, and whatever the
+    index file does not cover yet is indexed by scanning the audit file.
+    """
+    with _index_cache_lock:
+        index = _read_index_file(_index_path(path))
+        sealed = path.endswith(".gz")
+
+        if index is None:
+            index = _scan_into(_SegmentIndex(), path)
+            if sealed:
+                # sealed segments do not change, index them only once
+                try:
+                    _write_index_file(_index_path(path), index)
+                except (IOError, OSError):
+                    pass
+            return index
+        if sealed:
+            return index
+
+        try:
+            size = os.stat(path).st_size
+        except OSError:
+            size = 0
+        if not index.valid or index.end > size:
+            index = _scan_into(_SegmentIndex(), path)
+            index.valid = False
+        elif index.end < size:
+            index = _scan_into(index.copy(), path, index.end)
+        return index
+
+
+def _select(paths, since, until, events, containers):
+    """Yield the path and spans of the matching records of every file"""
+    for path in paths:
+        try:
+            index = _load_index(path)
+        except (IOError, OSError):
+            # rotated or removed while we were reading
+            continue
+        yield path, index.select(since, until, events, containers)
+
+
+def _select_newest(paths, last, since, until, events, containers):
+    """Like _select, but only for the newest `last` matching records"""
+    selected = []
+    if last <= 0:
+        return selected
+    for path, spans in _select(reversed(paths), since, until, events,
+                               containers):
+        spans = spans[-last:]
+        selected.insert(0, (path, spans))
+        last -= len(spans)
+        if last <= 0:
+            break
+    return selected
+
+
+def _parse_record(data, timestamp, event):
+    """The record in data if it is the one indexed, or None"""
+    if not data.endswith(b"\n"):
+        return None
+    try:
+        record = json.loads(data.decode("utf-8"))
+    except ValueError:
+        return None
+    if (not isinstance(record, dict) or
+            record.get('timestamp', 0) != timestamp or
+            record.get('event') != event):
+        return None
+    return record
+
+
+def _read_records(path, spans):
+    """
+    Read the records at the given (offset, length, timestamp, event) spans
+    of a file as (line, record), skipping those that do not match the index
+    """
+    try:
+        fptr = _open_binary(path)
+    except (IOError, OSError):
+        return
+    with fptr:
+        for offset, length, timestamp, event in spans:
+            fptr.seek(offset)
+            data = fptr.read(length)
+            record = _parse_record(data, timestamp, event)
+            if record is None:
+                _logger.warning("Skipping the audit record at %d of %s, "
+                                "which does not match its index",
+                                offset, path)
+                continue
+            yield data.decode("utf-8"), record
+
+
+def parse_time(value):
+    """
+    Parse a point in time given as seconds since the epoch or as local
+    date and time like 2017-03-01T12:30:00, 2017-03-01 12:30 or 2017-03-01
+    """
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    for fmt in ("%Y-%m-%dT%H:%M:%S", "%Y-%m-%d %H:%M:%S",
+                "%Y-%m-%dT%H:%M", "%Y-%m-%d %H:%M", "%Y-%m-%d"):
+        try:
+            return time.mktime(time.strptime(value, fmt))
+        except ValueError:
+            pass
+    raise errors.BlockadeUsageError("Invalid time '%s'" % value)
+
+
+def _first_timestamp(file_path):
+    try:
+        with open(file_path) as fptr:
+            return json.loads(fptr.readline())['timestamp']
+    except (IOError, OSError, ValueError, KeyError):
+        return time.time()
+
+
+# one writer per audit file, shared by all auditors of this process
+_writers = {}
+_writers_lock = threading.Lock()
+
+
+def _get_writer(file_path, fsync, queue_size, segment_policy):
+    with _writers_lock:
+        writer = _writers.get(file_path)
+        if writer is None:
+            writer = _writers[file_path] = _AuditWriter(
+                file_path, fsync, queue_size, segment_policy)
+        return writer
+
+
+def _remove_writer(file_path):
+    with _writers_lock:
+        writer = _writers.pop(file_path, None)
+    if writer is not None:
+        writer.close()
+
+
+def close_all():
+    """Write all pending audit events and stop the writer threads"""
+    with _writers_lock:
+        writers = list(_writers.values())
+        _writers.clear()
+    for writer in writers:
+        writer.close()
+
+
+atexit.register(close_all)
+
+
+DEFAULT_SUBSCRIPTION_SIZE = 1024
+DEFAULT_FOLLOW_INTERVAL = 0.5
+
+
+class Subscription(object):
+    """Events logged to one audit file from within this process
+
+    Events are handed over as they are logged, before they are written.
+    A subscriber that falls behind by more than the queue size misses
+    events, which are counted in `missed` instead of slowing down logging.
+    """
+
+    def __init__(self, file_path, events=None, containers=None,
+                 queue_size=DEFAULT_SUBSCRIPTION_SIZE):
+        self._file_path = file_path
+        self._events = set(e.lower() for e in events) if events else None
+        self._containers = set(containers) if containers else None
+        self._queue = queue.Queue(queue_size)
+        self.missed = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def get(self, timeout=None):
+        """Wait for the next event, raises queue.Empty on timeout"""
+        return self._queue.get(timeout=timeout)
+
+    def poll(self):
+        """Get all pending events without waiting"""
+        records = []
+        try:
+            while True:
+                records.append(self._queue.get_nowait())
+        except queue.Empty:
+            return records
+
+    def close(self):
+        _unsubscribe(self)
+
+    def _publish(self, record):
+        if not _matches(record, self._events, self._containers):
+            return
+        try:
+            self._queue.put_nowait(record)
+        except queue.Full:
+            self.missed += 1
+
+
+def _matches(record, events, containers):
+    """Whether a record is one of the events and targets any container"""
+    if events and record.get('event') not in events:
+        return False
+    if containers and set(containers).isdisjoint(
+            _target_names(record.get('targets', []))):
+        return False
+    return True
+
+
+# subscriptions by audit file, replaced as a whole on every change so
+# publishing can go without locking
+_subscriptions = {}
+_subscriptions_lock = threading.Lock()
+
+
+def _subscribe(subscription):
+    with _subscriptions_lock:
+        path = subscription._file_path
+        _subscriptions[path] = _subscriptions.get(path, ()) + (subscription,)
+
+
+def _unsubscribe(subscription):
+    with _subscriptions_lock:
+        path = subscription._file_path
+        remaining = tuple(s for s in _subscriptions.get(path, ())
+                          if s is not subscription)
+        if remaining:
+            _subscriptions[path] = remaining
+        else:
+            _subscriptions.pop(path, None)
+
+
+def _publish(file_path, record):
+    for subscription in _subscriptions.get(file_path, ()):
+        subscription._publish(record)
+
+
+def _reverse_lines(buf):
+    """Yield the complete lines of a buffer from the last to the first"""
+    end = buf.rfind(b"\n") + 1
+    while end > 0:
+        start = buf.rfind(b"\n", 0, end - 1) + 1
+        yield buf[start:end]
+        end = start
+
+
+def _reverse_segment(path):
+    """Yield the lines of an active or sealed audit file backwards"""
+    if path.endswith(".gz"):
+        # sealed segments are bounded in size, unpacking one is cheap enough
+        try:
+            with gzip.open(path, "rb") as fptr:
+                buf = fptr.read()
+        except (IOError, OSError):
+            return
+        for line in _reverse_lines(buf):
+            yield line.decode("utf-8")
+        return
+
+    try:
+        fptr = open(path, "rb")
+    except (IOError, OSError):
+        return
+    with fptr:
+        if os.fstat(fptr.fileno()).st_size == 0:
+            return
+        buf = mmap.mmap(fptr.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            for line in _reverse_lines(buf):
+                yield line.decode("utf-8")
+        finally:
+            buf.close()
+
+
+def _reverse_records(paths, as_json):
+    """Iterate over the lines of several audit files, newest line first"""
+    for path in reversed(paths):
+        for line in _reverse_segment(path):
+            yield json.loads(line) if as_json else line
+
 
 class _AuditIterator(object):
-    def __init__(self, fptr, as_json):
-        self._fptr = fptr
+    """Iterates over the lines of several audit files in turn"""
+
+    def __init__(self, paths, as_json):
+        self._paths = list(paths)
+        self._fptr = None
         self._as_json = as_json
 
     def __iter__(self):
         return self
 
     def __next__(self):
-        l = self._fptr.readline()
-        if l == "":
-            self._fptr.close()
-            raise StopIteration()
+        l = ""
+        while l == "":
+            if self._fptr is None:
+                if not self._paths:
+                    raise StopIteration()
+                self._fptr = _open_segment(self._paths.pop(0))
+                if self._fptr is None:
+                    continue
+            l = self._fptr.readline()
+            if l == "":
+                self._fptr.close()
+                self._fptr = None
         if self._as_json:
             return json.loads(l)
         return l
@@ -30,9 +915,63 @@ class _AuditIterator(object):
         return self.__next__()
 
 
+def _open_segment(path):
+    """Open a sealed or active audit file for reading if it still exists"""
+    try:
+        if path.endswith(".gz"):
+            return io.TextIOWrapper(gzip.open(path, "rb"))
+        return open(path, "r")
+    except (IOError, OSError):
+        return None
+
+
+def _latest_segment(path):
+    segments = _segments(path)
+    return segments[-1][0] if segments else 0
+
+
+def _open_to_follow(path, at_end):
+    """
+    Open the active audit file, if it exists, together with the number of
+    the latest sealed segment at that time, so the file will be sealed
+    with the next number
+    """
+    while True:
+        latest = _latest_segment(path)
+        try:
+            fptr = open(path, "rb")
+        except (IOError, OSError):
+            fptr = None
+        if _latest_segment(path) == latest:
+            break
+        # rotated while opening, try again
+        if fptr is not None:
+            fptr.close()
+    if fptr is not None and at_end:
+        fptr.seek(0, os.SEEK_END)
+    return fptr, latest
+
+
+def _was_rotated(fptr, path):
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return False
+    if fptr is None:
+        return True
+    current = os.fstat(fptr.fileno())
+    return (stat.st_dev, stat.st_ino) != (current.st_dev, current.st_ino)
+
+
 class EventAuditor(object):
-    def __init__(self, file_path):
-        self._file_path = file_path
+    def __init__(self, file_path, fsync=None, queue_size=DEFAULT_QUEUE_SIZE,
+                 segment_policy=None):
+        self._file_path = os.path.abspath(file_path)
+        fsync = fsync or os.environ.get(AUDIT_FSYNC_ENV) or FSYNC_NEVER
+        if fsync not in FSYNC_POLICIES:
+            raise errors.BlockadeError(
+                    "Invalid audit fsync policy '%s', must be one of %s"
+                    % (fsync, ", ".join(FSYNC_POLICIES)))
         try:
             with open(file_path, "a"):
                 pass
@@ -40,8 +979,16 @@ class EventAuditor(object):
             raise errors.BlockadeError(
                     "Cannot open the audit file %s because %s" % (file_path,
                                                                   str(ioe)))
+        self._fsync = fsync
+        self._queue_size = queue_size
+        self._segment_policy = segment_policy or segment_policy_from_env()
+
+    @property
+    def _writer(self):
+        return _get_writer(self._file_path, self._fsync, self._queue_size,
+                           self._segment_policy)
 
-    def log_event(self, event, status, message, targets):
+    def log_event(self, event, status, message, targets, results=None):
         normalized_target = []
         for l in targets:
             if isinstance(l, frozenset):
@@ -56,19 +1003,157 @@ class EventAuditor(object):
             'targets': normalized_target,
             'message': message
         }
+        if results:
+            # outcome per target of operations fanned out across containers
+            line['results'] = results
+        operation = timing.current()
+        if operation is not None:
+            # start, end and duration of the operation with the time spent
+            # in each of its phases, in seconds
+            line.update(operation.to_dict(end=line['timestamp']))
         _logger.info("event=%(event)s status=%(status)s targets=%(targets)s "
                      "%(message)s" % line)
+        with timing.phase(timing.AUDIT_LOG, event=line['event']):
+            self._writer.write(line)
+            _publish(self._file_path, line)
+
+    def subscribe(self, events=None, containers=None,
+                  queue_size=DEFAULT_SUBSCRIPTION_SIZE):
+        """
+        Subscribe to the events logged from now on by any auditor of this
+        process, optionally only to the given events or those targeting any
+        of the given containers. Close the subscription when done.
+        """
+        subscription = Subscription(self._file_path, events, containers,
+                                    queue_size)
+        _subscribe(subscription)
+        return subscription
+
+    def follow(self, events=None, containers=None, as_json=False,
+               poll_interval=DEFAULT_FOLLOW_INTERVAL, stop=None):
+        """
+        Iterate over the events logged from now on by any process, following
+        the audit file across rotations, until the `stop` event is set.
+        Unlike a subscription this works by polling the audit file.
+        """
+        self.flush()
+        if events:
+            events = set(e.lower() for e in events)
+        fptr, sealed = _open_to_follow(self._file_path, at_end=True)
+        pending = b""
         try:
-            with open(self._file_path, "a") as fptr:
-                fptr.write(json.dumps(line))
-                fptr.write(os.linesep)
-        except Exception as ex:
-            # swallow errors here and consider it a degradation of service
-            _logger.error("Failed to record an audit line %s" % str(ex))
+            while stop is None or not stop.is_set():
+                chunk = fptr.read() if fptr is not None else b""
+                rotated = not chunk and _was_rotated(fptr, self._file_path)
+                if rotated:
+                    if fptr is not None:
+                        # the writer is done with the rotated file, read
+                        # what it wrote since we last looked
+                        chunk = fptr.read()
+                        fptr.close()
+                    # the file we followed got sealed as number sealed + 1,
+                    # files rotated even after that were never seen
+                    fptr, latest = _open_to_follow(self._file_path,
+                                                   at_end=False)
+                    for seq, path in _segments(self._file_path):
+                        if sealed + 1 < seq <= latest:
+                            with _open_binary(path) as missed:
+                                chunk += missed.read()
+                    sealed = latest
+
+                lines = (pending + chunk).split(b"\n")
+                pending = b"" if rotated else lines.pop()
+                for line in lines:
+                    if not line:
+                        continue
+                    try:
+                        line = line.decode("utf-8") + "\n"
+                        record = json.loads(line)
+                    except ValueError:
+                        record = None
+                    if not isinstance(record, dict):
+                        # e.g. cut short by a writer killed while appending
+                        _logger.warning("Skipping a corrupt line of %s",
+                                        self._file_path)
+                        continue
+                    if _matches(record, events, containers):
+                        yield record if as_json else line
+
+                if not chunk:
+                    time.sleep(poll_interval)
+        finally:
+            if fptr is not None:
+                fptr.close()
+
+    def flush(self):
+        """Wait until all events logged so far are in the audit file"""
+        self._writer.flush()
+
+    def close(self):
+        """Write all pending events and stop writing in the background"""
+        _remove_writer(self._file_path)
+
+    def read_logs(self, as_json=False, last=None, reverse=False):
+        """
+        Iterate over all events, from the oldest sealed segment on, or from
+        the newest event backwards if `reverse` is set. With `last` only the
+        newest `last` events are read, which takes the same time no matter
+        how long the log is.
+        """
+        self.flush()
+        paths = [path for _, path in _segments(self._file_path)]
+        paths.append(self._file_path)
+        if not reverse and last is None:
+            return _AuditIterator(paths, as_json)
+
+        records = _reverse_records(paths, as_json)
+        if last is not None:
+            records = itertools.islice(records, last)
+            if not reverse:
+                records = reversed(list(records))
+        return iter(records)
+
+    def query(self, since=None, until=None, events=None, containers=None,
+              limit=None, last=None, as_json=False):
+        """
+        Iterate over the events logged between `since` and `until` (seconds
+        since the epoch) for any of the given `events` that target any of
+        the given `containers`, only the first `limit` or the newest `last`
+        of them. Only the indexes and the matching records are read.
+        """
+        if (since is None and until is None and not events and
+                not containers and limit is None):
+            # without filters reading the log directly is faster
+            for line in self.read_logs(as_json=as_json, last=last):
+                yield line
+            return
+
+        self.flush()
+        if events:
+            events = [e.lower() for e in events]
+        paths = [path for _, path in _segments(self._file_path)]
+        paths.append(self._file_path)
+        matches = _select(paths, since, until, events, containers)
+        if last is not None:
+            matches = _select_newest(paths, last, since, until, events,
+                                     containers)
 
-    def read_logs(self, as_json=False):
-        return _AuditIterator(open(self._file_path, "r"), as_json)
+        count = 0
+        for path, spans in matches:
+            if limit is not None and count >= limit:
+                return
+            if limit is not None:
+                spans = spans[:limit - count]
+            for line, record in _read_records(path, spans):
+                count += 1
+                yield record if as_json else line
 
     def clean(self):
         # XXX what happens when the interator is not fully walked?
+        self.close()
+        for _, path in _segments(self._file_path):
+            _remove(path)
+            _remove(_index_path(path))
+        _remove(_index_path(self._file_path))
+        _remove(_lock_path(self._file_path))
         os.remove(self._file_path)
@@ -13,9 +13,12 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 #
+from contextlib import contextmanager
+
 import logging
 import random
 import threading
+import time
 
 from blockade import errors
 from blockade import state_machine
@@ -58,6 +61,12 @@ def _duplicate(blockade, targets, all_containers):
     blockade.duplicate(target_names)
 
 
+def _throttle(blockade, targets, all_containers):
+    target_names = [t.name for t in targets]
+    _logger.info("Chaos limiting the bandwidth for %s" % str(target_names))
+    blockade.throttle(target_names)
+
+
 def _stop(blockade, targets, all_containers):
     target_names = [t.name for t in targets]
     _logger.info("Chaos stopping %s" % str(target_names))
@@ -70,9 +79,15 @@ _g_blockade_event_handlers = {
     'FLAKY': _flaky,
     'SLOW': _slow,
     'DUPLICATE': _duplicate,
+    'THROTTLE': _throttle,
 }
 
 
+@contextmanager
+def _no_lock():
+    yield
+
+
 def get_all_event_names():
     return list(_g_blockade_event_handlers.keys())
 
@@ -101,7 +116,10 @@ class BlockadeChaos(object):
                  min_run_time, max_run_time,
                  min_containers_at_once, max_containers_at_once,
                  event_set,
-                 done_notification_func=None):
+                 done_notification_func=None,
+                 blockade_lock=None,
+                 state=None,
+                 state_listener=None):
         valid_events = get_all_event_names()
         if event_set is None:
             event_set = valid_events
@@ -120,15 +138,47 @@ class BlockadeChaos(object):
         self._max_containers_at_once = max_containers_at_once
         self._chaos_events = event_set[:]
         self._done_notification_func = done_notification_func
+        # guards the blockade against concurrent changes by others
+        self._blockade_lock = blockade_lock or _no_lock
+        # called with every state entered, to persist it
+        self._state_listener = state_listener
         self._timer = None
+        # time spent in the DEGRADED state, up to when it was last entered
+        self._degraded_seconds = 0.0
+        self._degraded_since = None
         self._mutex = threading.Lock()
-        self._create_state_machine()
+        self._create_state_machine(state or ChaosStates.NEW)
         self._mutex.acquire()
         try:
-            self._sm.event_occurred(ChaosEvents.START)
+            if state is None:
+                self._event_occurred(ChaosEvents.START)
+            else:
+                self._resume(state)
         finally:
             self._mutex.release()
 
+    def _resume(self, state):
+        '''
+        Carry on with chaos left in the given state, e.g. by a daemon that
+        was restarted meanwhile
+        '''
+        if state == ChaosStates.HEALTHY:
+            self._start_timer(self._start_min_delay, self._start_max_delay)
+        elif state == ChaosStates.DEGRADED:
+            # the containers may still be degraded, and are relieved once
+            # the usual run time passed
+            self._degraded_since = time.time()
+            self._start_timer(self._run_min_time, self._run_max_time)
+
+    def _start_timer(self, min_millisec, max_millisec):
+        millisec = random.randint(min_millisec, max_millisec)
+        self._timer = threading.Timer(millisec / 1000.0, self.event_timeout)
+        self._timer.start()
+
+    def _cancel_timer(self):
+        if self._timer is not None:
+            self._timer.cancel()
+
     def change_events(self,
                       min_start_delay=None, max_start_delay=None,
                       min_run_time=None, max_run_time=None,
@@ -155,36 +205,38 @@ class BlockadeChaos(object):
             self._mutex.release()
 
     def _do_reset_all(self):
-        container_list = self._blockade.status()
-        container_names = [t.name for t in container_list]
-        # greedily set everything to a happy state
-        self._blockade.start(container_names)
-        self._blockade.fast(container_names)
-        self._blockade.join()
+        with self._blockade_lock():
+            container_list = self._blockade.status()
+            container_names = [t.name for t in container_list]
+            # greedily set everything to a happy state
+            self._blockade.start(container_names)
+            self._blockade.fast(container_names)
+            self._blockade.join()
 
     def _do_blockade_event(self):
-        container_list = self._blockade.status()
-        random.shuffle(container_list)
-        count = random.randint(self._min_containers_at_once,
-                               self._max_containers_at_once)
-        targets = container_list[:count]
-        partition_list = []
-        for t in targets:
-            e = random.choice(self._chaos_events)
-            if e == 'PARTITION':
-                partition_list.append(t)
-            else:
-                _g_blockade_event_handlers[e](
-                    self._blockade, [t], container_list)
-        if len(partition_list) > 0:
-            _partition(self._blockade, partition_list, container_list)
+        with self._blockade_lock():
+            container_list = self._blockade.status()
+            random.shuffle(container_list)
+            count = random.randint(self._min_containers_at_once,
+                                   self._max_containers_at_once)
+            targets = container_list[:count]
+            partition_list = []
+            for t in targets:
+                e = random.choice(self._chaos_events)
+                if e == 'PARTITION':
+                    partition_list.append(t)
+                else:
+                    _g_blockade_event_handlers[e](
+                        self._blockade, [t], container_list)
+            if len(partition_list) > 0:
+                _partition(self._blockade, partition_list, container_list)
 
     def print_state_machine(self):
         self._sm.draw_mapping()
 
     # state machine logic
-    def _create_state_machine(self):
-        self._sm = state_machine.StateMachine(ChaosStates.NEW)
+    def _create_state_machine(self, state=ChaosStates.NEW):
+        self._sm = state_machine.StateMachine(state)
         self._sm.add_transition(
             ChaosStates.NEW, ChaosEvents.START, ChaosStates.HEALTHY,
             self._sm_start, ChaosStates.FAILED_WHILE_HEALTHY)
@@ -255,31 +307,61 @@ class BlockadeChaos(object):
         finally:
             self._mutex.release()
 
+    def degraded_seconds(self):
+        '''Total time the blockade was degraded by this chaos'''
+        self._mutex.acquire()
+        try:
+            seconds = self._degraded_seconds
+            if self._degraded_since is not None:
+                seconds += time.time() - self._degraded_since
+            return seconds
+        finally:
+            self._mutex.release()
+
+    def _event_occurred(self, event):
+        previous = self._sm.get_state()
+        try:
+            self._sm.event_occurred(event)
+        finally:
+            state = self._sm.get_state()
+            degraded = state == ChaosStates.DEGRADED
+            if degraded and self._degraded_since is None:
+                self._degraded_since = time.time()
+            elif not degraded and self._degraded_since is not None:
+                self._degraded_seconds += time.time() - self._degraded_since
+                self._degraded_since = None
+            if self._state_listener is not None and state != previous:
+                try:
+                    self._state_listener(state)
+                except Exception:
+                    _logger.exception("Failed to record the chaos state %s "
+                                      "of %s", state, self._blockade_name)
+
     def event_timeout(self):
         self._mutex.acquire()
         try:
-            self._sm.event_occurred(ChaosEvents.TIMER)
+            self._event_occurred(ChaosEvents.TIMER)
         finally:
             self._mutex.release()
 
     def start(self):
         self._mutex.acquire()
         try:
-            self._sm.event_occurred(ChaosEvents.START)
+            self._event_occurred(ChaosEvents.START)
         finally:
             self._mutex.release()
 
     def stop(self):
         self._mutex.acquire()
         try:
-            self._sm.event_occurred(ChaosEvents.STOP)
+            self._event_occurred(ChaosEvents.STOP)
         finally:
             self._mutex.release()
 
     def delete(self):
         self._mutex.acquire()
         try:
-            self._sm.event_occurred(ChaosEvents.DELETE)
+            self._event_occurred(ChaosEvents.DELETE)
         finally:
             self._mutex.release()
 
@@ -287,9 +369,7 @@ class BlockadeChaos(object):
         """
         Start the timer waiting for pain
         """
-        millisec = random.randint(self._start_min_delay, self._start_max_delay)
-        self._timer = threading.Timer(millisec / 1000.0, self.event_timeout)
-        self._timer.start()
+        self._start_timer(self._start_min_delay, self._start_max_delay)
 
     def _sm_to_pain(self, *args, **kwargs):
         """
@@ -298,9 +378,7 @@ class BlockadeChaos(object):
         _logger.info("Starting chaos for blockade %s" % self._blockade_name)
         self._do_blockade_event()
         # start the timer to end the pain
-        millisec = random.randint(self._run_min_time, self._run_max_time)
-        self._timer = threading.Timer(millisec / 1000.0, self.event_timeout)
-        self._timer.start()
+        self._start_timer(self._run_min_time, self._run_max_time)
 
     def _sm_stop_from_no_pain(self, *args, **kwargs):
         """
@@ -309,7 +387,7 @@ class BlockadeChaos(object):
         # Just stop the timer.  It is possible that it was too late and the
         # timer is about to run
         _logger.info("Stopping chaos for blockade %s" % self._blockade_name)
-        self._timer.cancel()
+        self._cancel_timer()
 
     def _sm_relieve_pain(self, *args, **kwargs):
         """
@@ -319,9 +397,7 @@ class BlockadeChaos(object):
                 "Ending the degradation for blockade %s" % self._blockade_name)
         self._do_reset_all()
         # set a timer for the next pain event
-        millisec = random.randint(self._start_min_delay, self._start_max_delay)
-        self._timer = threading.Timer(millisec/1000.0, self.event_timeout)
-        self._timer.start()
+        self._start_timer(self._start_min_delay, self._start_max_delay)
 
     def _sm_stop_from_pain(self, *args, **kwargs):
         """
@@ -336,7 +412,7 @@ class BlockadeChaos(object):
         """
         if self._done_notification_func is not None:
             self._done_notification_func()
-        self._timer.cancel()
+        self._cancel_timer()
 
     def _sm_stale_timer(self, *args, **kwargs):
         """
@@ -347,7 +423,7 @@ class BlockadeChaos(object):
 
     def _sm_panic_handler_stop_timer(self):
         try:
-            self._timer.cancel()
+            self._cancel_timer()
             if self._done_notification_func is not None:
                 self._done_notification_func()
         except BaseException as base_ex:
@@ -362,7 +438,12 @@ class Chaos(object):
                   min_start_delay=30000, max_start_delay=300000,
                   min_run_time=30000, max_run_time=300000,
                   min_containers_at_once=1, max_containers_at_once=1,
-                  event_set=None):
+                  event_set=None, blockade_lock=None, state=None,
+                  state_listener=None):
+        '''
+        Start chaos on a blockade, or carry on with chaos left in the given
+        `state`. `state_listener` is called with every state it enters.
+        '''
         if name in self._active_chaos:
             raise errors.BlockadeUsageError(
                     "Chaos is already associated with %s" % name)
@@ -377,7 +458,10 @@ class Chaos(object):
                 max_run_time=max_run_time,
                 min_containers_at_once=min_containers_at_once,
                 max_containers_at_once=max_containers_at_once,
-                event_set=event_set)
+                event_set=event_set,
+                blockade_lock=blockade_lock,
+                state=state,
+                state_listener=state_listener)
         self._active_chaos[name] = bc
         return bc
 
@@ -436,6 +520,12 @@ class Chaos(object):
     def exists(self, name):
         return name in self._active_chaos
 
+    def names(self):
+        return list(self._active_chaos)
+
+    def degraded_seconds(self, name):
+        return self._get_chaos_obj(name).degraded_seconds()
+
     def shutdown(self):
         for c in self._active_chaos:
             chaos_b = self._get_chaos_obj(c)
@@ -18,6 +18,7 @@ import os
 import threading
 import argparse
 import errno
+import itertools
 import json
 import sys
 import traceback
@@ -26,10 +27,13 @@ import signal
 
 from clint.textui import puts, puts_err, colored, columns
 
+from . import audit
+from . import timing
 from .api import rest
 from .chaos import BlockadeChaos
 from .config import BlockadeConfig
 from .core import Blockade
+from .core import DEFAULT_MAX_WORKERS
 from .errors import BlockadeError
 from .errors import InsufficientPermissionsError
 from .net import BlockadeNetwork
@@ -77,7 +81,8 @@ def get_blockade(config, opts):
     return Blockade(config,
                     blockade_id=blockade_id,
                     state=state,
-                    network=BlockadeNetwork(config, get_host_exec()))
+                    network=BlockadeNetwork(config, get_host_exec()),
+                    max_workers=getattr(opts, 'workers', None))
 
 
 _host_exec = None
@@ -176,6 +181,15 @@ def cmd_destroy(opts):
 
 def cmd_status(opts):
     """Print status of containers and networks
+
+    The PARTITION column numbers the groups of containers that may not send
+    to the same other containers. Without one-way partitions these are the
+    partitions as given, in order, followed by the implicit one. A source of
+    an --edge gets a group of its own, so after
+
+        blockade partition --edge c1,c2
+
+    c1 is in partition 1 and the other containers are in none.
     """
     config = load_config(opts.config)
     b = get_blockade(config, opts)
@@ -189,7 +203,7 @@ def __with_containers(opts, func, **kwargs):
     b = get_blockade(config, opts)
     b.state.load()
 
-    configured_containers = set(b.state.containers.keys())
+    configured_containers = set(b.state.containers_view.keys())
     container_names = configured_containers \
         if select_all or (select_random and not containers)\
         else configured_containers.intersection(containers)
@@ -250,6 +264,12 @@ def cmd_duplicate(opts):
     __with_containers(opts, Blockade.duplicate)
 
 
+def cmd_throttle(opts):
+    """Limit the network bandwidth of some or all containers
+    """
+    __with_containers(opts, Blockade.throttle)
+
+
 def cmd_chaos(opts):
     config = load_config(opts.config)
     b = get_blockade(config, opts)
@@ -315,29 +335,63 @@ def cmd_partition(opts):
 
     Alternatively, --random may be specified, and zero or more random
     partitions will be generated by blockade.
+
+    One-way partitions are specified with --edge SOURCE,DESTINATION which
+    prevents SOURCE from sending to DESTINATION while the opposite direction
+    keeps working:
+
+        blockade partition --edge c1,c2
+
     """
     config = load_config(opts.config)
     b = get_blockade(config, opts)
 
     if opts.random:
-        if opts.partitions:
+        if opts.partitions or opts.edges:
             raise BlockadeError("Either specify individual partitions "
                                 "or --random, but not both")
         b.random_partition()
 
     else:
-        partitions = []
-        for partition in opts.partitions:
-            names = []
-            for name in partition.split(","):
-                name = name.strip()
-                if name:
-                    names.append(name)
-            partitions.append(names)
-        if not partitions:
+        partitions = [_split_names(p) for p in opts.partitions]
+        edges = [_split_names(e) for e in opts.edges or []]
+        for edge in edges:
+            if len(edge) != 2:
+                raise BlockadeError("An edge must be specified as "
+                                    "SOURCE,DESTINATION")
+        if not (partitions or edges):
             raise BlockadeError("Either specify individual partitions "
                                 "or random")
-        b.partition(partitions)
+        b.partition(partitions, edges=edges)
+
+
+def _split_names(value):
+    names = []
+    for name in value.split(","):
+        name = name.strip()
+        if name:
+            names.append(name)
+    return names
+
+
+def _split_all_names(values):
+    if not values:
+        return None
+    names = []
+    for value in values:
+        names.extend(_split_names(value))
+    return names
+
+
+def _positive_int(value):
+    try:
+        number = int(value)
+    except ValueError:
+        number = 0
+    if number < 1:
+        raise argparse.ArgumentTypeError(
+            "must be a positive integer, not '%s'" % value)
+    return number
 
 
 def cmd_join(opts):
@@ -362,7 +416,7 @@ def cmd_daemon(opts):
     if opts.data_dir is None:
         raise BlockadeError("You must supply a data directory for the daemon")
     rest.start(data_dir=opts.data_dir, port=opts.port, debug=opts.debug,
-        host_exec=get_host_exec())
+        host_exec=get_host_exec(), server=opts.server, threads=opts.threads)
 
 
 def cmd_add(opts):
@@ -386,6 +440,17 @@ def cmd_events(opts):
     config = load_config(opts.config)
     b = get_blockade(config, opts)
 
+    if opts.follow:
+        _follow_events(b.get_audit(), opts)
+        return
+
+    filters = dict(
+        since=audit.parse_time(opts.since) if opts.since else None,
+        until=audit.parse_time(opts.until) if opts.until else None,
+        events=_split_all_names(opts.event),
+        containers=_split_all_names(opts.container),
+        last=opts.tail)
+
     if opts.json:
         outf = None
         _write = puts
@@ -394,7 +459,7 @@ def cmd_events(opts):
             _write = outf.write
         try:
             delim = ""
-            logs = b.get_audit().read_logs(as_json=False)
+            logs = b.get_audit().query(as_json=False, **filters)
             _write('{"events": [')
             _write(os.linesep)
             for l in logs:
@@ -412,13 +477,44 @@ def cmd_events(opts):
                                   ["TIME",          16],
                                   ["MESSAGE",       25])))
 
-        logs = b.get_audit().read_logs(as_json=True)
+        logs = b.get_audit().query(as_json=True, **filters)
         for l in logs:
-            puts(columns([l['event'],                          10],
-                         [str([str(t) for t in l['targets']]), 16],
-                         [l['status'],                          8],
-                         [str(l['timestamp']),                 16],
-                         [l['message'],                        25]))
+            _print_event(l)
+
+
+def _print_event(l):
+    puts(columns([l['event'],                          10],
+                 [str([str(t) for t in l['targets']]), 16],
+                 [l['status'],                          8],
+                 [str(l['timestamp']),                 16],
+                 [l['message'],                        25]))
+
+
+def _follow_events(auditor, opts):
+    """Print events as they are logged, one JSON document per line with
+    --json, until interrupted
+    """
+    events = _split_all_names(opts.event)
+    containers = _split_all_names(opts.container)
+    if not opts.json:
+        puts(colored.blue(columns(["EVENT",         10],
+                                  ["TARGET",        16],
+                                  ["STATUS",         8],
+                                  ["TIME",          16],
+                                  ["MESSAGE",       25])))
+
+    logs = []
+    if opts.tail:
+        logs = auditor.query(events=events, containers=containers,
+                             last=opts.tail, as_json=True)
+    follow = auditor.follow(events=events, containers=containers,
+                            as_json=True)
+    for l in itertools.chain(logs, follow):
+        if opts.json:
+            puts(json.dumps(l))
+            sys.stdout.flush()
+        else:
+            _print_event(l)
 
 
 _CMDS = (("up", cmd_up),
@@ -432,6 +528,7 @@ _CMDS = (("up", cmd_up),
          ("flaky", cmd_flaky),
          ("slow", cmd_slow),
          ("duplicate", cmd_duplicate),
+         ("throttle", cmd_throttle),
          ("fast", cmd_fast),
          ("partition", cmd_partition),
          ("join", cmd_join),
@@ -452,12 +549,17 @@ def setup_parser():
     parser.add_argument("-n", "--name", metavar="NAME",
                         help="Unique name for blockade. "
                         "Default: basename of working directory")
+    parser.add_argument("--workers", "-w", metavar="N", type=_positive_int,
+                        help="Maximum number of containers to operate on "
+                        "concurrently. Default: %d" % DEFAULT_MAX_WORKERS)
     parser.add_argument("--verbose", "-v", action="store_true",
                         help="Print verbose output")
     parser.add_argument("--debug", "-D", action="store_true",
                         help="Print verbose output")
     parser.add_argument("--logconf", "-l",
                         help="Path to the log configuration file.")
+    parser.add_argument("--trace", metavar="FILE",
+                        help="Write a Chrome trace of the command to FILE")
 
     subparsers = parser.add_subparsers(title="commands")
 
@@ -487,6 +589,7 @@ def setup_parser():
     _add_container_selection_options(command_parsers["slow"])
     _add_container_selection_options(command_parsers["fast"])
     _add_container_selection_options(command_parsers["duplicate"])
+    _add_container_selection_options(command_parsers["throttle"])
 
     command_parsers["logs"].add_argument("container", metavar='CONTAINER',
                                          help="Container to fetch logs for")
@@ -497,6 +600,10 @@ def setup_parser():
     command_parsers["partition"].add_argument(
         "-z", "--random", action='store_true',
         help='Randomly select zero or more partitions')
+    command_parsers["partition"].add_argument(
+        "--edge", action='append', dest='edges', metavar='SOURCE,DESTINATION',
+        help='Prevent SOURCE from sending to DESTINATION (one-way partition). '
+             'May be given multiple times')
 
     command_parsers["kill"].add_argument(
         "-s", "--signal", action="store", default="SIGKILL",
@@ -506,6 +613,14 @@ def setup_parser():
     command_parsers["daemon"].add_argument(
         "-p", "--port", action='store',
         type=int, default=5000, help="REST API port. Default is 5000.")
+    command_parsers["daemon"].add_argument(
+        "--server", choices=rest.SERVERS, default=rest.GEVENT_SERVER,
+        help="HTTP server to run the REST API on, asyncio needs Python 3. "
+             "Default is gevent.")
+    command_parsers["daemon"].add_argument(
+        "--threads", metavar="N", type=int,
+        help="Number of threads making the Docker and host calls of "
+             "requests. Default is 32.")
 
     command_parsers["add"].add_argument(
         "containers", nargs="*", metavar='CONTAINER',
@@ -548,6 +663,27 @@ def setup_parser():
             help="A path to the file where the data should be written.  The "
                  "default is stdout.",
             type=str)
+    command_parsers["events"].add_argument(
+            "--since", metavar="TIME",
+            help="Only show events at or after TIME, given in seconds since "
+                 "the epoch or as local time like 2017-03-01T12:30:00.")
+    command_parsers["events"].add_argument(
+            "--until", metavar="TIME",
+            help="Only show events at or before TIME.")
+    command_parsers["events"].add_argument(
+            "--event", action="append", metavar="EVENT",
+            help="Only show events of this type, like slow or partition. "
+                 "May be comma-separated or given multiple times.")
+    command_parsers["events"].add_argument(
+            "--follow", "-f", action="store_true",
+            help="Keep showing events as they are logged until interrupted.")
+    command_parsers["events"].add_argument(
+            "--tail", type=int, metavar="N",
+            help="Only show the last N (matching) events.")
+    command_parsers["events"].add_argument(
+            "--container", action="append", metavar="CONTAINER",
+            help="Only show events targeting this container. May be "
+                 "comma-separated or given multiple times.")
 
     return parser
 
@@ -580,12 +716,31 @@ def _setup_logging(opts):
 
 def run_cleanups():
     _logger.debug("Running cleanup functions")
+    for cleanup in (audit.close_all, lambda: get_host_exec().close()):
+        try:
+            cleanup()
+        except:
+            puts_err(
+                colored.red("\nUnexpected error in cleanup! This may be a Blockade bug.\n"))
+            traceback.print_exc()
+
+
+def _run_command(opts):
+    if not opts.trace:
+        opts.func(opts)
+        return
+
+    command = opts.func.__name__[len("cmd_"):]
     try:
-        get_host_exec().close()
-    except:
-        puts_err(
-            colored.red("\nUnexpected error in cleanup! This may be a Blockade bug.\n"))
-        traceback.print_exc()
+        with timing.tracing(command) as trace:
+            opts.func(opts)
+    finally:
+        # failed commands are traced as well, up to where they failed
+        try:
+            trace.write(opts.trace)
+        except (IOError, OSError) as e:
+            puts_err(colored.red("Failed to write trace to %s: %s" %
+                                 (opts.trace, e)))
 
 
 def main(args=None):
@@ -614,7 +769,7 @@ def main(args=None):
         if opts.func != cmd_version:
             check_docker()
 
-        opts.func(opts)
+        _run_command(opts)
     except InsufficientPermissionsError as e:
         puts_err(colored.red(
                  "\nInsufficient permissions error:\n") + str(e) + "\n")
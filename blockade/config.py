@@ -114,6 +114,7 @@ _DEFAULT_NETWORK_CONFIG = {
     "flaky": "30%",
     "slow": "75ms 100ms distribution normal",
     "duplicate": "5%",
+    "throttle": "rate 1mbit burst 32kbit latency 400ms",
 }
 
 
@@ -23,42 +23,61 @@ import errno
 import random
 import six
 import sys
+import threading
 import time
 
 from blockade import audit
+from blockade import timing
 from .errors import AlreadyInitializedError
 from .errors import BlockadeContainerConflictError
 from .errors import BlockadeError
+from .errors import BlockadeUsageError
 from .errors import DockerContainerNotFound
 from .errors import InsufficientPermissionsError
+from .errors import TrafficControlError
 from .net import NetworkState
 from .state import BlockadeState
+from .utils import parallel_map
 
 
 # TODO: configurable timeout
 DEFAULT_KILL_TIMEOUT = 3
 
+# maximum number of containers operated on concurrently, by default no more
+# than the Docker client has connections in its pool, beyond that workers
+# only wait for a connection and the pool warns that it is full
+DOCKER_POOL_SIZE = 10
+DEFAULT_MAX_WORKERS = DOCKER_POOL_SIZE
+
 _logger = logging.getLogger(__name__)
 
 
 class Blockade(object):
     def __init__(self, config, blockade_id=None, state=None,
-                 network=None, docker_client=None):
+                 network=None, docker_client=None, max_workers=None):
         self.config = config
         self.state = state or BlockadeState(blockade_id=blockade_id)
         self.network = network
+        self.max_workers = max_workers or DEFAULT_MAX_WORKERS
         try:
             self._audit = audit.EventAuditor(self.state.get_audit_file())
         except Exception as ex:
             _logger.exception(ex)
             raise
 
-        default_client = docker.APIClient(
-            **docker.utils.kwargs_from_env(assert_hostname=False)
-        )
-        self.docker_client = docker_client or default_client
-
-    def create(self, verbose=False, force=False):
+        if docker_client is None:
+            docker_client = docker.APIClient(
+                **docker.utils.kwargs_from_env(assert_hostname=False)
+            )
+        # every Docker API call is accounted to the current operation
+        self.docker_client = timing.TimedProxy(docker_client, timing.DOCKER)
+
+    def create(self, verbose=False, force=False, progress=None):
+        '''
+        Start the containers of the blockade. `progress` is called with
+        the number of containers handled so far, the total number of
+        containers and what is being done.
+        '''
         container_state = {}
 
         num_containers = len(self.config.sorted_containers)
@@ -86,6 +105,8 @@ class Blockade(object):
             name = container.name
 
             vprint("\r[%d/%d] Starting '%s' " % (idx+1, num_containers, name))
+            if progress:
+                progress(idx, num_containers, "Starting '%s'" % name)
 
             # in case a startup delay is configured
             # we have to wait in here
@@ -95,6 +116,8 @@ class Blockade(object):
 
             container_id = self._start_container(container, force)
             container_state[name] = {'id': container_id}
+            if progress:
+                progress(idx+1, num_containers, "Started '%s'" % name)
 
         # clear progress line
         vprint('\r')
@@ -115,7 +138,9 @@ class Blockade(object):
         # deprecated since docker > 1.6
         device = None
         try:
-            device = self.network.get_container_device(self.docker_client, container_id)
+            with timing.phase(timing.DEVICE, container=container_name):
+                device = self.network.get_container_device(
+                    self.docker_client, container_id)
         except OSError as err:
             if err.errno in (errno.EACCES, errno.EPERM):
                 msg = "Failed to determine network device of container '%s' [%s]" % (container_name, container_id)
@@ -198,7 +223,7 @@ class Blockade(object):
     def _get_container_description(self, name, network_state=True,
                                    ip_partitions=None):
         self.state.load()
-        state_container = self.state.containers[name]
+        state_container = self.state.containers_view[name]
         container_id = state_container['id']
 
         try:
@@ -228,7 +253,7 @@ class Blockade(object):
             if ip:
                 extras['ip_address'] = ip
 
-        if (network_state and name in self.state.containers
+        if (network_state and name in self.state.containers_view
                 and container_status == ContainerStatus.UP):
             device = self._get_device_id(container_id, name)
             extras['device'] = device
@@ -249,12 +274,28 @@ class Blockade(object):
 
         return Container(name, container_id, container_status, **extras)
 
-    def destroy(self, force=False):
+    def destroy(self, force=False, progress=None):
+        '''
+        Remove the containers and network of the blockade. `progress` is
+        called with the number of containers removed so far, the total
+        number of containers and which container was removed.
+        '''
         containers = self._get_blockade_docker_containers()
-        for container in list(containers.values()):
+        removed = [0]
+        removed_lock = threading.Lock()
+
+        def remove(container):
             container_id = container['Id']
             self.docker_client.stop(container_id, timeout=DEFAULT_KILL_TIMEOUT)
             self.docker_client.remove_container(container_id)
+            if progress:
+                with removed_lock:
+                    removed[0] += 1
+                    progress(removed[0], len(containers),
+                             "Removed container %s" % container_id[:12])
+
+        self._fan_out(remove, list(containers.values()), {},
+                      names=list(containers.keys()))
 
         self.network.restore(self.state.blockade_id)
         self.state.destroy()
@@ -268,28 +309,30 @@ class Blockade(object):
 
     # Get the containers that are part of the initial Blockade group
     def _get_blockade_docker_containers(self):
-        self.state.load()
-        containers = {}
-        filters = {"label": ["blockade.id=" + self.state.blockade_id]}
-        prefix = self.state.blockade_id + "_"
-        for container in self.docker_client.containers(all=True, filters=filters):
-            for name in container['Names']:
-                # strip leading '/'
-                name = name[1:] if name[0] == '/' else name
-
-                # strip prefix. containers will have these UNLESS `container_name`
-                # was specified in the config
-                name = name[len(prefix):] if name.startswith(prefix) else name
-                if name in self.state.containers:
-                    containers[name] = container
-                    break
-        return containers
+        with timing.phase(timing.DISCOVERY):
+            self.state.load()
+            state_containers = self.state.containers_view
+            containers = {}
+            filters = {"label": ["blockade.id=" + self.state.blockade_id]}
+            prefix = self.state.blockade_id + "_"
+            for container in self.docker_client.containers(all=True, filters=filters):
+                for name in container['Names']:
+                    # strip leading '/'
+                    name = name[1:] if name[0] == '/' else name
+
+                    # strip prefix. containers will have these UNLESS `container_name`
+                    # was specified in the config
+                    name = name[len(prefix):] if name.startswith(prefix) else name
+                    if name in state_containers:
+                        containers[name] = container
+                        break
+            return containers
 
     def _get_docker_containers(self):
         self.state.load()
         containers = self._get_blockade_docker_containers()
         # Search for and add any containers that were added to the state
-        for state_container_name in self.state.containers:
+        for state_container_name in self.state.containers_view:
             if state_container_name not in containers.keys():
                 container_id = self.state.container_id(state_container_name)
                 filters = {"id": container_id}
@@ -298,16 +341,17 @@ class Blockade(object):
         return containers
 
     def _get_all_containers(self):
-        self.state.load()
-        containers = []
-        ip_partitions = self.network.get_ip_partitions(self.state.blockade_id)
-        docker_containers = self._get_docker_containers()
+        with timing.phase(timing.DISCOVERY):
+            self.state.load()
+            containers = []
+            ip_partitions = self.network.get_ip_partitions(self.state.blockade_id)
+            docker_containers = self._get_docker_containers()
 
-        for name in docker_containers.keys():
-            container = self._get_container_description(name, ip_partitions=ip_partitions)
-            containers.append(container)
+            for name in docker_containers.keys():
+                container = self._get_container_description(name, ip_partitions=ip_partitions)
+                containers.append(container)
 
-        return containers
+            return containers
 
     def status(self):
         return self._get_all_containers()
@@ -320,8 +364,13 @@ class Blockade(object):
                                                ContainerStatus.UP, ContainerStatus.DOWN)
 
     def _get_containers_with_state(self, container_names, select_random, *container_states):
-        containers = self._get_all_containers()
+        return self._select_containers(self._get_all_containers(),
+                                       container_names, select_random,
+                                       *container_states)
 
+    @staticmethod
+    def _select_containers(containers, container_names, select_random,
+                           *container_states):
         candidates = dict((c.name, c) for c in containers
                        if c.status in container_states)
 
@@ -343,15 +392,52 @@ class Blockade(object):
     def _get_running_container(self, container_name):
         return self._get_running_containers((container_name,))[0]
 
+    def _fan_out(self, func, containers, results, names=None):
+        '''
+        Call func for each container, running up to max_workers of them
+        concurrently. The outcome of every call is recorded by container name
+        in the results dict. Once all calls are done, a single failure is
+        re-raised and multiple failures are reported together.
+
+        Returns the results of the calls in the order of the containers.
+        '''
+        names = names or [c.name for c in containers]
+        outcomes = parallel_map(func, containers, self.max_workers)
+
+        failures = []
+        for name, (result, exc_info) in zip(names, outcomes):
+            if exc_info is None:
+                results[name] = "Success"
+            else:
+                results[name] = str(exc_info[1])
+                failures.append((name, exc_info))
+
+        if len(failures) == 1:
+            six.reraise(*failures[0][1])
+        elif failures:
+            raise BlockadeError("Failed on containers: %s" % "; ".join(
+                "%s: %s" % (name, exc_info[1]) for name, exc_info in failures))
+        return [result for result, _ in outcomes]
+
     def __with_running_container_device(self, container_names, func, select_random=False):
         message = ""
         audit_status = "Success"
+        results = {}
         try:
             containers = self._get_running_containers(container_names, select_random)
             container_names = [c.name for c in containers]
-            for container in containers:
-                device = self._get_device_id(container.container_id, container.name)
-                func(device)
+            devices = self._fan_out(
+                lambda c: self._get_device_id(c.container_id, c.name),
+                containers, results)
+            # the network applies all devices with a single host command
+            if devices:
+                try:
+                    func(*devices)
+                except TrafficControlError as ex:
+                    for container, device in zip(containers, devices):
+                        if device in ex.failures:
+                            results[container.name] = ex.failures[device]
+                    raise
             return container_names
         except Exception as ex:
             audit_status = "Failed"
@@ -359,29 +445,92 @@ class Blockade(object):
             raise
         finally:
             self._audit.log_event(func.__name__, audit_status, message,
-                                  container_names)
+                                  container_names, results=results)
 
+    @timing.timed('flaky')
     def flaky(self, container_names, select_random=False):
         return self.__with_running_container_device(container_names, self.network.flaky, select_random)
 
+    @timing.timed('slow')
     def slow(self, container_names, select_random=False):
         return self.__with_running_container_device(container_names, self.network.slow, select_random)
 
+    @timing.timed('duplicate')
     def duplicate(self, container_names, select_random=False):
         return self.__with_running_container_device(container_names, self.network.duplicate, select_random)
 
+    @timing.timed('throttle')
+    def throttle(self, container_names, select_random=False):
+        return self.__with_running_container_device(container_names, self.network.throttle, select_random)
+
+    @timing.timed('fast')
     def fast(self, container_names, select_random=False):
         return self.__with_running_container_device(container_names, self.network.fast, select_random)
 
+    @timing.timed('impair')
+    def impair_links(self, links):
+        """Impair the traffic between specific pairs of containers
+
+        `links` maps source container names to dicts of destination
+        container names and the impairment of the packets sent from the
+        source to the destination. An impairment is either a configured
+        network state ("slow", "flaky" or "duplicate") or a raw netem
+        expression like "delay 50ms 10ms".
+
+        Each destination gets a single qdisc tree which replaces any
+        network state it had before, and reports the IMPAIRED network state.
+        Use `fast` to remove it again.
+        """
+        message = ''
+        audit_status = "Success"
+        targets = ["%s->%s" % (src, dst) for src, dsts in links.items()
+                   for dst in dsts]
+        try:
+            for src, dsts in links.items():
+                for dst, impairment in dsts.items():
+                    if not isinstance(impairment, six.string_types):
+                        raise BlockadeUsageError(
+                            "Impairment of link %s->%s must be a string, "
+                            "not %r" % (src, dst, impairment))
+            names = set(links)
+            for dsts in links.values():
+                names.update(dsts)
+            containers = self._get_running_containers(sorted(names))
+            container_dict = dict((c.name, c) for c in containers)
+
+            peers = {}
+            for src, dsts in links.items():
+                for dst, impairment in dsts.items():
+                    if src == dst:
+                        raise BlockadeError(
+                            "Link source and destination must differ: %s" % src)
+                    ip = container_dict[src].ip_address
+                    if not ip:
+                        raise BlockadeError(
+                            "Container %s has no IP address" % src)
+                    peers.setdefault(dst, {})[ip] = impairment
+
+            for dst, dst_peers in sorted(peers.items()):
+                container = container_dict[dst]
+                device = self._get_device_id(container.container_id, dst)
+                self.network.impair_peers(device, dst_peers)
+            return targets
+        except Exception as ex:
+            message = str(ex)
+            audit_status = "Failed"
+            raise
+        finally:
+            self._audit.log_event('impair', audit_status, message, targets)
+
+    @timing.timed('restart')
     def restart(self, container_names, select_random=False):
         message = ""
         audit_status = "Success"
+        results = {}
         try:
             containers = self._get_running_containers(container_names, select_random)
             container_names = [c.name for c in containers]
-            for container in containers:
-                self._stop(container)
-                self._start(container.name)
+            self._fan_out(self._restart, containers, results)
             return container_names
         except Exception as ex:
             message = str(ex)
@@ -389,16 +538,21 @@ class Blockade(object):
             raise
         finally:
             self._audit.log_event('restart', audit_status, message,
-                                  container_names)
+                                  container_names, results=results)
+
+    def _restart(self, container):
+        self._stop(container)
+        self._start(container.name)
 
+    @timing.timed('kill')
     def kill(self, container_names, signal="SIGKILL", select_random=False):
         message = ''
         audit_status = "Success"
+        results = {}
         try:
             containers = self._get_running_containers(container_names, select_random)
             container_names = [c.name for c in containers]
-            for container in containers:
-                self._kill(container, signal)
+            self._fan_out(lambda c: self._kill(c, signal), containers, results)
             return container_names
         except Exception as ex:
             message = str(ex)
@@ -406,20 +560,21 @@ class Blockade(object):
             raise
         finally:
             self._audit.log_event('kill', audit_status, message,
-                                  container_names)
+                                  container_names, results=results)
 
     def _kill(self, container, signal):
         self.docker_client.kill(container.container_id, signal)
 
+    @timing.timed('stop')
     def stop(self, container_names, select_random=False):
         message = ''
         audit_status = "Success"
+        results = {}
         try:
             # it is valid to try to stop an already stopped container
             containers = self._get_created_containers(container_names, select_random)
             container_names = [c.name for c in containers]
-            for container in containers:
-                self._stop(container)
+            self._fan_out(self._stop, containers, results)
             return container_names
         except Exception as ex:
             message = str(ex)
@@ -427,20 +582,21 @@ class Blockade(object):
             raise
         finally:
             self._audit.log_event('stop', audit_status, message,
-                                  container_names)
+                                  container_names, results=results)
 
     def _stop(self, container):
         self.docker_client.stop(container.container_id, timeout=DEFAULT_KILL_TIMEOUT)
 
+    @timing.timed('start')
     def start(self, container_names, select_random=False):
         message = ''
         audit_status = "Success"
+        results = {}
         try:
             # it is valid to try to start an already running container
             containers = self._get_created_containers(container_names, select_random)
             container_names = [c.name for c in containers]
-            for container in container_names:
-                self._start(container)
+            self._fan_out(lambda c: self._start(c.name), containers, results)
             return container_names
         except Exception as ex:
             message = str(ex)
@@ -448,7 +604,7 @@ class Blockade(object):
             raise
         finally:
             self._audit.log_event('start', audit_status, message,
-                                  container_names)
+                                  container_names, results=results)
 
     def _start(self, container):
         container_id = self.state.container_id(container)
@@ -457,9 +613,6 @@ class Blockade(object):
 
         # TODO: determine between create and/or start?
         self.docker_client.start(container_id)
-        # update state
-        updated_containers = self.state.containers
-        updated_containers[container] = {'id': container_id}
 
     def random_partition(self):
         containers = [c.name for c in self._get_running_containers()
@@ -490,28 +643,52 @@ class Blockade(object):
             self.partition(partitions)
             return partitions
 
-    def partition(self, partitions):
+    @timing.timed('partition')
+    def partition(self, partitions, edges=None):
+        """Partition the network between containers
+
+        `partitions` is a list of lists of container names. `edges` is an
+        optional list of directed `(source, destination)` name pairs, each
+        meaning that `source` cannot send to `destination` while the
+        opposite direction keeps working.
+        """
         message = ''
         audit_status = "Success"
+        edges = edges or []
         try:
             containers = self._get_running_containers()
-            container_dict = dict((c.name, c) for c in containers)
-            partitions = expand_partitions(containers, partitions)
-
-            container_partitions = []
-            for partition in partitions:
-                container_partitions.append([container_dict[c] for c in partition])
-
-            self.network.partition_containers(self.state.blockade_id,
-                                              container_partitions)
+            partitions, edges = self._partition(containers, partitions, edges)
         except Exception as ex:
             message = str(ex)
             audit_status = "Failed"
             raise
         finally:
+            targets = list(partitions)
+            targets.extend("%s->%s" % tuple(edge) for edge in edges
+                           if len(edge) == 2)
             self._audit.log_event('partition', audit_status, message,
-                                  partitions)
+                                  targets)
+
+    def _partition(self, containers, partitions, edges):
+        '''Partition the given running containers, return the expanded
+        partitions and edges'''
+        container_dict = dict((c.name, c) for c in containers)
+        partitions = expand_partitions(containers, partitions)
+        edges = expand_edges(containers, edges)
+
+        container_partitions = []
+        for partition in partitions:
+            container_partitions.append([container_dict[c] for c in partition])
 
+        container_edges = [(container_dict[src], container_dict[dst])
+                           for src, dst in edges]
+
+        self.network.partition_containers(self.state.blockade_id,
+                                          container_partitions,
+                                          container_edges)
+        return partitions, edges
+
+    @timing.timed('join')
     def join(self):
         message = ''
         audit_status = "Success"
@@ -525,6 +702,168 @@ class Blockade(object):
         finally:
             self._audit.log_event('join', audit_status, message, [])
 
+    def batch(self, steps):
+        '''Apply a sequence of steps based on a single container discovery
+
+        Every step is a dict with one of `action` (start, stop, restart,
+        kill or join), `network_state` (flaky, slow, duplicate, throttle or
+        fast) or `partitions` and/or `edges` as taken by `partition`.
+        Actions other than join and network states also need a list of
+        `container_names`. Only the containers changed by an action are
+        inspected again, and consecutive network states are applied with a
+        single tc batch. Every step is audited as its own event.
+
+        The batch stops at the first failing step. Returns a dict per step
+        with its `status` (Success, Failed or Skipped), `message`,
+        `targets` and per-container `results`.
+        '''
+        kinds = [_batch_step_kind(step) for step in steps]
+        outcomes = [dict(status="Skipped", message='', targets=[], results={})
+                    for _ in steps]
+
+        snapshot = dict((c.name, c) for c in self._get_all_containers())
+        idx = 0
+        while idx < len(steps):
+            end = idx + 1
+            if kinds[idx] == 'network_state':
+                while end < len(steps) and kinds[end] == 'network_state':
+                    end += 1
+                self._batch_network_states(steps[idx:end], snapshot,
+                                           outcomes[idx:end])
+            elif kinds[idx] == 'action':
+                self._batch_action(steps[idx], snapshot, outcomes[idx])
+            else:
+                self._batch_partition(steps[idx], snapshot, outcomes[idx])
+            if any(o['status'] != "Success" for o in outcomes[idx:end]):
+                break
+            idx = end
+        return outcomes
+
+    def _batch_step(self, event, outcome, targets, func):
+        '''
+        Run func as a step of a batch, which returns the targets of the
+        step, and audit it. Unlike the single operations, failures are
+        reported in the outcome of the step instead of being raised.
+        '''
+        message = ''
+        audit_status = "Success"
+        results = {}
+        try:
+            targets = func(results)
+        except Exception as ex:
+            _logger.debug("Batch step %s failed", event, exc_info=True)
+            message = str(ex)
+            audit_status = "Failed"
+        finally:
+            self._audit.log_event(event, audit_status, message, targets,
+                                  results=results)
+            outcome.update(status=audit_status, message=message,
+                           targets=targets, results=results)
+
+    def _batch_action(self, step, snapshot, outcome):
+        action = step['action']
+        if action == 'join':
+            def join(results):
+                self.network.restore(self.state.blockade_id)
+                return []
+            with timing.operation(action):
+                self._batch_step(action, outcome, [], join)
+            return
+
+        if action in ('restart', 'kill'):
+            states = (ContainerStatus.UP,)
+        else:
+            states = (ContainerStatus.UP, ContainerStatus.DOWN)
+        calls = {
+            'start': lambda c: self._start(c.name),
+            'stop': self._stop,
+            'restart': self._restart,
+            'kill': lambda c: self._kill(c, step.get('signal', "SIGKILL")),
+        }
+
+        def run(results):
+            containers = self._select_containers(
+                list(snapshot.values()), step['container_names'], False,
+                *states)
+            self._fan_out(calls[action], containers, results)
+            # the changed containers got new states, IPs and devices
+            for c in containers:
+                snapshot[c.name] = self._get_container_description(c.name)
+            return [c.name for c in containers]
+
+        with timing.operation(action):
+            self._batch_step(action, outcome, step['container_names'], run)
+
+    def _batch_network_states(self, steps, snapshot, outcomes):
+        # devices of the selected containers of each step, in step order
+        step_devices = []
+        device_qdiscs = {}
+        error = None
+        with timing.operation('network_state'):
+            for step in steps:
+                try:
+                    containers = self._select_containers(
+                        list(snapshot.values()), step['container_names'],
+                        False, ContainerStatus.UP)
+                    qdisc = self.network.qdisc(step['network_state'])
+                except Exception as ex:
+                    # apply the steps before, skip the steps after
+                    error = ex
+                    break
+                devices = [(c.name, c.device) for c in containers]
+                step_devices.append(devices)
+                for _, device in devices:
+                    device_qdiscs[device] = qdisc
+
+            failures = {}
+            apply_error = None
+            try:
+                if device_qdiscs:
+                    self.network.apply(device_qdiscs)
+            except TrafficControlError as ex:
+                failures = ex.failures
+            except Exception as ex:
+                apply_error = ex
+
+            for step, outcome, devices in zip(steps, outcomes, step_devices):
+                def applied(results, devices=devices):
+                    for name, device in devices:
+                        results[name] = failures.get(device, "Success")
+                    if apply_error is not None:
+                        raise apply_error
+                    failed = [name for name, device in devices
+                              if device in failures]
+                    if failed:
+                        raise TrafficControlError(
+                            "Error applying traffic control to containers "
+                            "%s" % ", ".join(failed), failures)
+                    return [name for name, _ in devices]
+                self._batch_step(step['network_state'], outcome,
+                                 step['container_names'], applied)
+
+            if error is not None:
+                def fail(results):
+                    raise error
+                step = steps[len(step_devices)]
+                self._batch_step(step['network_state'],
+                                 outcomes[len(step_devices)],
+                                 step['container_names'], fail)
+
+    def _batch_partition(self, step, snapshot, outcome):
+        def run(results):
+            containers = [c for c in snapshot.values()
+                          if c.status == ContainerStatus.UP]
+            partitions, edges = self._partition(
+                containers, step.get('partitions') or [],
+                step.get('edges') or [])
+            targets = list(partitions)
+            targets.extend("%s->%s" % tuple(edge) for edge in edges)
+            return targets
+
+        with timing.operation('partition'):
+            self._batch_step('partition', outcome,
+                             list(step.get('partitions') or []), run)
+
     def logs(self, container_name):
         container = self._get_running_container(container_name)
         return self.docker_client.logs(container.container_id)
@@ -541,6 +880,11 @@ class Blockade(object):
 
     # containers can be the Docker ID or name
     def add_container(self, containers):
+        # other blockade commands may change the state at the same time
+        with self.state.lock():
+            self._add_container(containers)
+
+    def _add_container(self, containers):
         if self.state.exists():
             self.state.load()
 
@@ -597,6 +941,45 @@ class ContainerStatus(object):
     MISSING = "MISSING"
 
 
+_BATCH_ACTIONS = ('start', 'stop', 'restart', 'kill', 'join')
+_BATCH_NETWORK_STATES = ('flaky', 'slow', 'duplicate', 'throttle', 'fast')
+
+
+def _batch_step_kind(step):
+    '''Validate a step of a batch and return which kind of step it is'''
+    if not isinstance(step, dict):
+        raise BlockadeUsageError("Batch steps must be objects")
+    kinds = [kind for kind in ('action', 'network_state', 'partitions')
+             if kind in step]
+    if 'edges' in step and 'partitions' not in kinds:
+        kinds.append('partitions')
+    if len(kinds) != 1:
+        raise BlockadeUsageError("Batch steps need exactly one of 'action', "
+                                 "'network_state' or 'partitions': %s" % step)
+    kind = kinds[0]
+
+    if kind == 'action' and step['action'] not in _BATCH_ACTIONS:
+        raise BlockadeUsageError("'%s' is not a valid action" % step['action'])
+    if (kind == 'network_state' and
+            step['network_state'] not in _BATCH_NETWORK_STATES):
+        raise BlockadeUsageError("'%s' is not a valid network state" %
+                                 step['network_state'])
+    if kind == 'partitions':
+        for partition in step.get('partitions') or []:
+            if not isinstance(partition, list):
+                raise BlockadeUsageError(
+                    "'partitions' must be a list of lists")
+        for edge in step.get('edges') or []:
+            if not (isinstance(edge, list) and len(edge) == 2):
+                raise BlockadeUsageError(
+                    "'edges' must be a list of [source, destination] lists")
+    elif step.get('action') != 'join':
+        if not isinstance(step.get('container_names'), list):
+            raise BlockadeUsageError(
+                "'container_names' must be a list: %s" % step)
+    return kind
+
+
 def expand_partitions(containers, partitions):
     '''
     Validate the partitions of containers. If there are any containers
@@ -638,3 +1021,42 @@ def expand_partitions(containers, partitions):
         partitions.append(neutral_names)
 
     return partitions
+
+
+def expand_edges(containers, edges):
+    '''
+    Validate directed edges between containers and return them as a list
+    of `(source, destination)` tuples.
+    '''
+    all_names = frozenset(c.name for c in containers if not c.holy)
+    holy_names = frozenset(c.name for c in containers if c.holy)
+
+    result = []
+    unknown = set()
+    holy = set()
+
+    for edge in edges:
+        if len(edge) != 2:
+            raise BlockadeError('Edges must consist of a source and a '
+                                'destination: %s' % list(edge))
+        source, destination = edge
+        if source == destination:
+            raise BlockadeError('Edge source and destination must differ: %s'
+                                % source)
+        for name in edge:
+            if name in holy_names:
+                holy.add(name)
+            elif name not in all_names:
+                unknown.add(name)
+        if (source, destination) not in result:
+            result.append((source, destination))
+
+    if unknown:
+        raise BlockadeError('Edges contain unknown containers: %s' %
+                            list(unknown))
+
+    if holy:
+        raise BlockadeError('Edges contain holy containers: %s' %
+                            list(holy))
+
+    return result
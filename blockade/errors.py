@@ -83,6 +83,17 @@ class HostExecError(BlockadeError):
         return message
 
 
+class TrafficControlError(HostExecError):
+    """Error applying traffic control to one or more devices
+    """
+
+    def __init__(self, message, failures):
+        output = "".join("%s: %s" % (device, failures[device])
+                         for device in sorted(failures))
+        super(TrafficControlError, self).__init__(message, output=output)
+        self.failures = failures
+
+
 class BlockadeStateTransitionError(BlockadeError):
     """The state machine was given an invalid event.  Based on the state that
      it is in and the event received the state machine could not process the
@@ -21,8 +21,10 @@ import time
 import uuid
 
 import docker
+import six
 
 from .errors import HostExecError
+from . import timing
 
 
 _logger = logging.getLogger(__name__)
@@ -32,6 +34,24 @@ DEFAULT_CONTAINER_PREFIX = 'blockade-helper'
 CONTAINER_PREFIX_ENV = "BLOCKADE_HOST_CONTAINER_PREFIX"
 
 
+_TOOLS = ("tc", "iptables", "ip")
+
+
+def command_tool(command):
+    '''The network tool run by a host command, even through a shell'''
+    if isinstance(command, six.string_types):
+        words = command.split()
+    else:
+        words = list(command)
+    if words[:1] == ["sh"] and "-c" in words:
+        script = words[words.index("-c") + 1]
+        words = script.split() + words
+    for word in words:
+        if word in _TOOLS:
+            return word
+    return words[0] if words else "unknown"
+
+
 class HostExec(object):
     """Runs host commands via exec in a long-lived container
 
@@ -64,6 +84,11 @@ class HostExec(object):
         self._reset_container()
 
     def run(self, command):
+        # host commands are traffic control and iptables changes
+        with timing.phase(timing.HOST, tool=command_tool(command)):
+            return self._run(command)
+
+    def _run(self, command):
 
         _logger.debug("Running host command '%s'", command)
 
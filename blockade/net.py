@@ -20,7 +20,7 @@ import itertools
 import re
 import logging
 
-from .errors import BlockadeError, HostExecError
+from .errors import BlockadeError, HostExecError, TrafficControlError
 
 
 _logger = logging.getLogger(__name__)
@@ -33,12 +33,30 @@ IPTABLES_DOCKER_IMAGE = "vimagick/iptables:latest"
 
 _ERROR_NET_IFACE = "Failed to find container network interface"
 
+# prio qdiscs have at most 16 bands and the first 3 of them carry all traffic
+# through the default priomap. This leaves 13 bands for peer impairments.
+MAX_PEER_IMPAIRMENTS = 13
+
+# feeds every positional argument as one line into a single tc process
+_TC_BATCH_SCRIPT = 'printf "%s\\n" "$@" | tc -force -batch -'
+_TC_BATCH_FAILED = re.compile(r"^Command failed .*:(\d+)$")
+
+# netem facilities of the network states configured in the `network` block
+_NETEM_STATES = {
+    "flaky": "loss",
+    "slow": "delay",
+    "duplicate": "duplicate",
+}
+
 
 class NetworkState(object):
     NORMAL = "NORMAL"
     SLOW = "SLOW"
     FLAKY = "FLAKY"
     DUPLICATE = "DUPLICATE"
+    THROTTLE = "THROTTLE"
+    # the traffic from some peers only is impaired, see `impair_peers`
+    IMPAIRED = "IMPAIRED"
     UNKNOWN = "UNKNOWN"
 
 
@@ -52,27 +70,78 @@ class BlockadeNetwork(object):
     def network_state(self, device):
         return self.traffic_control.network_state(device)
 
-    def flaky(self, device):
-        flaky_config = self.config.network['flaky'].split()
-        self.traffic_control.netem(device, ["loss"] + flaky_config)
+    def flaky(self, *devices):
+        self._replace(devices, self.qdisc("flaky"))
+
+    def slow(self, *devices):
+        self._replace(devices, self.qdisc("slow"))
+
+    def duplicate(self, *devices):
+        self._replace(devices, self.qdisc("duplicate"))
+
+    def throttle(self, *devices):
+        self._replace(devices, self.qdisc("throttle"))
+
+    def qdisc(self, network_state):
+        """The root qdisc of a network state, None for "fast"
+        """
+        if network_state == "fast":
+            return None
+        if network_state == "throttle":
+            return ["tbf"] + self.config.network['throttle'].split()
+        return ["netem"] + self.netem_params(network_state)
+
+    def apply(self, device_qdiscs):
+        """Set the root qdisc of many devices with a single host command
+
+        See `_TrafficControl.apply`.
+        """
+        self.traffic_control.apply(device_qdiscs)
+
+    def _replace(self, devices, qdisc):
+        if len(devices) == 1:
+            self.traffic_control.replace(devices[0], qdisc)
+        else:
+            self.traffic_control.apply((device, qdisc) for device in devices)
 
-    def slow(self, device):
-        slow_config = self.config.network['slow'].split()
-        self.traffic_control.netem(device, ["delay"] + slow_config)
+    def netem_params(self, impairment):
+        """Translate an impairment into a list of netem parameters
 
-    def duplicate(self, device):
-        duplicate_config = self.config.network['duplicate'].split()
-        self.traffic_control.netem(device, ["duplicate"] + duplicate_config)
+        The impairment is either the name of a configured network state
+        (flaky, slow or duplicate) or a raw netem expression like
+        "delay 50ms 10ms".
+        """
+        facility = _NETEM_STATES.get(impairment)
+        if facility:
+            return [facility] + self.config.network[impairment].split()
+        params = impairment.split()
+        if not params:
+            raise BlockadeError("Invalid network impairment '%s'" % impairment)
+        return params
+
+    def impair_peers(self, device, peers):
+        """Impair the traffic of a device depending on the peer address
+
+        `peers` maps peer IP addresses to impairments (see `netem_params`).
+        The device is the host side of a container's veth pair, so only
+        packets the container receives from the given peers are affected.
+        """
+        peer_params = [(ip, self.netem_params(impairment))
+                       for ip, impairment in peers.items()]
+        self.traffic_control.netem_peers(device, peer_params)
 
-    def fast(self, device):
-        self.traffic_control.restore(device)
+    def fast(self, *devices):
+        if len(devices) == 1:
+            self.traffic_control.restore(devices[0])
+        else:
+            self.traffic_control.apply((device, None) for device in devices)
 
     def restore(self, blockade_id):
         self.iptables.clear(blockade_id)
 
-    def partition_containers(self, blockade_id, partitions):
+    def partition_containers(self, blockade_id, partitions, edges=None):
         self.iptables.clear(blockade_id)
-        self._partition_containers(blockade_id, partitions)
+        self._partition_containers(blockade_id, partitions, edges)
 
     def get_ip_partitions(self, blockade_id):
         return self.iptables.get_source_chains(blockade_id)
@@ -106,35 +175,25 @@ class BlockadeNetwork(object):
             "there may be something unusual about your container network."
             % (_ERROR_NET_IFACE, host_idx, container_id, host_res))
 
-    def _partition_containers(self, blockade_id, partitions):
-        if not partitions or len(partitions) == 1:
-            return
-
+    def _partition_containers(self, blockade_id, partitions, edges=None):
         # partitions without IP addresses can't be part of any
         # iptables rule anyway
-        ip_partitions = [[c for c in parts if c.ip_address] for parts in partitions]
+        ip_partitions = [[c for c in parts if c.ip_address]
+                         for parts in partitions or []]
+        blocked = _get_blocked_destinations(ip_partitions, edges or [])
 
-        all_nodes = frozenset(itertools.chain(*ip_partitions))
-
-        for idx, chain_group in enumerate(_get_chain_groups(ip_partitions)):
+        for idx, (sources, destinations) in enumerate(_get_chain_groups(blocked)):
             # create a new chain
             chain_name = partition_chain_name(blockade_id, idx+1)
             self.iptables.create_chain(chain_name)
 
             # direct all traffic of the chain group members to this chain
-            for container in chain_group:
-                self.iptables.insert_rule("FORWARD", src=container.ip_address, target=chain_name)
-
-            def in_group(container):
-                return any(container.name == x.name for x in chain_group)
-
-            # block all transfer of partitions the containers of this chain group  are NOT part of
-            chain_partition_members = set(itertools.chain(*[parts for parts in ip_partitions
-                                                            if any(in_group(c) for c in parts)]))
-            to_block = all_nodes - chain_partition_members
+            for source in sources:
+                self.iptables.insert_rule("FORWARD", src=source, target=chain_name)
 
-            for container in to_block:
-                self.iptables.insert_rule(chain_name, dest=container.ip_address, target="DROP")
+            # and drop everything the chain group members may not send to
+            for destination in destinations:
+                self.iptables.insert_rule(chain_name, dest=destination, target="DROP")
 
 
 class _IPTables(object):
@@ -282,16 +341,119 @@ class _TrafficControl(object):
                 raise
 
 
-    def netem(self, device, params):
-        cmd = ["tc", "qdisc", "replace", "dev", device,
-               "root", "netem"] + params
+    def replace(self, device, qdisc):
+        cmd = ["tc", "qdisc", "replace", "dev", device, "root"] + qdisc
         self.host_exec.run(cmd)
 
+    def netem(self, device, params):
+        self.replace(device, ["netem"] + params)
+
+    def netem_peers(self, device, peer_params):
+        """Build a qdisc tree with one netem leaf per distinct impairment
+
+        The root is a prio qdisc whose first three bands keep carrying all
+        unmatched traffic. Every distinct set of netem parameters gets its
+        own band and u32 filters steer the packets of each peer address into
+        it. The whole tree is applied with a single tc batch.
+        """
+        classes = collections.OrderedDict()
+        for ip, params in peer_params:
+            classes.setdefault(tuple(params), []).append(ip)
+
+        if len(classes) > MAX_PEER_IMPAIRMENTS:
+            raise BlockadeError(
+                "Device %s can not have more than %d distinct peer "
+                "impairments" % (device, MAX_PEER_IMPAIRMENTS))
+
+        commands = [
+            ["qdisc", "del", "dev", device, "root"],
+            ["qdisc", "add", "dev", device, "root", "handle", "1:",
+             "prio", "bands", str(len(classes) + 3)],
+        ]
+        for band, (params, ips) in enumerate(classes.items(), 4):
+            # tc class minor numbers are hexadecimal
+            classid = "1:%x" % band
+            commands.append(["qdisc", "add", "dev", device,
+                             "parent", classid, "netem"] + list(params))
+            for ip in ips:
+                commands.append(["filter", "add", "dev", device,
+                                 "parent", "1:", "protocol", "ip", "prio", "1",
+                                 "u32", "match", "ip", "src", ip + "/32",
+                                 "flowid", classid])
+
+        failures = self.batch(commands)
+
+        # the device may not have had a root qdisc to delete
+        failures.pop(0, None)
+        if failures:
+            raise HostExecError(
+                "Error building qdisc tree on device %s" % device,
+                output="".join(failures[idx] for idx in sorted(failures)))
+
+    def apply(self, device_qdiscs):
+        """Replace the root qdisc of many devices with a single host exec
+
+        `device_qdiscs` is a mapping or sequence of device and qdisc pairs,
+        where a qdisc is its kind followed by its parameters, e.g.
+        ``["netem", "loss", "30%"]``. A qdisc of None restores the device
+        instead. Failures are reported per device with a
+        `TrafficControlError`.
+        """
+        if isinstance(device_qdiscs, collections.Mapping):
+            device_qdiscs = device_qdiscs.items()
+
+        devices = []
+        commands = []
+        for device, qdisc in device_qdiscs:
+            devices.append(device)
+            if qdisc is None:
+                commands.append(["qdisc", "del", "dev", device, "root"])
+            else:
+                commands.append(["qdisc", "replace", "dev", device,
+                                 "root"] + list(qdisc))
+
+        failures = {}
+        for idx, output in self.batch(commands).items():
+            restoring = commands[idx][1] == "del"
+            if restoring and 'No such file or directory' in output:
+                continue  # this is an expected condition
+            failures[devices[idx]] = output
+
+        if failures:
+            raise TrafficControlError(
+                "Error applying traffic control to devices %s" %
+                ", ".join(sorted(failures)), failures)
+
+    def batch(self, commands):
+        """Run many tc commands with a single host exec
+
+        The commands are fed to ``tc -force -batch`` so a failing command
+        does not abort the remaining ones. Returns a dict mapping the index
+        of every failed command to the error output tc reported for it.
+        """
+        if not commands:
+            return {}
+        lines = [" ".join(command) for command in commands]
+        cmd = ["sh", "-c", _TC_BATCH_SCRIPT, "tc"] + lines
+        try:
+            self.host_exec.run(cmd)
+        except HostExecError as e:
+            failures = _parse_batch_failures(e.output or "")
+            if not failures:
+                raise
+            return failures
+        return {}
+
     def network_state(self, device):
         cmd = ["tc", "qdisc", "show", "dev", device]
         try:
             output = self.host_exec.run(cmd)
             # sloppy but good enough for now
+            if "qdisc prio 1: root " in output and "qdisc netem " in output:
+                # the netem leaves only apply to the traffic of some peers
+                return NetworkState.IMPAIRED
+            if "qdisc tbf " in output:
+                return NetworkState.THROTTLE
             if " delay " in output:
                 return NetworkState.SLOW
             if " loss " in output:
@@ -303,6 +465,19 @@ class _TrafficControl(object):
             return NetworkState.UNKNOWN
 
 
+def _parse_batch_failures(output):
+    failures = {}
+    messages = []
+    for line in output.splitlines(True):
+        match = _TC_BATCH_FAILED.match(line.strip())
+        if match:
+            failures[int(match.group(1)) - 1] = "".join(messages)
+            messages = []
+        else:
+            messages.append(line)
+    return failures
+
+
 def get_container_device_index(docker_client, container_id):
     cmd_args = ['cat', '/sys/class/net/eth0/ifindex']
     res = None
@@ -349,27 +524,53 @@ def partition_chain_prefix(blockade_id):
     return prefix[:MAX_CHAIN_PREFIX_LENGTH]
 
 
-def _get_chain_groups(partitions):
-    chains = []
-
-    def find_partition(name):
-        for idx, parts in enumerate(chains):
-            in_partition = any(c.name == name for c in parts)
-            if in_partition:
-                return idx
-        return None
-
-    for partition in partitions:
-        new_part = []
-        for part in partition:
-            in_partition = find_partition(part.name)
-            if not in_partition is None:
-                chains[in_partition].remove(part)
-                chains.append(set([part]))
-            else:
-                new_part.append(part)
-        if new_part:
-            chains.append(set(new_part))
-
-    # prune empty partitions
-    return [x for x in chains if len(x) > 0]
+def _get_blocked_destinations(partitions, edges):
+    """Map each source IP to the ordered list of IPs it must not send to
+
+    A container may only talk to the members of the partitions it is part
+    of. Every directed edge ``(src, dst)`` additionally blocks ``src`` from
+    sending to ``dst`` without affecting the opposite direction.
+    """
+    blocked = collections.OrderedDict()
+
+    def block(source, destination):
+        destinations = blocked.setdefault(source, [])
+        if destination not in destinations:
+            destinations.append(destination)
+
+    all_nodes = []
+    for container in itertools.chain(*partitions):
+        if container not in all_nodes:
+            all_nodes.append(container)
+
+    for container in all_nodes:
+        reachable = set(c.ip_address for parts in partitions
+                        if container in parts for c in parts)
+        for other in all_nodes:
+            if other.ip_address not in reachable:
+                block(container.ip_address, other.ip_address)
+
+    for source, destination in edges:
+        if source.ip_address and destination.ip_address:
+            block(source.ip_address, destination.ip_address)
+
+    return blocked
+
+
+def _get_chain_groups(blocked):
+    """Group sources sharing the same blocked destinations into one chain
+
+    Every source costs one FORWARD rule and every distinct set of blocked
+    destinations costs one chain with a DROP rule per destination. So a
+    one-way partition never needs more rules than its symmetric variant.
+    """
+    chains = collections.OrderedDict()
+    for source, destinations in blocked.items():
+        if not destinations:
+            continue
+        key = frozenset(destinations)
+        if key in chains:
+            chains[key][0].append(source)
+        else:
+            chains[key] = ([source], destinations)
+    return list(chains.values())
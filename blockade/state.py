@@ -14,13 +14,27 @@
 # limitations under the License.
 #
 
+from contextlib import contextmanager
 from copy import deepcopy
 
 import errno
+import json
 import os
 import re
+import tempfile
+import threading
 import yaml
 
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+try:
+    from collections.abc import Mapping
+except ImportError:
+    from collections import Mapping
+
 from .errors import AlreadyInitializedError
 from .errors import BlockadeError
 from .errors import InconsistentStateError
@@ -28,6 +42,16 @@ from .errors import InvalidBlockadeName
 from .errors import NotInitializedError
 
 
+# Version 1 state files are YAML. Version 2 state files are JSON, which is
+# much faster to read and write and - being a subset of YAML - can still be
+# read by anything that understands version 1.
+STATE_VERSION = 2
+
+# the libyaml based loader and dumper are a lot faster if available
+_YAML_LOADER = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+_YAML_DUMPER = getattr(yaml, 'CSafeDumper', yaml.SafeDumper)
+
+
 class BlockadeState(object):
     '''Blockade state related functionality'''
 
@@ -35,7 +59,7 @@ class BlockadeState(object):
                  blockade_id=None,
                  data_dir=None,
                  state_file=None,
-                 state_version=1):
+                 state_version=STATE_VERSION):
 
         if blockade_id:
             if re.match(r"^[a-zA-Z0-9-.]+$", blockade_id) is None:
@@ -67,6 +91,11 @@ class BlockadeState(object):
         self._state_version = state_version
         self._containers = {}
 
+        # identifies the file contents self._containers was loaded from,
+        # and the version of their format
+        self._signature = None
+        self._file_version = None
+
     @property
     def blockade_id(self):
         return self._blockade_id
@@ -81,6 +110,15 @@ class BlockadeState(object):
         '''Dictionary of container information'''
         return deepcopy(self._containers)
 
+    @property
+    def containers_view(self):
+        '''
+        Read-only view of the container information. Unlike `containers` this
+        does not copy anything, but the view reflects the state at the time
+        it was taken and does not follow later loads or updates.
+        '''
+        return _ReadOnlyView(self._containers)
+
     def container_id(self, name):
         '''Try to find the container ID with the specified name'''
         container = self._containers.get(name, None)
@@ -88,6 +126,23 @@ class BlockadeState(object):
             return container.get('id', None)
         return None
 
+    @contextmanager
+    def lock(self):
+        '''
+        Hold an exclusive lock on this blockade's state for a
+        read-modify-write cycle: load, change and update the state inside
+        the `with` block. The lock is shared by all threads and processes
+        that work on the same state and may be taken recursively. Reading
+        the state does not need the lock because updates are atomic.
+        '''
+        self._assure_dir()
+        state_lock = _state_lock(self._state_dir)
+        state_lock.acquire()
+        try:
+            yield
+        finally:
+            state_lock.release()
+
     def initialize(self, containers):
         '''
         Initialize a new state file with the given contents.
@@ -106,11 +161,26 @@ class BlockadeState(object):
         self.__write(containers, initialize=False)
 
     def load(self):
-        '''Try to load a blockade state file in the current directory'''
+        '''
+        Try to load a blockade state file in the current directory.
+        Parsing is skipped as long as the file was not changed since the
+        last load or write, which is determined by its inode, size and
+        modification time - no matter which process wrote it.
+        '''
+        if self.__read() < self._state_version:
+            self.__migrate()
+
+    def __read(self):
+        '''Load the state file unless unchanged, return its format version'''
         try:
+            if _file_signature(os.stat(self._state_file)) == self._signature:
+                return self._file_version
             with open(self._state_file) as f:
-                state = yaml.safe_load(f)
+                signature = _file_signature(os.fstat(f.fileno()))
+                state = _parse_state(f.read())
                 self._containers = state['containers']
+                self._signature = signature
+                self._file_version = state.get('version', 1)
         except (IOError, OSError) as err:
             if err.errno == errno.ENOENT:
                 raise NotInitializedError("No blockade exists in this context")
@@ -119,6 +189,21 @@ class BlockadeState(object):
         except Exception as err:
             raise InconsistentStateError("Failed to load Blockade state: "
                                          + str(err))
+        return self._file_version
+
+    def __migrate(self):
+        '''
+        Rewrite an outdated state file in the current format. This is done
+        under the lock, and only if no one else updated the file meanwhile,
+        so that concurrent updates are not lost.
+        '''
+        try:
+            with self.lock():
+                if self.__read() < self._state_version:
+                    self.__write(self._containers, initialize=False)
+        except (IOError, OSError):
+            # a read-only state is still usable, it just stays outdated
+            self._signature = None
 
     def destroy(self):
         '''Try to remove the current state file and directory'''
@@ -146,6 +231,7 @@ class BlockadeState(object):
 
     def _state_delete(self):
         '''Try to delete the state.yml file and the folder .blockade'''
+        self._signature = None
         try:
             os.remove(self._state_file)
         except OSError as err:
@@ -168,25 +254,41 @@ class BlockadeState(object):
                     version=self._state_version)
 
     def __write(self, containers, initialize=True):
-        '''Write the given state information into a file'''
+        '''
+        Write the given state information into a file. The contents go to a
+        temporary file first which then atomically replaces the state file,
+        so readers never see a partially written state.
+        '''
         path = self._state_file
+        content = _serialize_state(self.__base_state(containers))
         self._assure_dir()
+        fd, tmp_path = tempfile.mkstemp(dir=self._state_dir, prefix=".state-")
         try:
-            flags = os.O_WRONLY | os.O_CREAT
+            os.fchmod(fd, 0o644)
+            with os.fdopen(fd, "w") as f:
+                f.write(content)
+                f.flush()
+                os.fsync(f.fileno())
             if initialize:
-                flags |= os.O_EXCL
-            with os.fdopen(os.open(path, flags), "w") as f:
-                yaml.safe_dump(self.__base_state(containers), f)
+                # unlike a rename a link fails if the state already exists
+                _link_exclusive(tmp_path, path, content)
+            else:
+                os.rename(tmp_path, path)
+            _fsync_dir(self._state_dir)
+            self._signature = _file_signature(os.stat(path))
+            self._file_version = self._state_version
         except OSError as err:
             if err.errno == errno.EEXIST:
                 raise AlreadyInitializedError(
                     "Path %s exists. "
                     "You may need to destroy a previous blockade." % path)
             raise
-        except Exception:
-            # clean up our created file
-            self._state_delete()
-            raise
+        finally:
+            # clean up our temporary file unless it was renamed
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
 
     def get_audit_file(self):
         audit_dir = os.path.join(self._state_dir, "audit")
@@ -196,3 +298,131 @@ class BlockadeState(object):
             if os_e.errno != errno.EEXIST:
                 raise
         return os.path.join(audit_dir, "%s.json" % self._blockade_id)
+
+
+def _parse_state(content):
+    '''Parse the contents of a state file of any version'''
+    # version 2 files are JSON objects, everything else is left to YAML
+    if content.lstrip().startswith('{'):
+        try:
+            return json.loads(content)
+        except ValueError:
+            pass
+    return yaml.load(content, Loader=_YAML_LOADER)
+
+
+def _serialize_state(state):
+    '''Serialize a state dictionary in the format of its version'''
+    if state['version'] < 2:
+        return yaml.dump(state, Dumper=_YAML_DUMPER)
+    return json.dumps(state, sort_keys=True)
+
+
+def _link_exclusive(src, dst, content):
+    '''Create `dst` as a link to `src`, failing if `dst` already exists'''
+    try:
+        os.link(src, dst)
+    except OSError as err:
+        if err.errno not in (errno.EPERM, errno.EOPNOTSUPP, errno.ENOTSUP):
+            raise
+        # no hard links on this file system, create the file exclusively
+        fd = os.open(dst, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o644)
+        with os.fdopen(fd, "w") as f:
+            f.write(content)
+            f.flush()
+            os.fsync(f.fileno())
+
+
+def _fsync_dir(path):
+    '''Make a rename in the given directory durable'''
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+
+class _StateLock(object):
+    '''
+    Recursive lock on a state directory. A thread lock serializes the
+    threads of this process while an advisory `flock` on the directory
+    serializes processes.
+    '''
+
+    def __init__(self, path):
+        self._path = path
+        self._thread_lock = threading.RLock()
+        self._depth = 0
+        self._fd = None
+
+    def acquire(self):
+        self._thread_lock.acquire()
+        try:
+            if self._depth == 0 and fcntl is not None:
+                self._fd = os.open(self._path, os.O_RDONLY)
+                try:
+                    fcntl.flock(self._fd, fcntl.LOCK_EX)
+                except Exception:
+                    os.close(self._fd)
+                    self._fd = None
+                    raise
+        except Exception:
+            self._thread_lock.release()
+            raise
+        self._depth += 1
+
+    def release(self):
+        self._depth -= 1
+        try:
+            if self._depth == 0 and self._fd is not None:
+                fd, self._fd = self._fd, None
+                # closing the descriptor releases the flock
+                os.close(fd)
+        finally:
+            self._thread_lock.release()
+
+
+_STATE_LOCKS = {}
+_STATE_LOCKS_GUARD = threading.Lock()
+
+
+def _state_lock(path):
+    '''Get the lock shared by everyone in this process using `path`'''
+    with _STATE_LOCKS_GUARD:
+        state_lock = _STATE_LOCKS.get(path)
+        if state_lock is None:
+            state_lock = _STATE_LOCKS[path] = _StateLock(path)
+        return state_lock
+
+
+def _file_signature(stat):
+    '''Identify a version of a file by its inode, size and mtime'''
+    mtime = getattr(stat, 'st_mtime_ns', stat.st_mtime)
+    return (stat.st_dev, stat.st_ino, stat.st_size, mtime)
+
+
+class _ReadOnlyView(Mapping):
+    '''Read-only view of a (nested) dictionary'''
+
+    def __init__(self, data):
+        self._data = data
+
+    def __getitem__(self, key):
+        value = self._data[key]
+        if isinstance(value, dict):
+            return _ReadOnlyView(value)
+        return value
+
+    def __iter__(self):
+        return iter(self._data)
+
+    def __len__(self):
+        return len(self._data)
+
+    def __repr__(self):
+        return repr(self._data)
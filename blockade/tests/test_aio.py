@@ -0,0 +1,171 @@
+#
+#  Copyright (C) 2016 Dell, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+import json
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+import mock
+from six.moves import http_client
+
+from blockade import audit
+from blockade.api import rest
+from blockade.api.manager import BlockadeManager
+from blockade.tests import unittest
+
+try:
+    from blockade.api.aio import AsyncServer
+except (ImportError, SyntaxError):
+    AsyncServer = None
+
+
+@unittest.skipIf(AsyncServer is None, "the asyncio server needs Python 3")
+class AsyncServerTests(unittest.TestCase):
+
+    name = "AsyncServerTests"
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tempdir, ignore_errors=True)
+        self.addCleanup(BlockadeManager.set_data_dir,
+                        BlockadeManager.get_data_dir())
+        BlockadeManager.set_data_dir(self.tempdir)
+        self.blockade = mock.MagicMock()
+        self.blockade.status.return_value = []
+        for target, attr, value in (
+                (rest, '_offload_to_hub', False),
+                (BlockadeManager, 'get_blockade', self.blockade),
+                (BlockadeManager, 'blockade_exists', True)):
+            if callable(getattr(target, attr)):
+                patcher = mock.patch.object(target, attr, return_value=value)
+            else:
+                patcher = mock.patch.object(target, attr, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+        self.server = AsyncServer(rest.app, host='127.0.0.1', port=0,
+                                  workers=4, shutdown_timeout=5)
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.start()
+        self.addCleanup(self.thread.join)
+        self.addCleanup(self.server.stop)
+        self.assertTrue(self.server.started.wait(5))
+
+    def _connect(self):
+        host, port = self.server.address[:2]
+        return http_client.HTTPConnection(host, port, timeout=5)
+
+    def test_keep_alive(self):
+        conn = self._connect()
+        for _ in range(3):
+            conn.request("GET", "/blockade/%s" % self.name)
+            response = conn.getresponse()
+            self.assertEqual(200, response.status)
+            self.assertEqual({"containers": {}},
+                             json.loads(response.read().decode('utf-8')))
+        conn.close()
+        self.assertEqual(3, self.blockade.status.call_count)
+
+    def test_post_body(self):
+        conn = self._connect()
+        conn.request("POST", "/blockade/%s/network_state" % self.name,
+                     body='{"network_state": "slow", '
+                          '"container_names": ["c1"]}',
+                     headers={'Content-Type': 'application/json'})
+        response = conn.getresponse()
+        response.read()
+        conn.close()
+        self.assertEqual(204, response.status)
+        self.blockade.slow.assert_called_once_with(["c1"])
+
+    def test_body_too_large(self):
+        conn = self._connect()
+        conn.putrequest("POST", "/blockade/%s/network_state" % self.name)
+        conn.putheader("Content-Type", "application/json")
+        conn.putheader("Content-Length", str(1024 ** 3))
+        conn.endheaders()
+        response = conn.getresponse()
+        response.read()
+        conn.close()
+        self.assertEqual(413, response.status)
+        self.assertEqual(0, self.blockade.slow.call_count)
+
+    def test_not_found(self):
+        conn = self._connect()
+        conn.request("GET", "/nope")
+        response = conn.getresponse()
+        response.read()
+        conn.close()
+        self.assertEqual(404, response.status)
+
+    def test_graceful_shutdown(self):
+        def slow(container_names):
+            time.sleep(0.3)
+
+        self.blockade.slow.side_effect = slow
+        conn = self._connect()
+        conn.request("POST", "/blockade/%s/network_state" % self.name,
+                     body='{"network_state": "slow", '
+                          '"container_names": ["c1"]}',
+                     headers={'Content-Type': 'application/json'})
+        idle = self._connect()
+        idle.connect()
+        time.sleep(0.1)
+        self.server.stop()
+
+        # the request in progress is answered, then the server is done
+        response = conn.getresponse()
+        response.read()
+        self.assertEqual(204, response.status)
+        self.assertEqual("close", response.getheader("Connection"))
+        self.thread.join(5)
+        self.assertFalse(self.thread.is_alive())
+        conn.close()
+        idle.close()
+
+    def test_shutdown_with_follower(self):
+        auditor = audit.EventAuditor(os.path.join(self.tempdir, "b.json"))
+        self.addCleanup(auditor.clean)
+        self.blockade.get_audit.return_value = auditor
+        follower = self._connect()
+        follower.request("GET", "/blockade/%s/events?follow=1" % self.name)
+        response = follower.getresponse()
+        self.assertEqual(200, response.status)
+        auditor.log_event("SLOW", "Success", "message1", ["c1"])
+        self.assertIn(b'"message1"', response.readline())
+
+        # the follower holds no worker
+        for _ in range(8):
+            conn = self._connect()
+            conn.request("GET", "/blockade/%s" % self.name)
+            self.assertEqual(200, conn.getresponse().status)
+            conn.close()
+
+        start = time.time()
+        self.server.stop()
+        self.thread.join(5)
+        self.assertFalse(self.thread.is_alive())
+        self.assertLess(time.time() - start, 2)
+        response.read()
+        follower.close()
+
+
+if __name__ == '__main__' and sys.version_info >= (3, 5):
+    unittest.main()
@@ -15,10 +15,19 @@
 #
 import json
 import os
+import shutil
+import subprocess
+import sys
 import tempfile
+import threading
+import time
 import unittest
 
+import mock
+
 from blockade import audit
+from blockade import errors
+from blockade import timing
 
 
 class AuditTest(unittest.TestCase):
@@ -43,3 +52,391 @@ class AuditTest(unittest.TestCase):
         self.assertEqual(ctr, 3)
         a.clean()
         self.assertFalse(os.path.exists(tmpfile))
+
+    def _auditor(self, **kwargs):
+        fd, tmpfile = tempfile.mkstemp()
+        os.close(fd)
+        a = audit.EventAuditor(tmpfile, **kwargs)
+        self.addCleanup(a.clean)
+        return a, tmpfile
+
+    def test_audit_timing(self):
+        a, _ = self._auditor()
+        a.log_event("SLOW", "success", "untimed", ["c1"])
+        with timing.operation("slow"):
+            with timing.phase("docker"):
+                pass
+            a.log_event("SLOW", "success", "timed", ["c1"])
+
+        untimed, timed = list(a.read_logs(as_json=True))
+        self.assertNotIn('duration', untimed)
+        self.assertEqual(timed['timestamp'], timed['end'])
+        self.assertLessEqual(timed['start'], timed['end'])
+        self.assertGreaterEqual(timed['duration'], 0)
+        self.assertEqual(['docker'], list(timed['phases']))
+
+    def test_audit_flush(self):
+        a, tmpfile = self._auditor()
+        for i in range(100):
+            a.log_event("SLOW", "success", "message%d" % i, ["c1"])
+        a.flush()
+        with open(tmpfile) as f:
+            lines = f.readlines()
+        self.assertEqual(100, len(lines))
+        self.assertEqual("message99", json.loads(lines[-1])['message'])
+
+    def test_audit_close_all(self):
+        a, tmpfile = self._auditor()
+        a.log_event("SLOW", "success", "message1", ["c1"])
+        audit.close_all()
+        with open(tmpfile) as f:
+            self.assertEqual("message1", json.loads(f.readline())['message'])
+
+        # events logged after closing are written again
+        a.log_event("FLAKY", "success", "message2", ["c1"])
+        self.assertEqual(2, len(list(a.read_logs())))
+
+    def test_audit_shared_writer(self):
+        a, tmpfile = self._auditor()
+        b = audit.EventAuditor(tmpfile)
+        a.log_event("SLOW", "success", "message1", ["c1"])
+        b.log_event("FAST", "success", "message2", ["c1"])
+        a.log_event("FLAKY", "success", "message3", ["c1"])
+        messages = [d['message'] for d in b.read_logs(as_json=True)]
+        self.assertEqual(["message1", "message2", "message3"], messages)
+
+    def _log_from_processes(self, tmpfile, env=None, events=("ev1", "ev2"),
+                            count=200):
+        """Log count events from each of the processes at the same time"""
+        script = (
+            "import sys\n"
+            "from blockade import audit\n"
+            "a = audit.EventAuditor(sys.argv[1])\n"
+            "for i in range(int(sys.argv[3])):\n"
+            "    a.log_event(sys.argv[2], 'success', 'm%d' % i, ['c1'])\n"
+            "    a.flush()\n"
+            "a.close()\n")
+        environ = dict(os.environ, **(env or {}))
+        root = os.path.dirname(os.path.dirname(os.path.dirname(
+            os.path.abspath(audit.__file__))))
+        environ['PYTHONPATH'] = root
+        processes = [subprocess.Popen([sys.executable, "-c", script,
+                                       tmpfile, event, str(count)],
+                                      env=environ)
+                     for event in events]
+        for process in processes:
+            self.assertEqual(0, process.wait())
+
+    def test_audit_follow_skips_corrupt_line(self):
+        a, tmpfile = self._auditor()
+        stop = threading.Event()
+        followed = a.follow(as_json=True, poll_interval=0.01, stop=stop)
+        received = []
+
+        def _follow():
+            for record in followed:
+                received.append(record['message'])
+                if len(received) == 2:
+                    stop.set()
+
+        thread = threading.Thread(target=_follow)
+        thread.daemon = True
+        thread.start()
+        self.addCleanup(stop.set)
+        time.sleep(0.05)
+        a.log_event("SLOW", "success", "message1", ["c1"])
+        a.flush()
+        time.sleep(0.05)
+        with open(tmpfile, "ab") as f:
+            f.write(b'{"event": "slow", "mess\n')
+        a.log_event("FAST", "success", "message2", ["c1"])
+        thread.join(5)
+        self.assertFalse(thread.is_alive())
+        self.assertEqual(["message1", "message2"], received)
+
+    def test_audit_processes_share_file(self):
+        a, tmpfile = self._auditor()
+        self._log_from_processes(tmpfile)
+
+        records = list(a.query(events=["ev1"], as_json=True))
+        self.assertEqual(200, len(records))
+        self.assertEqual(set(["ev1"]), set(r['event'] for r in records))
+        self.assertEqual(400, len(list(a.query(containers=["c1"]))))
+
+    def test_audit_processes_share_rotation(self):
+        a, tmpfile = self._auditor()
+        self._log_from_processes(
+            tmpfile, {audit.AUDIT_SEGMENT_BYTES_ENV: "4000"})
+
+        self.assertGreater(len(audit._segments(tmpfile)), 1)
+        records = list(a.read_logs(as_json=True))
+        self.assertEqual(400, len(records))
+        for event in ("ev1", "ev2"):
+            self.assertEqual(["m%d" % i for i in range(200)],
+                             [r['message'] for r in records
+                              if r['event'] == event])
+
+    def test_audit_processes_share_age_rotation(self):
+        a, tmpdir = self._segmented_auditor(max_bytes=None, max_seconds=1,
+                                            retain=None)
+        tmpfile = os.path.join(tmpdir, "b1.json")
+        a.log_event("SLOW", "success", "message1", ["c1"])
+        a.flush()
+        time.sleep(1.1)
+        # the other process seals the old file and starts a new one
+        self._log_from_processes(
+            tmpfile, {audit.AUDIT_SEGMENT_SECONDS_ENV: "1"}, events=("ev1",),
+            count=1)
+        self.assertEqual(1, len(audit._segments(tmpfile)))
+
+        # which is not too old to write to
+        a.log_event("FAST", "success", "message2", ["c1"])
+        a.flush()
+        self.assertEqual(1, len(audit._segments(tmpfile)))
+        self.assertEqual(["message1", "m0", "message2"],
+                         [r['message'] for r in a.query(as_json=True)])
+        a.close()
+
+    def test_audit_record_not_matching_index(self):
+        a, tmpfile = self._auditor()
+        a.log_event("SLOW", "success", "message1", ["c1"])
+        a.log_event("FAST", "success", "message2", ["c1"])
+        a.close()
+        # another writer changed the file behind the back of the index
+        with open(tmpfile, "r+b") as f:
+            f.seek(2)
+            f.write(b"garbage")
+
+        records = list(a.query(events=["SLOW", "FAST"], as_json=True))
+        self.assertEqual(["message2"], [r['message'] for r in records])
+
+    def test_audit_fsync_policy(self):
+        with mock.patch("os.fsync") as mock_fsync:
+            a, tmpfile = self._auditor(fsync=audit.FSYNC_ALWAYS)
+            a.log_event("SLOW", "success", "message1", ["c1"])
+            self.assertTrue(mock_fsync.called)
+            with open(tmpfile) as f:
+                self.assertEqual(1, len(f.readlines()))
+            a.close()
+
+        with mock.patch.dict(os.environ, {audit.AUDIT_FSYNC_ENV: "sometimes"}):
+            with self.assertRaises(errors.BlockadeError):
+                audit.EventAuditor(tmpfile)
+
+    def _audit_files(self, tmpdir):
+        return sorted(f for f in os.listdir(tmpdir)
+                      if not f.endswith((".idx", ".lock")))
+
+    def _segmented_auditor(self, **kwargs):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir, ignore_errors=True)
+        tmpfile = os.path.join(tmpdir, "b1.json")
+        policy = audit.SegmentPolicy(**kwargs)
+        return audit.EventAuditor(tmpfile, segment_policy=policy), tmpdir
+
+    def test_audit_segments(self):
+        a, tmpdir = self._segmented_auditor(max_bytes=500, max_seconds=None,
+                                            retain=None)
+        for i in range(20):
+            a.log_event("SLOW", "success", "message%d" % i, ["c1"])
+            # every flush writes a batch which may rotate the file
+            a.flush()
+
+        files = self._audit_files(tmpdir)
+        self.assertIn("b1.json", files)
+        self.assertIn("b1.json.000001.gz", files)
+        self.assertTrue(all(f == "b1.json" or f.endswith(".gz")
+                            for f in files))
+
+        messages = [d['message'] for d in a.read_logs(as_json=True)]
+        self.assertEqual(["message%d" % i for i in range(20)], messages)
+
+        a.clean()
+        self.assertEqual([], os.listdir(tmpdir))
+
+    def test_audit_segment_retention(self):
+        a, tmpdir = self._segmented_auditor(max_bytes=1, max_seconds=None,
+                                            retain=2)
+        for i in range(5):
+            a.log_event("SLOW", "success", "message%d" % i, ["c1"])
+            a.flush()
+
+        self.assertEqual(["b1.json", "b1.json.000003.gz", "b1.json.000004.gz"],
+                         self._audit_files(tmpdir))
+        messages = [d['message'] for d in a.read_logs(as_json=True)]
+        self.assertEqual(["message2", "message3", "message4"], messages)
+        a.close()
+
+    def test_audit_segment_age(self):
+        a, tmpdir = self._segmented_auditor(max_bytes=None, max_seconds=60,
+                                            retain=None)
+        a.log_event("SLOW", "success", "message1", ["c1"])
+        a.flush()
+        with mock.patch("time.time", return_value=time.time() + 61):
+            a.log_event("FAST", "success", "message2", ["c1"])
+            a.flush()
+
+        self.assertEqual(["b1.json", "b1.json.000001.gz"],
+                         self._audit_files(tmpdir))
+        self.assertEqual(2, len(list(a.read_logs())))
+        a.close()
+
+    def _log_events(self, a):
+        with mock.patch("time.time") as mock_time:
+            for i, (event, targets) in enumerate([
+                    ("SLOW", ["c1"]), ("FLAKY", ["c1", "c2"]),
+                    ("PARTITION", [frozenset(["c1"]), frozenset(["c3"])]),
+                    ("PARTITION", ["c2->c3"]), ("SLOW", ["c3"]),
+                    ("STOP", ["c2"])]):
+                mock_time.return_value = 1000.0 + i
+                a.log_event(event, "Success", "message%d" % i, targets)
+                a.flush()
+
+    def _messages(self, a, **kwargs):
+        return [d['message'] for d in a.query(as_json=True, **kwargs)]
+
+    def test_audit_query(self):
+        a, tmpdir = self._segmented_auditor(max_bytes=300, max_seconds=None,
+                                            retain=None)
+        self._log_events(a)
+        self.assertIn("b1.json.000001.gz", self._audit_files(tmpdir))
+
+        self.assertEqual(["message%d" % i for i in range(6)],
+                         self._messages(a))
+        self.assertEqual(["message0", "message4"],
+                         self._messages(a, events=["slow"]))
+        self.assertEqual(["message2", "message3", "message4"],
+                         self._messages(a, containers=["c3"]))
+        self.assertEqual(["message4"],
+                         self._messages(a, events=["SLOW"], containers=["c3"]))
+        self.assertEqual(["message1", "message2", "message3"],
+                         self._messages(a, since=1001, until=1003))
+        self.assertEqual(["message3", "message5"],
+                         self._messages(a, since=1002, containers=["c2"]))
+        self.assertEqual(["message0", "message1"],
+                         self._messages(a, limit=2))
+        self.assertEqual([], self._messages(a, events=["duplicate"]))
+
+        raw = list(a.query(events=["stop"]))
+        self.assertEqual(1, len(raw))
+        self.assertEqual("message5", json.loads(raw[0])['message'])
+        a.close()
+
+    def test_audit_query_without_index(self):
+        a, tmpdir = self._segmented_auditor(max_bytes=300, max_seconds=None,
+                                            retain=None)
+        self._log_events(a)
+        a.close()
+        for name in os.listdir(tmpdir):
+            if name.endswith(".idx"):
+                os.remove(os.path.join(tmpdir, name))
+
+        self.assertEqual(["message2", "message3", "message4"],
+                         self._messages(a, containers=["c3"]))
+        # sealed segments got their index back
+        self.assertIn("b1.json.000001.idx", os.listdir(tmpdir))
+
+        # and the writer indexes the active file again
+        a.log_event("SLOW", "Success", "message6", ["c3"])
+        a.flush()
+        self.assertIn("b1.json.idx", os.listdir(tmpdir))
+        self.assertEqual(["message2", "message3", "message4", "message6"],
+                         self._messages(a, containers=["c3"]))
+        a.close()
+
+    def test_parse_time(self):
+        self.assertEqual(1000.5, audit.parse_time("1000.5"))
+        self.assertEqual(time.mktime((2017, 3, 1, 12, 30, 0, 0, 0, -1)),
+                         audit.parse_time("2017-03-01T12:30:00"))
+        self.assertEqual(time.mktime((2017, 3, 1, 0, 0, 0, 0, 0, -1)),
+                         audit.parse_time("2017-03-01"))
+        with self.assertRaises(errors.BlockadeUsageError):
+            audit.parse_time("yesterday")
+
+    def test_audit_tail(self):
+        a, tmpdir = self._segmented_auditor(max_bytes=300, max_seconds=None,
+                                            retain=None)
+        self._log_events(a)
+
+        def _tail(**kwargs):
+            return [d['message'] for d in a.read_logs(as_json=True, **kwargs)]
+
+        self.assertEqual(["message%d" % i for i in range(5, -1, -1)],
+                         _tail(reverse=True))
+        self.assertEqual(["message4", "message5"], _tail(last=2))
+        self.assertEqual(["message5", "message4", "message3"],
+                         _tail(last=3, reverse=True))
+        # reaching back into sealed segments
+        self.assertEqual(["message%d" % i for i in range(1, 6)], _tail(last=5))
+        self.assertEqual(["message%d" % i for i in range(6)], _tail(last=100))
+        self.assertEqual([], _tail(last=0))
+
+        lines = list(a.read_logs(last=1))
+        self.assertEqual("message5", json.loads(lines[0])['message'])
+
+        self.assertEqual(["message3", "message5"],
+                         self._messages(a, containers=["c2"], last=2))
+        self.assertEqual(["message5"], self._messages(a, last=1))
+        a.close()
+
+    def test_audit_tail_empty(self):
+        a, tmpfile = self._auditor()
+        self.assertEqual([], list(a.read_logs(last=10)))
+        self.assertEqual([], list(a.read_logs(reverse=True)))
+
+    def test_audit_subscribe(self):
+        a, tmpfile = self._auditor()
+        other = audit.EventAuditor(tmpfile)
+        a.log_event("SLOW", "success", "before", ["c1"])
+
+        with a.subscribe() as everything, \
+                a.subscribe(events=["flaky"], containers=["c2"]) as filtered:
+            other.log_event("FLAKY", "success", "message1", ["c1"])
+            other.log_event("FLAKY", "success", "message2", ["c1", "c2"])
+            self.assertEqual("message1", everything.get(timeout=1)['message'])
+            self.assertEqual(["message2"],
+                             [r['message'] for r in everything.poll()])
+            self.assertEqual(["message2"],
+                             [r['message'] for r in filtered.poll()])
+            self.assertEqual([], everything.poll())
+
+        a.log_event("SLOW", "success", "after", ["c1"])
+        self.assertEqual([], everything.poll())
+
+    def test_audit_subscription_overflow(self):
+        a, tmpfile = self._auditor()
+        with a.subscribe(queue_size=2) as sub:
+            for i in range(5):
+                a.log_event("SLOW", "success", "message%d" % i, ["c1"])
+            self.assertEqual(["message0", "message1"],
+                             [r['message'] for r in sub.poll()])
+            self.assertEqual(3, sub.missed)
+
+    def test_audit_follow(self):
+        a, tmpdir = self._segmented_auditor(max_bytes=300, max_seconds=None,
+                                            retain=None)
+        a.log_event("SLOW", "success", "before", ["c1"])
+        stop = threading.Event()
+        followed = a.follow(containers=["c2", "c3"], as_json=True,
+                            poll_interval=0.01, stop=stop)
+        received = []
+
+        def _follow():
+            for record in followed:
+                received.append(record['message'])
+                if len(received) == 5:
+                    stop.set()
+
+        thread = threading.Thread(target=_follow)
+        thread.daemon = True
+        thread.start()
+        self.addCleanup(stop.set)
+        time.sleep(0.05)
+        self._log_events(a)
+        thread.join(5)
+        self.assertFalse(thread.is_alive())
+        # followed across rotations of the audit file
+        self.assertIn("b1.json.000001.gz", self._audit_files(tmpdir))
+        self.assertEqual(["message1", "message2", "message3", "message4",
+                          "message5"], received)
+        a.close()
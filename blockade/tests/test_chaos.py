@@ -63,6 +63,27 @@ class ChaosTest(unittest.TestCase):
         with self.assertRaises(errors.BlockadeUsageError):
             self.chaos.delete(name)
 
+    def test_degraded_seconds(self):
+        name = "aname"
+        block_mock = MagicMock()
+        block_mock.status.return_value = [FakeContainers('c1')]
+        self.chaos.new_chaos(
+                block_mock, name,
+                min_start_delay=1,
+                max_start_delay=1,
+                min_run_time=10000,
+                max_run_time=10000,
+                event_set=["SLOW"])
+        self.assertEqual(0, self.chaos.degraded_seconds(name))
+        time.sleep(0.3)
+        self.assertEqual('DEGRADED', self.chaos.status(name)['state'])
+        self.chaos.stop(name)
+        degraded = self.chaos.degraded_seconds(name)
+        self.assertGreater(degraded, 0.1)
+        time.sleep(0.1)
+        self.assertEqual(degraded, self.chaos.degraded_seconds(name))
+        self.assertEqual([name], self.chaos.names())
+
     def _specific_event_called(self, func_name, event_name):
         name = "aname"
         block_mock = MagicMock()
@@ -87,6 +108,9 @@ class ChaosTest(unittest.TestCase):
     def test_timers_and_duplicate_fired(self):
         self._specific_event_called('duplicate', 'DUPLICATE')
 
+    def test_timers_and_throttle_fired(self):
+        self._specific_event_called('throttle', 'THROTTLE')
+
     def test_timers_and_flaky_fired(self):
         self._specific_event_called('flaky', 'FLAKY')
 
@@ -96,6 +120,40 @@ class ChaosTest(unittest.TestCase):
     def test_timers_and_stop_fired(self):
         self._specific_event_called('stop', 'STOP')
 
+    def test_resume_degraded(self):
+        name = "aname"
+        block_mock = MagicMock()
+        block_mock.status.return_value = [FakeContainers('c1')]
+        states = []
+        self.chaos.new_chaos(
+                block_mock, name,
+                min_start_delay=1000000,
+                max_start_delay=1000000,
+                min_run_time=1,
+                max_run_time=1,
+                event_set=["SLOW"],
+                state=chaos.ChaosStates.DEGRADED,
+                state_listener=states.append)
+        time.sleep(0.3)
+
+        # the containers left degraded are relieved
+        self.assertEqual('HEALTHY', self.chaos.status(name)['state'])
+        self.assertEqual(['HEALTHY'], states)
+        block_mock.fast.assert_called_once_with(['c1'])
+        block_mock.join.assert_called_once_with()
+        self.assertFalse(block_mock.slow.called)
+        self.assertGreater(self.chaos.degraded_seconds(name), 0)
+
+    def test_resume_stopped(self):
+        name = "aname"
+        block_mock = MagicMock()
+        self.chaos.new_chaos(block_mock, name,
+                             state=chaos.ChaosStates.STOPPED)
+        self.assertEqual('STOPPED', self.chaos.status(name)['state'])
+        self.chaos.delete(name)
+        self.assertFalse(self.chaos.exists(name))
+        self.assertEqual([], block_mock.method_calls)
+
     def test_update_event_called(self):
         name = "aname"
         block_mock = MagicMock()
@@ -14,12 +14,15 @@
 # limitations under the License.
 #
 
+import json
 import os
 import tempfile
 import shutil
+import mock
 from textwrap import dedent
 
 from blockade import cli
+from blockade import timing
 from blockade.tests import unittest
 from blockade.errors import BlockadeError
 
@@ -30,6 +33,32 @@ class CommandLineTests(unittest.TestCase):
         # just make sure we don't have any typos for now
         cli.setup_parser()
 
+    def test_workers(self):
+        parser = cli.setup_parser()
+        opts = parser.parse_args(["--workers", "4", "version"])
+        self.assertEqual(4, opts.workers)
+        for value in ("0", "-1", "many"):
+            with mock.patch("sys.stderr"):
+                with self.assertRaises(SystemExit):
+                    parser.parse_args(["--workers", value, "version"])
+
+    def test_trace(self):
+        tempdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tempdir)
+        path = os.path.join(tempdir, "trace.json")
+        opts = cli.setup_parser().parse_args(["--trace", path, "version"])
+
+        def cmd_version(opts):
+            with timing.phase(timing.DOCKER, call="version"):
+                pass
+        opts.func = cmd_version
+        cli._run_command(opts)
+
+        with open(path) as f:
+            events = json.load(f)["traceEvents"]
+        self.assertEqual(["docker", "version"],
+                         sorted(e["name"] for e in events if e["ph"] == "X"))
+
 
 class ConfigFilePathTests(unittest.TestCase):
     tempdir = None
@@ -50,6 +50,7 @@ class ConfigTests(unittest.TestCase):
         self.assertEqual(config.network['flaky'], "61%")
         # default value should be there
         self.assertIn("slow", config.network)
+        self.assertIn("throttle", config.network)
 
     def test_parse_with_volumes_1(self):
         containers = {
@@ -14,12 +14,18 @@
 # limitations under the License.
 #
 import os
+import threading
+import time
 
 import mock
 
 from blockade.tests import unittest
 from blockade.core import Blockade, Container, ContainerStatus, expand_partitions
+from blockade.core import expand_edges
 from blockade.errors import BlockadeError
+from blockade.errors import BlockadeUsageError
+from blockade.errors import TrafficControlError
+from blockade import timing
 from blockade.config import BlockadeContainerConfig, BlockadeConfig
 
 
@@ -54,10 +60,12 @@ class BlockadeCoreTests(unittest.TestCase):
                      network=self.network,
                      docker_client=self.docker_client)
 
-        b.create()
+        progress = mock.Mock()
+        b.create(progress=progress)
 
         self.assertEqual(self.state.initialize.call_count, 1)
         self.assertEqual(self.docker_client.create_container.call_count, 3)
+        self.assertEqual(mock.call(3, 3, "Started 'c3'"), progress.call_args)
 
     def test_expand_partitions(self):
         def normal(name):
@@ -80,6 +88,242 @@ class BlockadeCoreTests(unittest.TestCase):
         with self.assertRaisesRegexp(BlockadeError, "holy"):
             expand_partitions(containers, [["c1"], ["c2", "c6"]])
 
+    def test_expand_edges(self):
+        containers = [Container(name, 'id-'+name, ContainerStatus.UP)
+                      for name in ["c1", "c2", "c3"]]
+        containers.append(Container('c4', 'id-c4', ContainerStatus.UP, holy=True))
+
+        edges = expand_edges(containers, [["c1", "c2"], ("c2", "c1"),
+                                          ["c1", "c2"]])
+        self.assertEqual([("c1", "c2"), ("c2", "c1")], edges)
+
+        with self.assertRaisesRegexp(BlockadeError, "unknown"):
+            expand_edges(containers, [["c1", "c100"]])
+
+        with self.assertRaisesRegexp(BlockadeError, "holy"):
+            expand_edges(containers, [["c4", "c1"]])
+
+        with self.assertRaisesRegexp(BlockadeError, "differ"):
+            expand_edges(containers, [["c1", "c1"]])
+
+        with self.assertRaisesRegexp(BlockadeError, "source"):
+            expand_edges(containers, [["c1", "c2", "c3"]])
+
+    def test_impair_links(self):
+        containers = [Container(name, 'id-'+name, ContainerStatus.UP,
+                                ip_address=ip)
+                      for name, ip in [("c1", "10.0.1.1"), ("c2", "10.0.1.2"),
+                                       ("c3", "10.0.1.3")]]
+        self.network.get_container_device.side_effect = lambda dc, y: "veth"+y
+
+        b = Blockade(BlockadeConfig(),
+                     state=self.state,
+                     network=self.network,
+                     docker_client=self.docker_client)
+
+        with mock.patch.object(b, '_get_running_containers',
+                               return_value=containers):
+            b.impair_links({"c1": {"c2": "delay 20ms", "c3": "slow"},
+                            "c3": {"c2": "delay 5ms"}})
+
+        # one call per destination container
+        self.assertEqual([
+            mock.call("vethid-c2", {"10.0.1.1": "delay 20ms",
+                                    "10.0.1.3": "delay 5ms"}),
+            mock.call("vethid-c3", {"10.0.1.1": "slow"}),
+        ], self.network.impair_peers.call_args_list)
+
+    def test_impair_links_not_string(self):
+        b = self._running_blockade(["c1", "c2"])
+
+        with self.assertRaisesRegexp(BlockadeUsageError, "c1->c2"):
+            b.impair_links({"c1": {"c2": 20}})
+        self.assertEqual(0, self.network.impair_peers.call_count)
+
+    def _running_blockade(self, names, **kwargs):
+        containers = [Container(name, 'id-'+name, ContainerStatus.UP)
+                      for name in names]
+        b = Blockade(BlockadeConfig(),
+                     state=self.state,
+                     network=self.network,
+                     docker_client=self.docker_client,
+                     **kwargs)
+        b._audit = mock.Mock()
+        patcher = mock.patch.object(b, '_get_running_containers',
+                                    return_value=containers)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        return b
+
+    def test_restart_concurrently(self):
+        names = ["c%d" % i for i in range(8)]
+        lock = threading.Lock()
+        running = [0, 0]
+
+        def stop(container_id, timeout):
+            with lock:
+                running[0] += 1
+                running[1] = max(running)
+            time.sleep(0.05)
+            with lock:
+                running[0] -= 1
+
+        self.docker_client.stop.side_effect = stop
+        self.state.container_id.side_effect = lambda name: 'id-' + name
+        b = self._running_blockade(names, max_workers=4)
+
+        self.assertEqual(names, b.restart(names))
+        self.assertEqual(8, self.docker_client.start.call_count)
+        self.assertEqual(4, running[1])
+
+    def test_kill_failures_are_aggregated(self):
+        def kill(container_id, signal):
+            if container_id in ('id-c2', 'id-c3'):
+                raise Exception("no such container " + container_id)
+
+        self.docker_client.kill.side_effect = kill
+        b = self._running_blockade(["c1", "c2", "c3"])
+
+        with self.assertRaisesRegexp(BlockadeError, "c2.*c3"):
+            b.kill(["c1", "c2", "c3"])
+
+        # all containers were attempted
+        self.assertEqual(3, self.docker_client.kill.call_count)
+
+        args, kwargs = b._audit.log_event.call_args
+        self.assertEqual(('kill', 'Failed'), args[:2])
+        self.assertEqual({"c1": "Success",
+                          "c2": "no such container id-c2",
+                          "c3": "no such container id-c3"},
+                         kwargs['results'])
+
+    def test_kill_is_timed(self):
+        operations = []
+
+        def kill(container_id, signal):
+            operations.append(timing.current())
+            time.sleep(0.01)
+
+        self.docker_client.kill.side_effect = kill
+        b = self._running_blockade(["c1", "c2"])
+        b._audit.log_event.side_effect = \
+            lambda *args, **kwargs: operations.append(timing.current())
+        b.kill(["c1", "c2"])
+
+        op = operations[0]
+        self.assertEqual("kill", op.name)
+        self.assertEqual([op] * 3, operations)
+        self.assertGreaterEqual(op.phases["docker"], 0.02)
+
+    def test_single_failure_is_reraised(self):
+        self.docker_client.stop.side_effect = ValueError("boom")
+        b = self._running_blockade(["c1"])
+        with mock.patch.object(b, '_get_created_containers',
+                               b._get_running_containers):
+            with self.assertRaises(ValueError):
+                b.stop(["c1"])
+
+    def test_slow_applies_all_devices_at_once(self):
+        self.network.get_container_device.side_effect = lambda dc, y: "veth"+y
+        self.network.slow.__name__ = "slow"
+        b = self._running_blockade(["c1", "c2", "c3"])
+
+        b.slow(["c1", "c2", "c3"])
+
+        self.network.slow.assert_called_once_with(
+            "vethid-c1", "vethid-c2", "vethid-c3")
+
+    def _batch_blockade(self, names):
+        containers = [Container(name, 'id-'+name, ContainerStatus.UP,
+                                device='veth-'+name, ip_address='10.0.0.%d' % i)
+                      for i, name in enumerate(names)]
+        self.network.qdisc.side_effect = lambda state: [state]
+        self.state.blockade_id = self.blockade_id
+        self.state.container_id.side_effect = lambda name: 'id-' + name
+        b = Blockade(BlockadeConfig(),
+                     state=self.state,
+                     network=self.network,
+                     docker_client=self.docker_client)
+        b._audit = mock.Mock()
+        discover = mock.patch.object(b, '_get_all_containers',
+                                     return_value=containers)
+        describe = mock.patch.object(
+            b, '_get_container_description',
+            side_effect=lambda name: Container(name, 'id-'+name,
+                                               ContainerStatus.DOWN))
+        for patcher in (discover, describe):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        return b
+
+    def test_batch(self):
+        b = self._batch_blockade(["c1", "c2", "c3", "c4"])
+
+        outcomes = b.batch([
+            {"action": "stop", "container_names": ["c1"]},
+            {"network_state": "slow", "container_names": ["c2", "c3"]},
+            {"network_state": "duplicate", "container_names": ["c4"]},
+            {"partitions": [["c2"], ["c3", "c4"]]},
+        ])
+
+        self.assertEqual(["Success"] * 4, [o['status'] for o in outcomes])
+        self.assertEqual(["c2", "c3"], outcomes[1]['targets'])
+        self.assertEqual(1, b._get_all_containers.call_count)
+        b._get_container_description.assert_called_once_with("c1")
+        self.docker_client.stop.assert_called_once_with('id-c1', timeout=3)
+
+        # both network states are applied at once
+        self.network.apply.assert_called_once_with(
+            {"veth-c2": ["slow"], "veth-c3": ["slow"],
+             "veth-c4": ["duplicate"]})
+        self.assertEqual(1, self.network.partition_containers.call_count)
+
+        events = [c[0][:2] for c in b._audit.log_event.call_args_list]
+        self.assertEqual([("stop", "Success"), ("slow", "Success"),
+                          ("duplicate", "Success"), ("partition", "Success")],
+                         events)
+
+    def test_batch_stops_at_failure(self):
+        self.network.apply.side_effect = TrafficControlError(
+            "tc failed", {"veth-c2": "RTNETLINK answers: No such device"})
+        b = self._batch_blockade(["c1", "c2"])
+
+        outcomes = b.batch([
+            {"network_state": "flaky", "container_names": ["c1", "c2"]},
+            {"action": "join"},
+        ])
+
+        self.assertEqual(["Failed", "Skipped"],
+                         [o['status'] for o in outcomes])
+        self.assertEqual({"c1": "Success",
+                          "c2": "RTNETLINK answers: No such device"},
+                         outcomes[0]['results'])
+        self.assertFalse(self.network.restore.called)
+        self.assertEqual(1, b._audit.log_event.call_count)
+
+    def test_batch_unknown_container(self):
+        b = self._batch_blockade(["c1"])
+
+        outcomes = b.batch([
+            {"network_state": "fast", "container_names": ["c1"]},
+            {"network_state": "slow", "container_names": ["c9"]},
+        ])
+
+        self.assertEqual(["Success", "Failed"],
+                         [o['status'] for o in outcomes])
+        self.network.apply.assert_called_once_with({"veth-c1": ["fast"]})
+
+    def test_batch_validation(self):
+        b = self._batch_blockade(["c1"])
+        for step in ({"action": "pause", "container_names": ["c1"]},
+                     {"network_state": "slow"},
+                     {"action": "stop", "network_state": "slow",
+                      "container_names": ["c1"]},
+                     {"partitions": ["c1"]}):
+            with self.assertRaises(BlockadeUsageError):
+                b.batch([{"action": "join"}, step])
+        self.assertFalse(self.network.restore.called)
+
     def assert_partitions(self, partitions1, partitions2):
         setofsets1 = frozenset(frozenset(n) for n in partitions1)
         setofsets2 = frozenset(frozenset(n) for n in partitions2)
@@ -0,0 +1,90 @@
+#
+#  Copyright (C) 2016 Dell, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+import threading
+import time
+
+from blockade.api.jobs import JobRunner
+from blockade.api.jobs import JobStatus
+from blockade.tests import unittest
+
+
+class JobRunnerTests(unittest.TestCase):
+
+    def setUp(self):
+        self.runner = JobRunner(max_workers=2, max_finished=2)
+        self.addCleanup(self.runner.close)
+
+    def test_job_result(self):
+        def work(job):
+            job.progress(1, 2, "half way")
+            return "done"
+
+        job = self.runner.submit("b1", "create", work)
+        self.assertIs(job, self.runner.get(job.id))
+        self.runner.close()
+
+        self.assertEqual(JobStatus.SUCCEEDED, job.status)
+        d = job.to_dict()
+        self.assertEqual("done", d['result'])
+        self.assertEqual("[1/2] half way", d['progress'])
+        self.assertLessEqual(d['created'], d['started'])
+        self.assertLessEqual(d['started'], d['finished'])
+
+    def test_job_failure(self):
+        def work(job):
+            raise ValueError("boom")
+
+        job = self.runner.submit("b1", "destroy", work)
+        self.runner.close()
+        self.assertEqual(JobStatus.FAILED, job.status)
+        self.assertEqual("boom", job.error)
+
+    def test_bounded_workers(self):
+        running = [0, 0]
+        lock = threading.Lock()
+        release = threading.Event()
+
+        def work(job):
+            with lock:
+                running[0] += 1
+                running[1] = max(running)
+            release.wait(5)
+            with lock:
+                running[0] -= 1
+
+        jobs = [self.runner.submit("b%d" % i, "create", work)
+                for i in range(5)]
+        for _ in range(500):
+            if running[0] == 2:
+                break
+            time.sleep(0.01)
+        # give a third job the chance to start if it could
+        time.sleep(0.05)
+        release.set()
+        self.runner.close()
+
+        self.assertEqual(2, running[1])
+        self.assertTrue(all(job.status == JobStatus.SUCCEEDED for job in jobs))
+
+    def test_finished_jobs_expire(self):
+        jobs = [self.runner.submit("b1", "create", lambda job: None)
+                for _ in range(3)]
+        self.runner.close()
+        self.runner.submit("b1", "create", lambda job: None)
+
+        self.assertIsNone(self.runner.get(jobs[0].id))
+        self.assertIsNotNone(self.runner.get(jobs[2].id))
@@ -0,0 +1,128 @@
+#
+#  Copyright (C) 2016 Dell, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+
+import mock
+
+from blockade import timing
+from blockade.api import metrics
+from blockade.api.manager import BlockadeManager
+from blockade.api.rest import app
+from blockade.host import command_tool
+from blockade.net import _TC_BATCH_SCRIPT
+from blockade.tests import unittest
+
+
+class MetricsTests(unittest.TestCase):
+
+    def test_histogram(self):
+        h = metrics.Histogram("test_seconds", "Test", labels=("call",),
+                              buckets=(0.1, 1.0))
+        h.observe(0.05, call="start")
+        h.observe(0.1, call="start")
+        h.observe(5, call="start")
+
+        self.assertEqual([
+            '# HELP test_seconds Test',
+            '# TYPE test_seconds histogram',
+            'test_seconds_bucket{call="start",le="0.1"} 2',
+            'test_seconds_bucket{call="start",le="1.0"} 2',
+            'test_seconds_bucket{call="start",le="+Inf"} 3',
+            'test_seconds_sum{call="start"} 5.15',
+            'test_seconds_count{call="start"} 3',
+        ], h.render())
+
+    def test_gauge(self):
+        gauge = metrics.Gauge("test_gauge", "Test", labels=("blockade",))
+        gauge.set_all([({"blockade": 'a"b'}, 3)])
+        gauge.set_all([({"blockade": 'c'}, 1.5)])
+        self.assertEqual(['test_gauge{blockade="c"} 1.5'], gauge.render()[2:])
+
+    def test_spans(self):
+        metrics.install()
+        with timing.operation("slow"):
+            with timing.phase(timing.HOST, tool="tc"):
+                pass
+            client = timing.TimedProxy(mock.Mock(), timing.DOCKER)
+            client.inspect_container("c1")
+
+        text = metrics.REGISTRY.render()
+        self.assertIn(
+            'blockade_operation_duration_seconds_count{operation="slow"}',
+            text)
+        self.assertIn(
+            'blockade_host_command_duration_seconds_count{tool="tc"}', text)
+        self.assertIn('blockade_docker_call_duration_seconds_count'
+                      '{call="inspect_container"}', text)
+
+    def test_import_does_not_collect(self):
+        # commands import the REST API too, only the daemon collects
+        root = os.path.dirname(os.path.dirname(os.path.dirname(
+            os.path.abspath(metrics.__file__))))
+        output = subprocess.check_output(
+            [sys.executable, "-c",
+             "from blockade.api import rest\n"
+             "from blockade import timing\n"
+             "print(len(timing._listeners))\n"],
+            env=dict(os.environ, PYTHONPATH=root))
+        self.assertEqual(b"0", output.strip())
+
+    def test_command_tool(self):
+        self.assertEqual("tc", command_tool(
+            ["sh", "-c", _TC_BATCH_SCRIPT, "tc", "qdisc del dev eth0 root"]))
+        self.assertEqual("iptables", command_tool(["iptables", "-n", "-L"]))
+        self.assertEqual("ip", command_tool("ip link"))
+        self.assertEqual("hostname", command_tool(["hostname"]))
+
+
+class MetricsRestTests(unittest.TestCase):
+
+    def setUp(self):
+        self.client = app.test_client()
+        self.tempdir = tempfile.mkdtemp()
+        BlockadeManager.set_data_dir(self.tempdir)
+
+    def tearDown(self):
+        BlockadeManager.close_store()
+        shutil.rmtree(self.tempdir, ignore_errors=True)
+
+    def test_metrics(self):
+        BlockadeManager.get_store().put_config("b1", {})
+        BlockadeManager.get_store().put_containers("b1", {"c1": {}, "c2": {}})
+        self.client.get('/blockade')
+
+        with mock.patch('blockade.api.rest._chaos') as chaos:
+            chaos.names.return_value = ["b1"]
+            chaos.status.return_value = {"state": "DEGRADED"}
+            chaos.degraded_seconds.return_value = 12.5
+            result = self.client.get('/metrics')
+
+        self.assertEqual(200, result.status_code)
+        self.assertTrue(result.headers['Content-Type'].startswith(
+            "text/plain; version=0.0.4"))
+        text = result.get_data(as_text=True)
+        self.assertIn('blockade_http_request_duration_seconds_count'
+                      '{route="/blockade",method="GET",status="200"} ', text)
+        self.assertIn(
+            'blockade_chaos_state{blockade="b1",state="DEGRADED"} 1\n', text)
+        self.assertIn('blockade_chaos_degraded_seconds{blockade="b1"} 12.5\n',
+                      text)
+        self.assertIn('blockade_containers{blockade="b1"} 2\n', text)
@@ -14,6 +14,7 @@
 # limitations under the License.
 #
 
+import collections
 import shlex
 
 import mock
@@ -23,11 +24,19 @@ from blockade.net import NetworkState
 from blockade.net import parse_partition_index
 from blockade.net import partition_chain_name
 from blockade.tests import unittest
+from blockade.errors import BlockadeError
 from blockade.errors import HostExecError
+from blockade.errors import TrafficControlError
 
 NORMAL_QDISC_SHOW = "qdisc pfifo_fast 0: root refcnt 2 bands 3 priomap\n"
 SLOW_QDISC_SHOW = "qdisc netem 8011: root refcnt 2 limit 1000 delay 50.0ms\n"
 FLAKY_QDISC_SHOW = "qdisc netem 8011: root refcnt 2 limit 1000 loss 50%\n"
+THROTTLE_QDISC_SHOW = ("qdisc tbf 8012: root refcnt 2 rate 1Mbit burst 4Kb "
+                       "lat 400.0ms\n")
+IMPAIRED_QDISC_SHOW = (
+    "qdisc prio 1: root refcnt 2 bands 5 priomap 1 2 2 2 1 2 0 0 1 1 1 1 1 "
+    "1 1 1\n"
+    "qdisc netem 8013: parent 1:4 limit 1000 delay 20.0ms\n")
 
 QDISC_DEL_NOENT = "RTNETLINK answers: No such file or directory"
 
@@ -286,6 +295,93 @@ class NetTests(unittest.TestCase):
                 "iptables -I blockade-e5dcf85cd2-p2 -d 10.0.1.2 -j DROP")),
         ], any_order=True)
 
+    def _partition_host_exec(self):
+        def iptables(args):
+            if args == ["iptables", "-n", "-L"]:
+                return _IPTABLES_LIST_2
+            if args == ["iptables", "-n", "-L", "FORWARD"]:
+                return _IPTABLES_LIST_FORWARD_2
+            return ""
+
+        mock_host_exec = mock.Mock()
+        mock_host_exec.run.side_effect = iptables
+        return mock_host_exec
+
+    def _rule_calls(self, mock_run):
+        return [c for c in mock_run.call_args_list
+                if c[0][0][:2] in (["iptables", "-N"], ["iptables", "-I"])]
+
+    def test_partition_one_way(self):
+        blockade_id = "e5dcf85cd2"
+        mock_host_exec = self._partition_host_exec()
+        mock_run = mock_host_exec.run
+        net = BlockadeNetwork(None, mock_host_exec)
+
+        c1 = mock.Mock(ip_address="10.0.1.1")
+        c2 = mock.Mock(ip_address="10.0.1.2")
+        c3 = mock.Mock(ip_address="10.0.1.3")
+        net.partition_containers(blockade_id, [[c1, c2, c3]],
+                                 edges=[(c1, c2), (c1, c3)])
+
+        # only c1 gets a chain: c2 and c3 may still send to c1
+        self.assertEqual([
+            mock.call(shlex.split("iptables -N blockade-e5dcf85cd2-p1")),
+            mock.call(shlex.split(
+                "iptables -I FORWARD -s 10.0.1.1 -j blockade-e5dcf85cd2-p1")),
+            mock.call(shlex.split(
+                "iptables -I blockade-e5dcf85cd2-p1 -d 10.0.1.2 -j DROP")),
+            mock.call(shlex.split(
+                "iptables -I blockade-e5dcf85cd2-p1 -d 10.0.1.3 -j DROP")),
+        ], self._rule_calls(mock_run))
+
+    def test_partition_one_way_shares_chains(self):
+        blockade_id = "e5dcf85cd2"
+        mock_host_exec = self._partition_host_exec()
+        mock_run = mock_host_exec.run
+        net = BlockadeNetwork(None, mock_host_exec)
+
+        c1, c2, c3, c4 = [mock.Mock(ip_address="10.0.1.%d" % i)
+                          for i in range(1, 5)]
+
+        # c1 and c2 cannot reach c3 and c4 but still receive from them
+        net.partition_containers(blockade_id, [[c1, c2, c3, c4]], edges=[
+            (c1, c3), (c1, c4), (c2, c3), (c2, c4)])
+        one_way = self._rule_calls(mock_run)
+
+        mock_run.reset_mock()
+        net.partition_containers(blockade_id, [[c1, c2], [c3, c4]])
+        symmetric = self._rule_calls(mock_run)
+
+        # one chain, two FORWARD and two DROP rules vs. twice as many
+        self.assertEqual(5, len(one_way))
+        self.assertEqual(10, len(symmetric))
+
+    def test_partition_mixed_with_edges(self):
+        blockade_id = "e5dcf85cd2"
+        mock_host_exec = self._partition_host_exec()
+        mock_run = mock_host_exec.run
+        net = BlockadeNetwork(None, mock_host_exec)
+
+        c1, c2, c3 = [mock.Mock(ip_address="10.0.1.%d" % i)
+                      for i in range(1, 4)]
+        net.partition_containers(blockade_id, [[c1], [c2, c3]],
+                                 edges=[(c2, c3)])
+
+        mock_run.assert_has_calls([
+            mock.call(shlex.split(
+                "iptables -I FORWARD -s 10.0.1.1 -j blockade-e5dcf85cd2-p1")),
+            mock.call(shlex.split(
+                "iptables -I FORWARD -s 10.0.1.2 -j blockade-e5dcf85cd2-p2")),
+            mock.call(shlex.split(
+                "iptables -I FORWARD -s 10.0.1.3 -j blockade-e5dcf85cd2-p3")),
+            mock.call(shlex.split(
+                "iptables -I blockade-e5dcf85cd2-p2 -d 10.0.1.3 -j DROP")),
+        ], any_order=True)
+        self.assertNotIn(
+            mock.call(shlex.split(
+                "iptables -I blockade-e5dcf85cd2-p3 -d 10.0.1.2 -j DROP")),
+            mock_run.call_args_list)
+
     def test_network_already_normal(self):
         mock_host_exec = mock.Mock()
         mock_run = mock_host_exec.run
@@ -333,6 +429,138 @@ class NetTests(unittest.TestCase):
                "root", "netem", "duplicate"] + duplicate_config.split()
         mock_run.assert_called_once_with(cmd)
 
+    def test_impair_peers(self):
+        mock_host_exec = mock.Mock()
+        mock_run = mock_host_exec.run
+        mock_config = mock.Mock()
+        mock_config.network = {"slow": "75ms 100ms distribution normal"}
+        net = BlockadeNetwork(mock_config, mock_host_exec)
+
+        net.impair_peers("mydevice", collections.OrderedDict([
+            ("10.0.1.2", "delay 20ms"),
+            ("10.0.1.3", "slow"),
+            ("10.0.1.4", "delay 20ms")]))
+
+        # the whole tree is built with a single host command
+        mock_run.assert_called_once()
+        cmd = mock_run.call_args[0][0]
+        self.assertEqual(["sh", "-c"], cmd[:2])
+        self.assertIn("tc -force -batch -", cmd[2])
+        self.assertEqual([
+            "qdisc del dev mydevice root",
+            "qdisc add dev mydevice root handle 1: prio bands 5",
+            "qdisc add dev mydevice parent 1:4 netem delay 20ms",
+            "filter add dev mydevice parent 1: protocol ip prio 1 u32 "
+            "match ip src 10.0.1.2/32 flowid 1:4",
+            "filter add dev mydevice parent 1: protocol ip prio 1 u32 "
+            "match ip src 10.0.1.4/32 flowid 1:4",
+            "qdisc add dev mydevice parent 1:5 netem delay 75ms 100ms "
+            "distribution normal",
+            "filter add dev mydevice parent 1: protocol ip prio 1 u32 "
+            "match ip src 10.0.1.3/32 flowid 1:5",
+        ], cmd[4:])
+
+    def test_impair_peers_without_root_qdisc(self):
+        mock_host_exec = mock.Mock()
+        mock_host_exec.run.side_effect = HostExecError(
+            "", exit_code=1,
+            output=QDISC_DEL_NOENT + "\nCommand failed -:1\n")
+        net = BlockadeNetwork(mock.Mock(), mock_host_exec)
+
+        # failing to delete a missing root qdisc is expected
+        net.impair_peers("mydevice", {"10.0.1.2": "delay 20ms"})
+
+    def test_impair_peers_failure(self):
+        mock_host_exec = mock.Mock()
+        mock_host_exec.run.side_effect = HostExecError(
+            "", exit_code=1,
+            output="Illegal \"match\"\nCommand failed -:4\n")
+        net = BlockadeNetwork(mock.Mock(), mock_host_exec)
+
+        with self.assertRaisesRegexp(HostExecError, "Illegal"):
+            net.impair_peers("mydevice", {"10.0.1.2": "delay 20ms"})
+
+    def test_impair_peers_too_many(self):
+        mock_host_exec = mock.Mock()
+        net = BlockadeNetwork(mock.Mock(), mock_host_exec)
+        peers = dict(("10.0.1.%d" % i, "delay %dms" % i) for i in range(14))
+
+        with self.assertRaises(BlockadeError):
+            net.impair_peers("mydevice", peers)
+        self.assertEqual(0, mock_host_exec.run.call_count)
+
+    def test_slow_many_devices(self):
+        slow_config = "75ms 100ms distribution normal"
+        mock_host_exec = mock.Mock()
+        mock_run = mock_host_exec.run
+        mock_config = mock.Mock()
+        mock_config.network = {"slow": slow_config}
+        net = BlockadeNetwork(mock_config, mock_host_exec)
+        net.slow("dev1", "dev2", "dev3")
+
+        mock_run.assert_called_once()
+        self.assertEqual([
+            "qdisc replace dev dev1 root netem delay " + slow_config,
+            "qdisc replace dev dev2 root netem delay " + slow_config,
+            "qdisc replace dev dev3 root netem delay " + slow_config,
+        ], mock_run.call_args[0][0][4:])
+
+    def test_fast_many_devices(self):
+        mock_host_exec = mock.Mock()
+        mock_run = mock_host_exec.run
+        mock_run.side_effect = HostExecError(
+            "", exit_code=1,
+            output=QDISC_DEL_NOENT + "\nCommand failed -:2\n")
+        net = BlockadeNetwork(None, mock_host_exec)
+
+        # devices which are already normal are no error
+        net.fast("dev1", "dev2")
+        self.assertEqual([
+            "qdisc del dev dev1 root",
+            "qdisc del dev dev2 root",
+        ], mock_run.call_args[0][0][4:])
+
+    def test_apply_failures(self):
+        mock_host_exec = mock.Mock()
+        mock_host_exec.run.side_effect = HostExecError("", exit_code=1, output=(
+            "Cannot find device \"dev2\"\nCommand failed -:2\n"
+            "Cannot find device \"dev4\"\nCommand failed -:4\n"))
+        net = BlockadeNetwork(None, mock_host_exec)
+
+        with self.assertRaises(TrafficControlError) as cm:
+            net.traffic_control.apply([("dev1", ["netem", "loss", "30%"]),
+                                       ("dev2", ["netem", "loss", "30%"]),
+                                       ("dev3", None),
+                                       ("dev4", None)])
+
+        failures = cm.exception.failures
+        self.assertEqual(["dev2", "dev4"], sorted(failures))
+        self.assertIn("dev4", failures["dev4"])
+
+    def test_apply_unknown_failure(self):
+        mock_host_exec = mock.Mock()
+        mock_host_exec.run.side_effect = HostExecError(
+            "", exit_code=127, output="sh: tc: not found")
+        net = BlockadeNetwork(None, mock_host_exec)
+
+        with self.assertRaisesRegexp(HostExecError, "not found"):
+            net.traffic_control.apply({"dev1": ["netem", "loss", "30%"]})
+
+    def test_throttle(self):
+        throttle_config = "rate 1mbit burst 32kbit latency 400ms"
+        mock_host_exec = mock.Mock()
+        mock_run = mock_host_exec.run
+        mock_config = mock.Mock()
+        mock_config.network = {"throttle": throttle_config}
+        net = BlockadeNetwork(mock_config, mock_host_exec)
+        net.throttle("mydevice")
+        cmd = ["tc", "qdisc", "replace", "dev", "mydevice",
+               "root", "tbf"] + throttle_config.split()
+        mock_run.assert_called_once_with(cmd)
+
+    def test_network_state_throttle(self):
+        self._network_state(NetworkState.THROTTLE, THROTTLE_QDISC_SHOW)
+
     def test_network_state_slow(self):
         self._network_state(NetworkState.SLOW, SLOW_QDISC_SHOW)
 
@@ -342,6 +570,9 @@ class NetTests(unittest.TestCase):
     def test_network_state_flaky(self):
         self._network_state(NetworkState.FLAKY, FLAKY_QDISC_SHOW)
 
+    def test_network_state_impaired(self):
+        self._network_state(NetworkState.IMPAIRED, IMPAIRED_QDISC_SHOW)
+
     def _network_state(self, state, output):
         mock_host_exec = mock.Mock()
         mock_run = mock_host_exec.run
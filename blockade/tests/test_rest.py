@@ -14,13 +14,26 @@
 # limitations under the License.
 #
 
+from blockade import audit
+from blockade import errors
+from blockade import timing
+from blockade.api import manager
 from blockade.api.manager import BlockadeManager
+from blockade.api import rest
 from blockade.api.rest import app
+from blockade.config import BlockadeConfig
 from blockade.core import Blockade
 from blockade.tests import unittest
 
+import gevent
 import json
 import mock
+import os
+import shutil
+import tempfile
+import threading
+import time
+import zlib
 
 
 class RestTests(unittest.TestCase):
@@ -31,6 +44,12 @@ class RestTests(unittest.TestCase):
     def setUp(self):
         self.client = app.test_client()
         self.blockade = mock.MagicMock()
+        self.tempdir = tempfile.mkdtemp()
+        BlockadeManager.set_data_dir(self.tempdir)
+
+    def tearDown(self):
+        BlockadeManager.close_store()
+        shutil.rmtree(self.tempdir, ignore_errors=True)
 
     def test_network_state_missing_state(self):
         data = '''
@@ -87,6 +106,76 @@ class RestTests(unittest.TestCase):
             self.assertEqual(204, result.status_code)
             self.assertEqual(1, self.blockade.fast.call_count)
 
+    def test_network_state_traced(self):
+        def fast(container_names):
+            with timing.phase(timing.HOST, tool="tc"):
+                pass
+
+        self.blockade.fast.side_effect = fast
+        data = '{"network_state": "fast", "container_names": ["c1"]}'
+        with mock.patch.object(BlockadeManager,
+                               'get_blockade',
+                               return_value=self.blockade), \
+             mock.patch.object(BlockadeManager,
+                               'blockade_exists',
+                               return_value=True):
+
+            result = self.client.post(
+                '/blockade/%s/network_state?trace=1' % self.name,
+                headers=self.headers, data=data)
+
+        self.assertEqual(204, result.status_code)
+        location = result.headers['X-Blockade-Trace']
+        result = self.client.get(location)
+        self.assertEqual(200, result.status_code)
+        events = json.loads(result.get_data(as_text=True))['traceEvents']
+        self.assertEqual(
+            ["POST /blockade/%s/network_state" % self.name, "host"],
+            sorted(e["name"] for e in events if e["ph"] == "X"))
+
+        self.assertEqual(404, self.client.get('/traces/nope').status_code)
+
+    def test_traces_pruned(self):
+        data = '{"network_state": "fast", "container_names": ["c1"]}'
+        locations = []
+        with mock.patch.object(rest, 'MAX_TRACES', 3), \
+             mock.patch.object(BlockadeManager,
+                               'get_blockade',
+                               return_value=self.blockade), \
+             mock.patch.object(BlockadeManager,
+                               'blockade_exists',
+                               return_value=True):
+
+            for _ in range(5):
+                result = self.client.post(
+                    '/blockade/%s/network_state?trace=1' % self.name,
+                    headers=self.headers, data=data)
+                locations.append(result.headers['X-Blockade-Trace'])
+
+        self.assertEqual(3, len(os.listdir(rest._trace_dir())))
+        self.assertEqual(200, self.client.get(locations[-1]).status_code)
+
+    def test_network_state_throttle(self):
+        data = '''
+            {
+                "network_state": "throttle",
+                "container_names": ["c1"]
+            }
+        '''
+        with mock.patch.object(BlockadeManager,
+                               'get_blockade',
+                               return_value=self.blockade), \
+             mock.patch.object(BlockadeManager,
+                               'blockade_exists',
+                               return_value=True):
+
+            result = self.client.post('/blockade/%s/network_state' % self.name,
+                                      headers=self.headers,
+                                      data=data)
+
+            self.assertEqual(204, result.status_code)
+            self.assertEqual(1, self.blockade.throttle.call_count)
+
     def test_action_missing_command(self):
         data = '''
             {
@@ -142,6 +231,41 @@ class RestTests(unittest.TestCase):
             self.assertEqual(204, result.status_code)
             self.assertEqual(1, self.blockade.start.call_count)
 
+    def test_batch(self):
+        data = '''
+            {
+                "steps": [
+                    {"action": "stop", "container_names": ["c1"]},
+                    {"network_state": "slow", "container_names": ["c2"]}
+                ]
+            }
+        '''
+        outcomes = [{"status": "Success", "message": "", "targets": ["c1"],
+                     "results": {"c1": "Success"}},
+                    {"status": "Failed", "message": "boom", "targets": ["c2"],
+                     "results": {"c2": "boom"}}]
+        self.blockade.batch.return_value = outcomes
+        with mock.patch.object(BlockadeManager,
+                               'get_blockade',
+                               return_value=self.blockade), \
+             mock.patch.object(BlockadeManager,
+                               'blockade_exists',
+                               return_value=True):
+
+            result = self.client.post('/blockade/%s/batch' % self.name,
+                                      headers=self.headers,
+                                      data=data)
+
+            self.assertEqual(200, result.status_code)
+            result_data = json.loads(result.get_data(as_text=True))
+            self.assertEqual(outcomes, result_data['steps'])
+            self.assertEqual(1, self.blockade.batch.call_count)
+
+            result = self.client.post('/blockade/%s/batch' % self.name,
+                                      headers=self.headers,
+                                      data='{"steps": {}}')
+            self.assertEqual(400, result.status_code)
+
     def test_delete_partition(self):
         with mock.patch.object(BlockadeManager,
                                'get_blockade',
@@ -191,6 +315,100 @@ class RestTests(unittest.TestCase):
             self.assertEqual(204, result.status_code)
             self.assertEqual(1, self.blockade.partition.call_count)
 
+    def test_partitions_edges(self):
+        data = '''
+            {
+                "edges": [["c1", "c2"]]
+            }
+        '''
+        with mock.patch.object(BlockadeManager,
+                               'get_blockade',
+                               return_value=self.blockade), \
+             mock.patch.object(BlockadeManager,
+                               'blockade_exists',
+                               return_value=True):
+
+            result = self.client.post('/blockade/%s/partitions' % self.name,
+                                      headers=self.headers,
+                                      data=data)
+
+            self.assertEqual(204, result.status_code)
+            self.blockade.partition.assert_called_once_with(
+                [], edges=[["c1", "c2"]])
+
+    def test_partitions_invalid_edges(self):
+        data = '''
+            {
+                "edges": [["c1", "c2", "c3"]]
+            }
+        '''
+        with mock.patch.object(BlockadeManager,
+                               'get_blockade',
+                               return_value=self.blockade), \
+             mock.patch.object(BlockadeManager,
+                               'blockade_exists',
+                               return_value=True):
+
+            result = self.client.post('/blockade/%s/partitions' % self.name,
+                                      headers=self.headers,
+                                      data=data)
+
+            self.assertEqual(400, result.status_code)
+            self.assertEqual(0, self.blockade.partition.call_count)
+
+    def test_links(self):
+        data = '''
+            {
+                "links": {"c1": {"c2": "delay 20ms"}}
+            }
+        '''
+        with mock.patch.object(BlockadeManager,
+                               'get_blockade',
+                               return_value=self.blockade), \
+             mock.patch.object(BlockadeManager,
+                               'blockade_exists',
+                               return_value=True):
+
+            result = self.client.post('/blockade/%s/links' % self.name,
+                                      headers=self.headers,
+                                      data=data)
+
+            self.assertEqual(204, result.status_code)
+            self.blockade.impair_links.assert_called_once_with(
+                {"c1": {"c2": "delay 20ms"}})
+
+    def test_links_invalid(self):
+        data = '''
+            {
+                "links": {"c1": ["c2"]}
+            }
+        '''
+        with mock.patch.object(BlockadeManager,
+                               'blockade_exists',
+                               return_value=True):
+
+            result = self.client.post('/blockade/%s/links' % self.name,
+                                      headers=self.headers,
+                                      data=data)
+
+            self.assertEqual(400, result.status_code)
+
+    def test_links_usage_error(self):
+        self.blockade.impair_links.side_effect = errors.BlockadeUsageError(
+            "Impairment of link c1->c2 must be a string, not 20")
+        with mock.patch.object(BlockadeManager,
+                               'get_blockade',
+                               return_value=self.blockade), \
+             mock.patch.object(BlockadeManager,
+                               'blockade_exists',
+                               return_value=True):
+
+            result = self.client.post('/blockade/%s/links' % self.name,
+                                      headers=self.headers,
+                                      data='{"links": {"c1": {"c2": 20}}}')
+
+            self.assertEqual(400, result.status_code)
+            self.assertIn("c1->c2", result.get_data(as_text=True))
 
     def test_delete_blockade(self):
         with mock.patch.object(BlockadeManager,
@@ -205,6 +423,120 @@ class RestTests(unittest.TestCase):
             self.assertEqual(204, result.status_code)
             self.assertEqual(1, self.blockade.destroy.call_count)
 
+    def test_get_events_filtered(self):
+        self.blockade.get_audit.return_value.query.return_value = ['{"a": 1}']
+        with mock.patch.object(BlockadeManager,
+                               'get_blockade',
+                               return_value=self.blockade), \
+             mock.patch.object(BlockadeManager,
+                               'blockade_exists',
+                               return_value=True):
+
+            result = self.client.get(
+                '/blockade/%s/events?since=1000&event=slow,flaky'
+                '&container=c1&limit=5' % self.name)
+
+            self.assertEqual(200, result.status_code)
+            self.assertEqual('{"events": [{"a": 1}]}',
+                             result.get_data(as_text=True))
+            self.blockade.get_audit.return_value.query.assert_called_once_with(
+                as_json=False, since=1000.0, until=None,
+                events=["slow", "flaky"], containers=["c1"], limit=5,
+                last=None)
+
+            result = self.client.get('/blockade/%s/events?tail=20' % self.name)
+            self.assertEqual(200, result.status_code)
+            self.blockade.get_audit.return_value.query.assert_called_with(
+                as_json=False, since=None, until=None, events=None,
+                containers=None, limit=None, last=20)
+
+            result = self.client.get(
+                '/blockade/%s/events?since=yesterday' % self.name)
+            self.assertEqual(400, result.status_code)
+
+    def test_get_events_is_json(self):
+        self.blockade.get_audit.return_value.query.return_value = iter(
+            ['{"a": %d}\n' % i for i in range(3)])
+        with mock.patch.object(BlockadeManager,
+                               'get_blockade',
+                               return_value=self.blockade), \
+             mock.patch.object(BlockadeManager,
+                               'blockade_exists',
+                               return_value=True):
+
+            result = self.client.get('/blockade/%s/events' % self.name)
+
+        self.assertEqual(200, result.status_code)
+        self.assertEqual({"events": [{"a": 0}, {"a": 1}, {"a": 2}]},
+                         json.loads(result.get_data(as_text=True)))
+
+    def test_get_blockade_gzip(self):
+        containers = []
+        for idx in range(1000):
+            container = mock.Mock()
+            container.name = "c%d" % idx
+            container.to_dict.return_value = {"name": container.name,
+                                              "status": "UP"}
+            containers.append(container)
+        self.blockade.status.return_value = containers
+        with mock.patch.object(BlockadeManager,
+                               'get_blockade',
+                               return_value=self.blockade), \
+             mock.patch.object(BlockadeManager,
+                               'blockade_exists',
+                               return_value=True):
+
+            plain = self.client.get('/blockade/%s' % self.name)
+            compressed = self.client.get('/blockade/%s' % self.name,
+                                         headers={'Accept-Encoding': 'gzip'})
+
+        self.assertNotIn('Content-Encoding', plain.headers)
+        data = json.loads(plain.get_data(as_text=True))
+        self.assertEqual(1000, len(data['containers']))
+        self.assertEqual({"name": "c7", "status": "UP"},
+                         data['containers']['c7'])
+
+        self.assertEqual('gzip', compressed.headers['Content-Encoding'])
+        self.assertIn('Accept-Encoding', compressed.headers['Vary'])
+        body = compressed.get_data()
+        self.assertLess(len(body), len(plain.get_data()))
+        self.assertEqual(data, json.loads(
+            zlib.decompress(body, 16 + zlib.MAX_WBITS).decode('utf-8')))
+
+    def test_small_response_not_compressed(self):
+        result = self.client.get('/jobs/nope',
+                                 headers={'Accept-Encoding': 'gzip'})
+        self.assertEqual(404, result.status_code)
+        self.assertNotIn('Content-Encoding', result.headers)
+
+    def test_follow_events(self):
+        auditor = audit.EventAuditor(os.path.join(self.tempdir, "b.json"))
+        auditor.log_event("SLOW", "Success", "message0", ["c2"])
+        auditor.log_event("SLOW", "Success", "message1", ["c2"])
+        self.blockade.get_audit.return_value = auditor
+        with mock.patch.object(BlockadeManager,
+                               'get_blockade',
+                               return_value=self.blockade), \
+             mock.patch.object(BlockadeManager,
+                               'blockade_exists',
+                               return_value=True):
+
+            result = self.client.get(
+                '/blockade/%s/events?follow=1&tail=1&container=c2'
+                % self.name, buffered=False)
+            self.assertEqual(200, result.status_code)
+            self.assertEqual('text/event-stream', result.mimetype)
+
+            stream = iter(result.response)
+            self.assertIn('"message1"', next(stream).decode())
+            auditor.log_event("FLAKY", "Success", "message2", ["c1"])
+            auditor.log_event("FLAKY", "Success", "message3", ["c2"])
+            chunk = next(stream).decode()
+            self.assertTrue(chunk.startswith("data: "))
+            self.assertEqual("message3", json.loads(chunk[6:])['message'])
+            result.close()
+        auditor.clean()
+
     def test_get_blockade(self):
         with mock.patch.object(BlockadeManager,
                                'get_blockade',
@@ -219,6 +551,165 @@ class RestTests(unittest.TestCase):
             self.assertEqual(200, result.status_code)
             self.assertTrue('containers' in result_data)
 
+    def test_blockade_instances_are_reused(self):
+        config = BlockadeConfig.from_dict({"containers": {"c1": {"image": "i"}}})
+        BlockadeManager.store_config(self.name, config,
+                                     {"containers": {"c1": {"image": "i"}}})
+        BlockadeManager.set_host_exec(mock.Mock())
+        self.addCleanup(BlockadeManager.set_host_exec, None)
+
+        with mock.patch.object(BlockadeManager, 'get_docker_client',
+                               return_value=mock.Mock()) as get_client:
+            b = BlockadeManager.get_blockade(self.name)
+            self.assertIs(b, BlockadeManager.get_blockade(self.name))
+            self.assertEqual(1, get_client.call_count)
+
+            # destroying the blockade drops the instance
+            BlockadeManager.delete_config(self.name)
+            BlockadeManager.store_config(self.name, config, {"containers": {}})
+            self.assertIsNot(b, BlockadeManager.get_blockade(self.name))
+
+    def _concurrent_network_states(self, names):
+        '''Post network states for all names at once, return how many of
+        them ran at the same time'''
+        lock = threading.Lock()
+        running = [0, 0]
+
+        def slow(container_names):
+            with lock:
+                running[0] += 1
+                running[1] = max(running)
+            time.sleep(0.1)
+            with lock:
+                running[0] -= 1
+
+        self.blockade.slow.side_effect = slow
+        data = '{"network_state": "slow", "container_names": ["c1"]}'
+        with mock.patch.object(BlockadeManager,
+                               'get_blockade',
+                               return_value=self.blockade), \
+             mock.patch.object(BlockadeManager,
+                               'blockade_exists',
+                               return_value=True):
+            requests = [gevent.spawn(self.client.post,
+                                     '/blockade/%s/network_state' % name,
+                                     headers=self.headers, data=data)
+                        for name in names]
+            gevent.joinall(requests)
+        self.assertEqual([204] * len(names),
+                         [r.value.status_code for r in requests])
+        return running[1]
+
+    def test_blockades_changed_in_parallel(self):
+        self.assertEqual(2, self._concurrent_network_states(["b1", "b2"]))
+
+    def test_blockade_changed_one_at_a_time(self):
+        self.assertEqual(1, self._concurrent_network_states(["b1", "b1"]))
+
+    def test_read_write_lock(self):
+        lock = BlockadeManager.get_lock(self.name)
+        self.assertIs(lock, BlockadeManager.get_lock(self.name))
+        acquired = []
+
+        def write():
+            with BlockadeManager.write_lock(self.name):
+                acquired.append("write")
+
+        with BlockadeManager.read_lock(self.name):
+            # readers share the lock
+            with BlockadeManager.read_lock(self.name):
+                pass
+            writer = threading.Thread(target=write)
+            writer.start()
+            writer.join(0.1)
+            self.assertEqual([], acquired)
+        writer.join()
+        self.assertEqual(["write"], acquired)
+
+    def test_restore(self):
+        config = {"containers": {"c1": {"image": "ubuntu"}}}
+        BlockadeManager.store_config(
+            self.name, BlockadeConfig.from_dict(config), config)
+        BlockadeManager.store_chaos(self.name, {"min_start_delay": 100000,
+                                                "max_start_delay": 100000})
+        BlockadeManager.store_chaos_state(self.name, "DEGRADED")
+        BlockadeManager.close_store()
+        self.addCleanup(rest._chaos.shutdown)
+
+        with mock.patch.object(BlockadeManager,
+                               'get_blockade') as get_blockade:
+            rest.restore()
+            # Docker is left alone until chaos acts on the blockade
+            self.assertFalse(get_blockade.called)
+
+        self.assertIn(self.name, manager._CONFIGS)
+        self.assertEqual({"state": "DEGRADED"},
+                         rest._chaos.status(self.name))
+        rest._chaos.stop(self.name)
+        rest._chaos.delete(self.name)
+
+    def test_get_blockade_not_modified(self):
+        with mock.patch.object(BlockadeManager,
+                               'get_blockade',
+                               return_value=self.blockade), \
+             mock.patch.object(BlockadeManager,
+                               'blockade_exists',
+                               return_value=True):
+
+            result = self.client.get('/blockade/%s' % self.name)
+            self.assertEqual(200, result.status_code)
+            etag = result.headers['ETag']
+            self.assertTrue(etag.startswith('W/"'))
+            self.assertIn('Accept-Encoding', result.headers['Vary'])
+
+            result = self.client.get('/blockade/%s' % self.name,
+                                     headers={'If-None-Match': etag,
+                                              'Accept-Encoding': 'gzip'})
+            self.assertEqual(304, result.status_code)
+            self.assertEqual(etag, result.headers['ETag'])
+            self.assertIn('Accept-Encoding', result.headers['Vary'])
+            self.assertEqual(1, self.blockade.status.call_count)
+
+            # changing the blockade changes its status version
+            self.client.delete('/blockade/%s/partitions' % self.name)
+            result = self.client.get('/blockade/%s' % self.name,
+                                     headers={'If-None-Match': etag})
+            self.assertEqual(200, result.status_code)
+            self.assertNotEqual(etag, result.headers['ETag'])
+            self.assertEqual(2, self.blockade.status.call_count)
+
+    def test_docker_events_change_status_version(self):
+        stopped = threading.Event()
+
+        def events(decode, filters):
+            yield {"Actor": {"ID": "c1", "Attributes": {"blockade.id": "b1"}}}
+            yield {"Actor": {"ID": "c2", "Attributes": {}}}
+            stopped.set()
+
+        client = mock.Mock()
+        client.events.side_effect = events
+        with mock.patch.object(BlockadeManager, 'blockades_with_container',
+                               return_value=["b2"]) as lookup, \
+             mock.patch.object(manager, 'EVENTS_RECONNECT_DELAY', 10):
+            versions = [BlockadeManager.status_version(name)
+                        for name in ("b1", "b2", "b3")]
+            BlockadeManager.watch_docker_events(client)
+            self.addCleanup(BlockadeManager.stop_watching_docker_events)
+            self.assertTrue(stopped.wait(5))
+            time.sleep(0.05)
+
+        lookup.assert_called_once_with("c2")
+        # not connected to the Docker events any more
+        self.assertIsNone(BlockadeManager.status_version("b1"))
+        BlockadeManager.stop_watching_docker_events()
+        new_versions = [BlockadeManager.status_version(name)
+                        for name in ("b1", "b2", "b3")]
+        self.assertNotEqual(versions, new_versions)
+        b1, b2, b3 = [v.rsplit("-", 1)[1] for v in new_versions]
+        self.assertEqual(int(b1), int(versions[0].rsplit("-", 1)[1]) + 1)
+        self.assertEqual(int(b2), int(versions[1].rsplit("-", 1)[1]) + 1)
+        self.assertEqual(b3, versions[2].rsplit("-", 1)[1])
+
     def test_get_all_blockades(self):
         blockades = {
             'blockade1': 'abc',
@@ -263,6 +754,69 @@ class RestTests(unittest.TestCase):
             self.assertEqual(1, self.blockade.create.call_count)
             self.assertEqual(204, result.status_code)
 
+            # the config survives a restart of the daemon
+            BlockadeManager.set_data_dir(self.tempdir)
+            self.assertTrue(BlockadeManager.blockade_exists(self.name))
+            config = BlockadeManager.get_config(self.name)
+            self.assertEqual(["c1", "c2"], sorted(config.containers))
+
+            result = self.client.post('/blockade/%s' % self.name,
+                                      headers=self.headers,
+                                      data=data)
+            self.assertEqual(400, result.status_code)
+
+
+    def _wait_for_job(self, location):
+        for _ in range(100):
+            result = self.client.get(location)
+            job = json.loads(result.get_data(as_text=True))
+            if job['finished'] is not None:
+                return job
+            time.sleep(0.01)
+        self.fail("job did not finish")
+
+    def test_create_blockade_async(self):
+        data = '{"containers": {"c1": {"image": "ubuntu:trusty"}}}'
+        self.blockade.create.side_effect = \
+            lambda progress: progress(1, 1, "Started 'c1'")
+        with mock.patch.object(BlockadeManager,
+                               'get_blockade',
+                               return_value=self.blockade):
+
+            result = self.client.post('/blockade/%s' % self.name,
+                                      headers=self.headers,
+                                      data=data,
+                                      query_string={'async': '1'})
+            self.assertEqual(202, result.status_code)
+            location = result.headers['Location']
+            job_id = json.loads(result.get_data(as_text=True))['id']
+            self.assertTrue(location.endswith('/jobs/%s' % job_id))
+
+            job = self._wait_for_job(location)
+            self.assertEqual('succeeded', job['status'])
+            self.assertEqual('create', job['action'])
+            self.assertEqual("[1/1] Started 'c1'", job['progress'])
+
+    def test_delete_blockade_async(self):
+        self.blockade.destroy.side_effect = Exception("boom")
+        with mock.patch.object(BlockadeManager,
+                               'get_blockade',
+                               return_value=self.blockade), \
+             mock.patch.object(BlockadeManager,
+                               'blockade_exists',
+                               return_value=True):
+
+            result = self.client.delete('/blockade/%s' % self.name,
+                                        query_string={'async': 'true'})
+            self.assertEqual(202, result.status_code)
+
+            job = self._wait_for_job(result.headers['Location'])
+            self.assertEqual('failed', job['status'])
+            self.assertEqual('boom', job['error'])
+
+    def test_get_unknown_job(self):
+        result = self.client.get('/jobs/nosuchjob')
+        self.assertEqual(404, result.status_code)
 
     def test_add_docker_container(self):
         data = '''
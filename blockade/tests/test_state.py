@@ -14,12 +14,19 @@
 # limitations under the License.
 #
 
+import fcntl
+import json
 import os
 import shutil
 import tempfile
+import threading
+
+import mock
+import yaml
 
 from blockade.tests import unittest
 from blockade.state import BlockadeState
+from blockade.errors import AlreadyInitializedError
 from blockade.errors import NotInitializedError
 
 
@@ -79,6 +86,146 @@ class BlockadeStateTests(unittest.TestCase):
         self.assertEqual(self.state.containers["n1"], {"a": 2})
         self.assertEqual(self.state.containers["n2"], {"a": 4})
 
+    def test_state_load_cached(self):
+        containers = {"n1": {"a": 1}, "n2": {"a": 4}}
+        self.state.initialize(containers=containers)
+
+        with mock.patch("blockade.state._parse_state") as mock_load:
+            # nothing changed since our own write
+            self.state.load()
+            self.state.load()
+            self.assertEqual(0, mock_load.call_count)
+
+    def test_state_load_external_change(self):
+        containers = {"n1": {"a": 1}, "n2": {"a": 4}}
+        self.state.initialize(containers=containers)
+
+        # another process updates the state behind our back
+        other = BlockadeState(data_dir=self.tempdir)
+        other.load()
+        other.update({"n1": {"a": 1}, "n2": {"a": 4}, "n3": {"a": 9}})
+
+        self.state.load()
+        self.assertEqual(self.state.containers["n3"], {"a": 9})
+
+    def test_state_containers_view(self):
+        containers = {"n1": {"a": 1}, "n2": {"a": 4}}
+        self.state.initialize(containers=containers)
+
+        view = self.state.containers_view
+        self.assertEqual(["n1", "n2"], sorted(view))
+        self.assertEqual(4, view["n2"]["a"])
+        self.assertEqual(dict(view["n1"]), {"a": 1})
+        with self.assertRaises(TypeError):
+            view["n3"] = {"a": 5}
+        with self.assertRaises(TypeError):
+            view["n1"]["a"] = 5
+
+        # the view is a snapshot of the state it was taken from
+        self.state.update({"n1": {"a": 2}})
+        self.assertEqual(1, view["n1"]["a"])
+        self.assertEqual(2, self.state.containers_view["n1"]["a"])
+
+    def test_state_written_as_json(self):
+        containers = {"n1": {"a": 1}, "n2": {"a": 4}}
+        self.state.initialize(containers=containers)
+        self.state.update({"n1": {"a": 1}})
+
+        with open(".blockade/state.yml") as f:
+            state = json.load(f)
+        self.assertEqual(2, state["version"])
+        self.assertEqual({"n1": {"a": 1}}, state["containers"])
+
+    def test_state_migrate_version_1(self):
+        containers = {"n1": {"a": 1}, "n2": {"a": 4}}
+        os.mkdir(".blockade")
+        with open(".blockade/state.yml", "w") as f:
+            yaml.safe_dump(dict(blockade_id="abc", containers=containers,
+                                version=1), f)
+
+        self.state.load()
+        self.assertEqual(self.state.containers, containers)
+
+        # the state file got rewritten in the current format
+        with open(".blockade/state.yml") as f:
+            state = json.load(f)
+        self.assertEqual(2, state["version"])
+        self.assertEqual(containers, state["containers"])
+
+    def test_state_migrate_keeps_concurrent_update(self):
+        os.mkdir(".blockade")
+        with open(".blockade/state.yml", "w") as f:
+            yaml.safe_dump(dict(blockade_id="abc", containers={"n1": {}},
+                                version=1), f)
+        writer = BlockadeState(data_dir=self.tempdir)
+        reader = BlockadeState(data_dir=self.tempdir)
+
+        with writer.lock():
+            # the reader sees version 1 and waits to migrate it
+            loader = threading.Thread(target=reader.load)
+            loader.start()
+            loader.join(0.2)
+            self.assertTrue(loader.is_alive())
+            writer.update({"n1": {}, "n2": {}})
+        loader.join()
+
+        # the update is neither lost nor rewritten
+        self.assertEqual({"n1": {}, "n2": {}}, reader.containers)
+        writer.load()
+        self.assertEqual({"n1": {}, "n2": {}}, writer.containers)
+
+    def test_state_initialize_twice(self):
+        self.state.initialize(containers={"n1": {"a": 1}})
+
+        other = BlockadeState(data_dir=self.tempdir)
+        with self.assertRaises(AlreadyInitializedError):
+            other.initialize(containers={"n2": {"a": 2}})
+        self.assertEqual(["state.yml"], os.listdir(".blockade"))
+
+        self.state.load()
+        self.assertEqual(self.state.containers, {"n1": {"a": 1}})
+
+    def test_state_update_replaces_file(self):
+        self.state.initialize(containers={"n1": {"a": 1}})
+        inode = os.stat(".blockade/state.yml").st_ino
+
+        self.state.update({"n1": {"a": 2}})
+        self.assertNotEqual(inode, os.stat(".blockade/state.yml").st_ino)
+        self.assertEqual(["state.yml"], os.listdir(".blockade"))
+
+    def test_state_lock(self):
+        self.state.initialize(containers={"n1": {"a": 1}})
+        other = BlockadeState(data_dir=self.tempdir)
+        acquired = threading.Event()
+
+        def _lock_other():
+            with other.lock():
+                acquired.set()
+
+        with self.state.lock():
+            # the lock is recursive, also across instances
+            with other.lock():
+                pass
+
+            # other processes cannot take the lock
+            fd = os.open(".blockade", os.O_RDONLY)
+            try:
+                with self.assertRaises(IOError):
+                    fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            finally:
+                os.close(fd)
+
+            # neither can other threads
+            thread = threading.Thread(target=_lock_other)
+            thread.start()
+            self.assertFalse(acquired.wait(0.1))
+
+            # while reading is always possible
+            other.load()
+
+        thread.join()
+        self.assertTrue(acquired.is_set())
+
     def test_state_uninitialized(self):
         with self.assertRaises(NotInitializedError):
             self.state.load()
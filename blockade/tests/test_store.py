@@ -0,0 +1,170 @@
+#
+#  Copyright (C) 2016 Dell, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+import os
+import shutil
+import sqlite3
+import tempfile
+
+from blockade.api.store import BlockadeStore
+from blockade.api.store import StoreState
+from blockade.errors import AlreadyInitializedError
+from blockade.errors import NotInitializedError
+from blockade.tests import unittest
+
+
+class BlockadeStoreTests(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tempdir, "blockade.db")
+        self.store = BlockadeStore(self.path)
+
+    def tearDown(self):
+        self.store.close()
+        shutil.rmtree(self.tempdir, ignore_errors=True)
+
+    def test_config(self):
+        config = {"containers": {"c1": {"image": "ubuntu"}}}
+        self.store.put_config("b1", config)
+        self.store.put_config("a1", {})
+
+        with self.assertRaises(AlreadyInitializedError):
+            self.store.put_config("b1", {})
+
+        self.assertTrue(self.store.exists("b1"))
+        self.assertFalse(self.store.exists("c1"))
+        self.assertEqual(["a1", "b1"], self.store.names())
+        self.assertEqual(config, self.store.get_config("b1"))
+
+        self.store.delete("b1")
+        self.assertFalse(self.store.exists("b1"))
+        self.assertIsNone(self.store.get_config("b1"))
+
+    def test_persistent(self):
+        self.store.put_config("b1", {"network": {}})
+        self.store.put_containers("b1", {"c1": {"id": "abc"}})
+        self.store.put_chaos("b1", {"min_run_time": 5})
+        self.store.close()
+
+        self.store = BlockadeStore(self.path)
+        self.assertEqual(["b1"], self.store.names())
+        self.assertEqual({"network": {}}, self.store.get_config("b1"))
+        containers, _ = self.store.get_containers("b1")
+        self.assertEqual({"c1": {"id": "abc"}}, containers)
+        self.assertEqual({"min_run_time": 5}, self.store.get_chaos("b1"))
+
+    def test_chaos_state(self):
+        self.store.put_config("b1", {"network": {}})
+        self.store.put_config("b2", {})
+        self.store.put_chaos("b1", {"min_run_time": 5})
+        self.store.put_chaos_state("b1", "DEGRADED")
+        # updating the options keeps the state
+        self.store.put_chaos("b1", {"min_run_time": 6})
+        # no chaos on b2 to record the state of
+        self.store.put_chaos_state("b2", "HEALTHY")
+
+        self.assertEqual([("b1", {"min_run_time": 6}, "DEGRADED")],
+                         self.store.all_chaos())
+        self.assertEqual({"b1": {"network": {}}, "b2": {}},
+                         self.store.configs())
+
+    def test_migrate_version_1(self):
+        self.store.close()
+        os.remove(self.path)
+        db = sqlite3.connect(self.path)
+        db.executescript('''
+            CREATE TABLE blockades (name TEXT PRIMARY KEY,
+                config TEXT NOT NULL, containers TEXT,
+                revision INTEGER NOT NULL DEFAULT 0);
+            CREATE TABLE chaos (name TEXT PRIMARY KEY
+                REFERENCES blockades (name) ON DELETE CASCADE,
+                options TEXT NOT NULL);
+            INSERT INTO blockades (name, config) VALUES ('b1', '{}');
+            INSERT INTO chaos (name, options) VALUES ('b1', '{}');
+            PRAGMA user_version=1;
+        ''')
+        db.close()
+
+        self.store = BlockadeStore(self.path)
+        self.assertEqual([], self.store.names_with_container("abc"))
+        self.assertEqual([("b1", {}, None)], self.store.all_chaos())
+        self.store.put_chaos_state("b1", "HEALTHY")
+        self.assertEqual([("b1", {}, "HEALTHY")], self.store.all_chaos())
+
+    def test_migrate_version_2(self):
+        self.store.put_config("b1", {})
+        self.store.put_containers("b1", {"c1": {"id": "abc"}})
+        self.store.close()
+        db = sqlite3.connect(self.path)
+        db.executescript('''
+            DROP TABLE containers;
+            PRAGMA user_version=2;
+        ''')
+        db.close()
+
+        self.store = BlockadeStore(self.path)
+        self.assertEqual(["b1"], self.store.names_with_container("abc"))
+
+    def test_names_with_container(self):
+        self.store.put_config("b1", {})
+        self.store.put_config("b2", {})
+        self.store.put_containers("b1", {"c1": {"id": "abc"},
+                                         "c2": {"id": "def"}})
+        self.store.put_containers("b2", {"c1": {"id": "abc"}})
+        self.assertEqual(["b1", "b2"], self.store.names_with_container("abc"))
+        self.assertEqual(["b1"], self.store.names_with_container("def"))
+
+        # the index follows updates, destroys and deletes
+        self.store.put_containers("b1", {"c2": {"id": "def"}})
+        self.assertEqual(["b2"], self.store.names_with_container("abc"))
+        self.store.delete_containers("b2")
+        self.assertEqual([], self.store.names_with_container("abc"))
+        self.store.delete("b1")
+        self.assertEqual([], self.store.names_with_container("def"))
+
+    def test_chaos_deleted_with_blockade(self):
+        self.store.put_config("b1", {})
+        self.store.put_chaos("b1", {"min_run_time": 5})
+        self.store.delete("b1")
+        self.store.put_config("b1", {})
+        self.assertIsNone(self.store.get_chaos("b1"))
+
+    def test_state(self):
+        self.store.put_config("b1", {})
+        state = StoreState(self.store, "b1", data_dir=self.tempdir)
+        self.assertFalse(state.exists())
+        with self.assertRaises(NotInitializedError):
+            state.load()
+
+        containers = {"c1": {"id": "abc"}}
+        state.initialize(containers)
+        self.assertTrue(state.exists())
+        with self.assertRaises(AlreadyInitializedError):
+            StoreState(self.store, "b1").initialize(containers)
+
+        other = StoreState(self.store, "b1", data_dir=self.tempdir)
+        other.load()
+        self.assertEqual(containers, other.containers)
+        other.update({"c2": {"id": "def"}})
+
+        state.load()
+        self.assertEqual({"c2": {"id": "def"}}, state.containers)
+
+        state.destroy()
+        self.assertFalse(other.exists())
+        with self.assertRaises(NotInitializedError):
+            other.load()
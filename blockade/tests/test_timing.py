@@ -0,0 +1,134 @@
+#
+#  Copyright (C) 2016 Dell, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+import time
+
+import mock
+
+from blockade import timing
+from blockade.tests import unittest
+from blockade.utils import parallel_map
+
+
+class TimingTests(unittest.TestCase):
+
+    def test_phases_are_summed(self):
+        with timing.operation("slow") as op:
+            for _ in range(2):
+                with timing.phase("docker"):
+                    time.sleep(0.01)
+            self.assertIs(op, timing.current())
+        self.assertIsNone(timing.current())
+
+        self.assertGreaterEqual(op.phases["docker"], 0.02)
+        self.assertGreaterEqual(op.end - op.start, op.phases["docker"])
+
+    def test_nested_phase_counted_once(self):
+        with timing.operation("slow") as op:
+            with timing.phase("discovery"):
+                with timing.phase("docker"):
+                    with timing.phase("docker"):
+                        time.sleep(0.01)
+        self.assertEqual(set(["discovery", "docker"]), set(op.phases))
+        self.assertLess(op.phases["docker"], 0.02)
+        self.assertGreaterEqual(op.phases["discovery"], op.phases["docker"])
+
+    def test_phase_without_operation(self):
+        with timing.phase("docker"):
+            pass
+        self.assertIsNone(timing.current())
+
+    def test_phases_of_worker_threads(self):
+        def work(_):
+            with timing.phase("host"):
+                time.sleep(0.01)
+            return timing.current()
+
+        with timing.operation("kill") as op:
+            outcomes = parallel_map(work, range(4), 4)
+
+        self.assertEqual([op] * 4, [result for result, _ in outcomes])
+        self.assertGreaterEqual(op.phases["host"], 0.04)
+
+    def test_to_dict(self):
+        with timing.operation("stop") as op:
+            with timing.phase("docker"):
+                pass
+        d = op.to_dict()
+        self.assertEqual(op.start, d['start'])
+        self.assertEqual(op.end, d['end'])
+        self.assertEqual(round(op.end - op.start, 6), d['duration'])
+        self.assertEqual(["docker"], list(d['phases']))
+
+    def test_timed(self):
+        @timing.timed("join")
+        def join():
+            return timing.current().name
+        self.assertEqual("join", join())
+
+    def test_listeners(self):
+        spans = []
+        timing.add_listener(spans.append)
+        self.addCleanup(timing.remove_listener, spans.append)
+
+        with timing.operation("partition", blockade="b1"):
+            with timing.phase("host"):
+                pass
+        with timing.phase("docker"):
+            pass
+
+        self.assertEqual([("phase", "host"), ("operation", "partition"),
+                          ("phase", "docker")],
+                         [(s.kind, s.name) for s in spans])
+        self.assertEqual({"blockade": "b1"}, spans[1].tags)
+        self.assertGreaterEqual(spans[1].duration, 0)
+
+    def test_timed_proxy(self):
+        client = mock.Mock()
+        client.inspect_container.return_value = {"Id": "c1"}
+        client.version = "1.24"
+        proxy = timing.TimedProxy(client, "docker")
+
+        with timing.operation("start") as op:
+            self.assertEqual({"Id": "c1"}, proxy.inspect_container("c1"))
+        self.assertEqual("1.24", proxy.version)
+        client.inspect_container.assert_called_once_with("c1")
+        self.assertIn("docker", op.phases)
+
+    def test_tracing(self):
+        def work(_):
+            with timing.phase("host", tool="tc"):
+                pass
+
+        with timing.tracing("partition") as trace:
+            self.assertIs(trace, timing.current_trace())
+            with timing.operation("partition"):
+                parallel_map(work, range(2), 2)
+        self.assertIsNone(timing.current_trace())
+
+        self.assertEqual(["host", "host", "partition", "partition"],
+                         sorted(span.name for span in trace.spans))
+        self.assertEqual("trace", trace.spans[-1].kind)
+
+        chrome = trace.to_chrome_trace()
+        events = [e for e in chrome["traceEvents"] if e["ph"] == "X"]
+        self.assertEqual(4, len(events))
+        host = [e for e in events if e["name"] == "host"][0]
+        self.assertEqual({"tool": "tc"}, host["args"])
+        self.assertGreaterEqual(host["dur"], 0)
+        names = [e for e in chrome["traceEvents"] if e["ph"] == "M"]
+        self.assertEqual(set(e["tid"] for e in events),
+                         set(e["tid"] for e in names))
@@ -0,0 +1,305 @@
+#
+#  Copyright (C) 2016 Dell, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+'''
+Lightweight timing of blockade operations.
+
+An operation (e.g. a partition) is timed as a whole and split up into named
+phases such as container discovery, Docker API calls and host commands. The
+time spent in each phase is summed up per operation, across all the threads
+working on it, and is recorded in the audit log along with the start and end
+of the operation. Listeners get every finished operation and phase as a span.
+A trace collects the spans of a single request or command, which can be
+written as a Chrome trace file.
+'''
+
+from contextlib import contextmanager
+import functools
+import json
+import logging
+import os
+import threading
+import time
+
+
+DISCOVERY = "discovery"
+DEVICE = "device"
+DOCKER = "docker"
+HOST = "host"
+AUDIT = "audit"
+AUDIT_LOG = "audit_log"
+
+_logger = logging.getLogger(__name__)
+
+_local = threading.local()
+
+# listeners are replaced as a whole so that spans are published lock free
+_listeners = ()
+_listeners_lock = threading.Lock()
+
+
+class Span(object):
+    '''A finished operation or phase passed to the timing listeners'''
+
+    __slots__ = ('kind', 'name', 'start', 'end', 'thread', 'thread_id',
+                 'tags')
+
+    def __init__(self, kind, name, start, end, thread, tags, thread_id=None):
+        self.kind = kind
+        self.name = name
+        self.start = start
+        self.end = end
+        self.thread = thread
+        self.thread_id = thread_id
+        self.tags = tags
+
+    @property
+    def duration(self):
+        return self.end - self.start
+
+
+class Operation(object):
+    '''The timings of a single operation and its phases'''
+
+    def __init__(self, name, tags=None):
+        self.name = name
+        self.tags = tags or {}
+        self.start = time.time()
+        self.end = None
+        self.phases = {}
+        self._lock = threading.Lock()
+
+    def add(self, phase, duration):
+        with self._lock:
+            self.phases[phase] = self.phases.get(phase, 0.0) + duration
+
+    def to_dict(self, end=None):
+        '''The timing fields of the audit record of this operation'''
+        end = end or self.end or time.time()
+        with self._lock:
+            phases = dict((name, round(duration, 6))
+                          for name, duration in self.phases.items())
+        return {
+            'start': self.start,
+            'end': end,
+            'duration': round(end - self.start, 6),
+            'phases': phases,
+        }
+
+
+class Trace(object):
+    '''The spans of a single request or command'''
+
+    def __init__(self):
+        self.spans = []
+        self._lock = threading.Lock()
+
+    def add(self, span):
+        with self._lock:
+            self.spans.append(span)
+
+    def record(self, kind, name, start, end=None, **tags):
+        '''Add a span of the current thread'''
+        thread = threading.current_thread()
+        self.add(Span(kind, name, start, end or time.time(), thread.name,
+                      tags, thread.ident))
+
+    def to_chrome_trace(self):
+        '''The spans in the Chrome trace event format'''
+        pid = os.getpid()
+        events = []
+        threads = {}
+        with self._lock:
+            spans = list(self.spans)
+        for span in spans:
+            threads[span.thread_id] = span.thread
+            args = dict((k, str(v)) for k, v in span.tags.items())
+            events.append({
+                'name': span.name,
+                'cat': span.kind,
+                'ph': 'X',
+                'ts': int(span.start * 1e6),
+                'dur': int(span.duration * 1e6),
+                'pid': pid,
+                'tid': span.thread_id,
+                'args': args,
+            })
+        for thread_id, thread in threads.items():
+            events.append({'name': 'thread_name', 'ph': 'M', 'pid': pid,
+                           'tid': thread_id, 'args': {'name': thread}})
+        return {'traceEvents': events, 'displayTimeUnit': 'ms'}
+
+    def write(self, path):
+        with open(path, 'w') as f:
+            json.dump(self.to_chrome_trace(), f)
+
+
+def add_listener(listener):
+    '''Call listener with a Span for every finished operation and phase'''
+    global _listeners
+    with _listeners_lock:
+        _listeners = _listeners + (listener,)
+
+
+def remove_listener(listener):
+    global _listeners
+    with _listeners_lock:
+        _listeners = tuple(l for l in _listeners if l is not listener)
+
+
+def _finish(kind, name, start, end, tags, trace):
+    thread = threading.current_thread()
+    span = Span(kind, name, start, end, thread.name, tags, thread.ident)
+    if trace is not None:
+        trace.add(span)
+    for listener in _listeners:
+        try:
+            listener(span)
+        except Exception:
+            _logger.exception("Timing listener failed")
+
+
+def current():
+    '''The operation timed in the current thread or None'''
+    return getattr(_local, 'operation', None)
+
+
+def current_trace():
+    '''The trace collecting the spans of the current thread or None'''
+    return getattr(_local, 'trace', None)
+
+
+def context():
+    '''The operation and trace of this thread, see `attached`'''
+    return current(), current_trace()
+
+
+@contextmanager
+def tracing(name, **tags):
+    '''
+    Collect the spans of this thread, and its workers, in a new trace whose
+    outermost span covers the whole block.
+    '''
+    trace = Trace()
+    previous = current_trace()
+    _local.trace = trace
+    start = time.time()
+    try:
+        yield trace
+    finally:
+        _local.trace = previous
+        trace.record("trace", name, start, **tags)
+
+
+def _active_phases():
+    try:
+        return _local.phases
+    except AttributeError:
+        _local.phases = []
+        return _local.phases
+
+
+@contextmanager
+def attached(ctx):
+    '''
+    Account the phases of the current thread to the operation and trace of
+    the given `context`, which carries them over into worker threads.
+    '''
+    previous = context()
+    _local.operation, _local.trace = ctx
+    try:
+        yield
+    finally:
+        _local.operation, _local.trace = previous
+
+
+@contextmanager
+def operation(name, **tags):
+    '''Time an operation and make it the current one of this thread'''
+    op = Operation(name, tags)
+    previous = current()
+    _local.operation = op
+    try:
+        yield op
+    finally:
+        op.end = time.time()
+        _local.operation = previous
+        trace = current_trace()
+        if _listeners or trace is not None:
+            _finish("operation", name, op.start, op.end, tags, trace)
+
+
+def timed(name):
+    '''Decorator timing every call of a function as an operation'''
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with operation(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+@contextmanager
+def phase(name, **tags):
+    '''
+    Add the time spent in this block to the named phase of the current
+    operation. Phases of the same name nested in one thread are only
+    counted once, whereas phases of different names may overlap, e.g. the
+    Docker calls made during the container discovery count towards both.
+    '''
+    op = current()
+    trace = current_trace()
+    active = _active_phases()
+    if (op is None and trace is None and not _listeners) or name in active:
+        yield
+        return
+
+    active.append(name)
+    start = time.time()
+    try:
+        yield
+    finally:
+        end = time.time()
+        active.pop()
+        if op is not None:
+            op.add(name, end - start)
+        if _listeners or trace is not None:
+            _finish("phase", name, start, end, tags, trace)
+
+
+class TimedProxy(object):
+    '''Proxy to an object timing every method call as the given phase'''
+
+    def __init__(self, target, phase_name):
+        self._target = target
+        self._phase_name = phase_name
+
+    @property
+    def target(self):
+        return self._target
+
+    def __getattr__(self, attr):
+        value = getattr(self._target, attr)
+        if not callable(value):
+            return value
+
+        phase_name = self._phase_name
+
+        def timed_call(*args, **kwargs):
+            with phase(phase_name, call=attr):
+                return value(*args, **kwargs)
+        return timed_call
@@ -15,8 +15,13 @@
 #
 
 from .errors import BlockadeError
+from . import timing
+
+import sys
+import threading
 
 import docker
+import six
 
 
 # NOTE the values from the client are "byte strings".
@@ -80,3 +85,48 @@ def check_docker():
             "is running and your user has the correct privileges to access " +
             "it.\nOr set the DOCKER_HOST env to point to an external Docker.")
         % (str(e),))
+
+
+def parallel_map(func, items, max_workers):
+    """Call func for every item using at most max_workers threads
+
+    Returns a list with one (result, exc_info) tuple per item, in the order
+    of the items. exc_info is None unless the call raised an exception.
+    """
+    items = list(items)
+    results = [None] * len(items)
+    # the workers account their time to the operation of the caller
+    ctx = timing.context()
+
+    def call(idx):
+        try:
+            with timing.attached(ctx):
+                results[idx] = (func(items[idx]), None)
+        except Exception:
+            results[idx] = (None, sys.exc_info())
+
+    num_workers = min(max_workers or 1, len(items))
+    if num_workers <= 1:
+        for idx in range(len(items)):
+            call(idx)
+        return results
+
+    pending = six.moves.queue.Queue()
+    for idx in range(len(items)):
+        pending.put(idx)
+
+    def worker():
+        while True:
+            try:
+                idx = pending.get_nowait()
+            except six.moves.queue.Empty:
+                return
+            call(idx)
+
+    threads = [threading.Thread(target=worker) for _ in range(num_workers)]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results